@@ -0,0 +1,282 @@
+# Benchmark of the stages of small block forensics on a synthetic corpus
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from benchmarks.corpus import SIZE_DISTRIBUTIONS, CorpusConfig, generate_corpus
+from small_blk_forensics.ml.filtering import DEFAULT_COMMON_BLOCK_THRESHOLD, BlockFilter
+from small_blk_forensics.ml.hashing import DEFAULT_HASH_ALGORITHM, HASH_ALGORITHMS
+from small_blk_forensics.ml.index import KnownHashIndex
+from small_blk_forensics.ml.model import (
+    LOOKUP_BATCH_SIZE,
+    SmallBlockForensicsModel,
+    _iter_file_cells,
+)
+
+T = TypeVar("T")
+
+# Version of the layout of the results, results with another version are not compared
+RESULTS_VERSION = 1
+
+# Stages in the order they run. Each one is timed on its own, reusing the output of the previous ones.
+STAGES = [
+    "known_hashing",
+    "db_build",
+    "block_map",
+    "sample_selection",
+    "target_hashing",
+    "lookups",
+    "index_loading",
+    "indexed_lookups",
+    "scan",
+]
+
+# A stage is flagged as a regression when it is slower than the baseline by more than this fraction, and by
+# more than MIN_REGRESSION_SECONDS so that timer noise on the fastest stages is not flagged
+DEFAULT_TOLERANCE = 0.2
+MIN_REGRESSION_SECONDS = 0.01
+
+
+def _best_of(repeat: int, func: Callable[[], T]) -> Tuple[float, T]:
+    """
+    Run func `repeat` times, and return the shortest run time along with the result of the last run.
+    The shortest time is the least disturbed by the rest of the machine.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run_benchmark(corpus_root: Path, args: argparse.Namespace) -> Dict:
+    known_directory, target_directory = corpus_root / "known", corpus_root / "target"
+    db_path = corpus_root / "known_content_hashes.sqlite"
+    model = SmallBlockForensicsModel(
+        args.block_size,
+        args.target_probability,
+        num_workers=args.num_workers,
+        num_io_threads=args.num_io_threads,
+        hash_algorithm=args.hash_algorithm,
+        block_filter=(
+            BlockFilter(skip_constant=True, common_block_threshold=DEFAULT_COMMON_BLOCK_THRESHOLD)
+            if args.filter_low_information_blocks
+            else None
+        ),
+        adaptive_sampling=args.adaptive_sampling,
+    )
+    timings: Dict[str, float] = {}
+    counts: Dict[str, int] = {}
+
+    # Hashing only, without writing to the DB
+    known_files = sorted(path for path in known_directory.rglob("*") if path.is_file())
+    timings["known_hashing"], counts["known_blocks"] = _best_of(
+        args.repeat,
+        lambda: sum(
+            1
+            for file_path in known_files
+            for _ in _iter_file_cells(file_path, args.block_size, hash_algorithm=args.hash_algorithm)
+        ),
+    )
+
+    def build_db():
+        db_path.unlink(missing_ok=True)
+        model.hash_directory(known_directory, db_path)
+
+    timings["db_build"], _ = _best_of(args.repeat, build_db)
+
+    db_conn = model._get_db_conn(db_path)
+    model._load_known_content(db_conn)
+
+    timings["block_map"], file_block_map = _best_of(
+        args.repeat, lambda: model._generate_file_block_map(target_directory)
+    )
+    counts["target_blocks"] = file_block_map.total_blocks
+
+    def select_blocks():
+        random.seed(args.seed)
+        return model._select_random_blocks(file_block_map)
+
+    timings["sample_selection"], random_blocks_info = _best_of(args.repeat, select_blocks)
+    counts["sampled_blocks"] = sum(len(blocks) for _, blocks in random_blocks_info)
+
+    # Every sampled block is read and hashed, and then looked up, as when nothing matches
+    timings["target_hashing"], cells = _best_of(
+        args.repeat,
+        lambda: [cell for cells in model._hash_random_blocks_pipelined(random_blocks_info) for cell in cells],
+    )
+
+    def look_up_all():
+        num_matches = 0
+        for start in range(0, len(cells), LOOKUP_BATCH_SIZE):
+            batch = cells[start : start + LOOKUP_BATCH_SIZE]
+            num_matches += len(model._query_hashes_in_db(list({cell.hash_value for cell in batch}), db_conn))
+        return num_matches
+
+    timings["lookups"], counts["matched_hashes"] = _best_of(args.repeat, look_up_all)
+
+    # The same lookups, with the in-memory index of the known hashes rejecting the blocks that cannot match
+    timings["index_loading"], model.known_index = _best_of(
+        args.repeat,
+        lambda: KnownHashIndex.from_db(db_conn, model.num_hashed_blocks_in_known_cntnt, sys.maxsize),
+    )
+    timings["indexed_lookups"], counts["indexed_matched_hashes"] = _best_of(args.repeat, look_up_all)
+    db_conn.close()
+
+    # The whole scan of the target, which stops at the first match. Unlike the stages above, it samples
+    # adaptively with --adaptive_sampling, so the blocks it reads are counted too.
+    def scan():
+        random.seed(args.seed)
+        blocks_read = model.stats.blocks_read
+        found = model.run_with_known_content_sqlite(db_path, target_directory).found
+        return found, model.stats.blocks_read - blocks_read
+
+    timings["scan"], (found, counts["scan_blocks_read"]) = _best_of(args.repeat, scan)
+    counts["found"] = int(found)
+
+    return {"timings": timings, "counts": counts}
+
+
+def compare_to_baseline(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    Print how each stage compares to the baseline, and return the stages that regressed.
+    """
+    if baseline.get("config") != results["config"]:
+        print("WARNING: The baseline was recorded with a different config", file=sys.stderr)
+
+    regressions = []
+    print(f"{'stage':<18} {'baseline':>10} {'current':>10} {'change':>8}", file=sys.stderr)
+    for stage in STAGES:
+        current = results["timings"][stage]
+        previous = baseline["timings"].get(stage)
+        if previous is None:
+            print(f"{stage:<18} {'-':>10} {current:>9.3f}s", file=sys.stderr)
+            continue
+        change = current / previous - 1 if previous > 0 else 0.0
+        regressed = change > tolerance and current - previous > MIN_REGRESSION_SECONDS
+        if regressed:
+            regressions.append(stage)
+        flag = " REGRESSION" if regressed else ""
+        print(f"{stage:<18} {previous:>9.3f}s {current:>9.3f}s {change:>+7.0%}{flag}", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of small block forensics")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus and of the sampling")
+    parser.add_argument("--num_known_files", type=int, default=20)
+    parser.add_argument("--num_target_files", type=int, default=2000)
+    parser.add_argument("--mean_file_size", type=int, default=64 * 1024, help="Mean file size in bytes")
+    parser.add_argument("--size_distribution", choices=SIZE_DISTRIBUTIONS, default="lognormal")
+    parser.add_argument(
+        "--overlap", type=float, default=0.0, help="Fraction of target files copied from known"
+    )
+    parser.add_argument(
+        "--zeroed_fraction", type=float, default=0.0, help="Fraction of other target files filled with zeros"
+    )
+    parser.add_argument(
+        "--num_small_target_files",
+        type=int,
+        default=0,
+        help="Target files added that are smaller than every known file",
+    )
+    parser.add_argument("--block_size", type=int, default=4096)
+    parser.add_argument("--target_probability", type=float, default=0.99)
+    parser.add_argument("--hash_algorithm", choices=HASH_ALGORITHMS, default=DEFAULT_HASH_ALGORITHM)
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--num_io_threads", type=int, default=1)
+    parser.add_argument(
+        "--filter_low_information_blocks",
+        action="store_true",
+        help="Build the DB with the filter of zero-filled and too common blocks",
+    )
+    parser.add_argument(
+        "--adaptive_sampling", action="store_true", help="Sample the target adaptively in the scan stage"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage, the fastest one is kept")
+    parser.add_argument("--corpus_dir", type=Path, help="Where to generate the corpus, reused across runs")
+    parser.add_argument("--output", type=Path, help="Also write the results to this file")
+    parser.add_argument("--baseline", type=Path, help="Compare the results to the ones in this file")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    corpus_config = CorpusConfig(
+        seed=args.seed,
+        num_known_files=args.num_known_files,
+        num_target_files=args.num_target_files,
+        mean_file_size=args.mean_file_size,
+        size_distribution=args.size_distribution,
+        overlap=args.overlap,
+        zeroed_fraction=args.zeroed_fraction,
+        num_small_target_files=args.num_small_target_files,
+    )
+    corpus_dir: Optional[tempfile.TemporaryDirectory] = None
+    if args.corpus_dir is None:
+        corpus_dir = tempfile.TemporaryDirectory(prefix="sbf-bench-")
+        corpus_root = Path(corpus_dir.name)
+    else:
+        corpus_root = args.corpus_dir
+
+    try:
+        # The model reports its progress on stdout, which is kept for the results
+        with redirect_stdout(sys.stderr):
+            generate_corpus(corpus_root, corpus_config)
+            stage_results = run_benchmark(corpus_root, args)
+    finally:
+        if corpus_dir is not None:
+            corpus_dir.cleanup()
+
+    results = {
+        "version": RESULTS_VERSION,
+        "config": {
+            **corpus_config.to_dict(),
+            "block_size": args.block_size,
+            "target_probability": args.target_probability,
+            "hash_algorithm": args.hash_algorithm,
+            "num_workers": args.num_workers,
+            "num_io_threads": args.num_io_threads,
+            "filter_low_information_blocks": args.filter_low_information_blocks,
+            "adaptive_sampling": args.adaptive_sampling,
+        },
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        **stage_results,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+
+    if args.baseline is not None:
+        if not args.baseline.is_file():
+            print(f"WARNING: No baseline at {args.baseline}, nothing to compare to", file=sys.stderr)
+            return
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get("version") != RESULTS_VERSION:
+            print(
+                f"WARNING: {args.baseline} has an unsupported version, nothing to compare to", file=sys.stderr
+            )
+            return
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(
+                f"ERROR: {', '.join(regressions)} regressed by more than {args.tolerance:.0%}",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import json
+import math
+import random
+import shutil
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+SIZE_DISTRIBUTIONS = ["fixed", "uniform", "lognormal"]
+
+# Spread of the lognormal size distribution, a sigma of 1 gives a long tail of files several times the mean
+LOGNORMAL_SIGMA = 1.0
+
+# Files per subdirectory, so that the corpora have a tree to walk like real ones
+FILES_PER_DIRECTORY = 100
+
+
+class CorpusConfig(NamedTuple):
+    seed: int
+    num_known_files: int
+    num_target_files: int
+    mean_file_size: int
+    size_distribution: str
+    overlap: float  # fraction of the target files that are copies of known files
+    zeroed_fraction: float = 0.0  # fraction of the other target files that are filled with zeros
+    num_small_target_files: int = 0  # random target files added, each smaller than every known file
+
+    def to_dict(self) -> Dict:
+        return self._asdict()
+
+
+def _file_sizes(rng: random.Random, config: CorpusConfig, num_files: int) -> List[int]:
+    if config.size_distribution == "fixed":
+        return [config.mean_file_size] * num_files
+    if config.size_distribution == "uniform":
+        return [rng.randint(1, 2 * config.mean_file_size) for _ in range(num_files)]
+    if config.size_distribution == "lognormal":
+        # Mean of a lognormal distribution is exp(mu + sigma^2 / 2)
+        mu = math.log(config.mean_file_size) - LOGNORMAL_SIGMA**2 / 2
+        return [max(1, round(rng.lognormvariate(mu, LOGNORMAL_SIGMA))) for _ in range(num_files)]
+    raise ValueError(
+        f"Unknown size distribution {config.size_distribution}, must be one of {SIZE_DISTRIBUTIONS}"
+    )
+
+
+def _file_path(root: Path, index: int) -> Path:
+    return root / f"d{index // FILES_PER_DIRECTORY:04}" / f"f{index:07}.bin"
+
+
+def _write_file(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def generate_corpus(root: Path, config: CorpusConfig) -> None:
+    """
+    Generate a known content directory and a target directory under root. The same config always generates the
+    same bytes, so results are comparable across runs and machines.
+    A fraction `overlap` of the target files are copies of randomly chosen known files, the others are random
+    data that shares no block with the known content, or zeros for a fraction `zeroed_fraction` of them.
+    `num_small_target_files` more target files of random data are smaller than every known file.
+
+    A corpus already generated under root with the same config is reused.
+    """
+    config_path = root / "corpus.json"
+    if config_path.is_file() and json.loads(config_path.read_text()) == config.to_dict():
+        return
+    if root.exists():
+        shutil.rmtree(root)
+
+    rng = random.Random(config.seed)
+    known_directory, target_directory = root / "known", root / "target"
+
+    known_sizes = _file_sizes(rng, config, config.num_known_files)
+    for i, file_size in enumerate(known_sizes):
+        _write_file(_file_path(known_directory, i), rng.randbytes(file_size))
+
+    num_copies = round(config.overlap * config.num_target_files) if config.num_known_files else 0
+    copied_indices = set(rng.sample(range(config.num_target_files), num_copies))
+    target_sizes = _file_sizes(rng, config, config.num_target_files)
+    zeroed_indices = set()
+    if config.zeroed_fraction > 0:
+        other_indices = [i for i in range(config.num_target_files) if i not in copied_indices]
+        zeroed_indices = set(rng.sample(other_indices, round(config.zeroed_fraction * len(other_indices))))
+    for i, file_size in enumerate(target_sizes):
+        target_path = _file_path(target_directory, i)
+        if i in copied_indices:
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(_file_path(known_directory, rng.randrange(config.num_known_files)), target_path)
+        elif i in zeroed_indices:
+            _write_file(target_path, bytes(file_size))
+        else:
+            _write_file(target_path, rng.randbytes(file_size))
+
+    max_small_file_size = min(known_sizes, default=0) - 1
+    if config.num_small_target_files > 0 and max_small_file_size < 1:
+        raise ValueError("Small target files need known files of at least 2 bytes")
+    for i in range(config.num_target_files, config.num_target_files + config.num_small_target_files):
+        _write_file(_file_path(target_directory, i), rng.randbytes(rng.randint(1, max_small_file_size)))
+
+    config_path.write_text(json.dumps(config.to_dict()))
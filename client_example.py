@@ -14,7 +14,13 @@ inputs = {
 }
 
 # Parameters of the model
-parameters = {"block_size": 4, "target_probability": 0.90}
+parameters = {
+    "block_size": 4,
+    "target_probability": 0.90,
+    "num_io_threads": 1,
+    "num_workers": 1,
+    "hash_algorithm": "md5",
+}
 
 response = client.request(inputs, parameters)  # Send a request to the server
 
@@ -1,16 +1,24 @@
 # Command line interface for small block forensics
 
 import argparse
+from pathlib import Path
 
 from flask_ml.flask_ml_cli import MLCli
 
 from small_blk_forensics.backend.server import server
+from small_blk_forensics.ml.stats import profiled
 
 
 def main():
     parser = argparse.ArgumentParser(description="Analyze target directories with small block forensics")
+    parser.add_argument(
+        "--profile", type=Path, help="Profile the run with cProfile and save the stats to this file"
+    )
+    # The subcommands are only added by the CLI, so the profile flag is read ahead of them
+    args, _ = parser.parse_known_args()
     cli = MLCli(server, parser)
-    cli.run_cli()
+    with profiled(args.profile):
+        cli.run_cli()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+from logging import Logger
+from typing import Callable, List, Optional
+from uuid import uuid4
+
+from flask_ml.flask_ml_server.models import ResponseBody
+
+from small_blk_forensics.ml.progress import ScanCancelled, ScanProgress
+
+logger = Logger(__name__)
+
+# Finished jobs kept around for their results, the oldest ones are forgotten first
+MAX_FINISHED_JOBS = 100
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+FINISHED_JOB_STATUSES = {JobStatus.COMPLETED, JobStatus.FAILED, JobStatus.CANCELLED}
+
+
+class Job:
+    def __init__(self, task: str):
+        self.job_id = str(uuid4())
+        self.task = task
+        self.status = JobStatus.QUEUED
+        self.progress = ScanProgress()
+        self.result: Optional[ResponseBody] = None
+        self.error: Optional[str] = None
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.future: Optional[Future] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "task": self.task,
+            "status": self.status.value,
+            "progress": self.progress.to_dict(),
+            "result": self.result.model_dump(mode="json") if self.result is not None else None,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Runs long scans on a bounded pool of worker threads, so that the HTTP request submitting a scan returns
+    straight away with a job id that can be polled for status and progress, or cancelled.
+    """
+
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sbf-job")
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, task: str, func: Callable[[ScanProgress], ResponseBody]) -> Job:
+        """
+        Queue func to run with the progress of a new job. func must pass the progress on to the model.
+        """
+        job = Job(task)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._forget_finished_jobs()
+        job.future = self._executor.submit(self._run, job, func)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        Cancel a job. A queued job never starts, a running one stops at the next point where the model checks
+        for cancellation.
+        """
+        job = self.get(job_id)
+        if job is None or job.status in FINISHED_JOB_STATUSES:
+            return job
+        job.progress.cancel()
+        if job.future is not None and job.future.cancel():
+            self._finish(job, JobStatus.CANCELLED)
+        return job
+
+    def _run(self, job: Job, func: Callable[[ScanProgress], ResponseBody]) -> None:
+        if job.progress.cancelled:
+            self._finish(job, JobStatus.CANCELLED)
+            return
+        job.status = JobStatus.RUNNING
+        job.started_at = time.time()
+        try:
+            job.result = func(job.progress)
+            self._finish(job, JobStatus.COMPLETED)
+        except ScanCancelled:
+            self._finish(job, JobStatus.CANCELLED)
+        except Exception as e:
+            logger.error(f"Job {job.job_id} failed")
+            logger.error(traceback.format_exc())
+            job.error = repr(e)
+            self._finish(job, JobStatus.FAILED)
+
+    def _finish(self, job: Job, status: JobStatus) -> None:
+        job.finished_at = time.time()
+        job.status = status
+
+    def _forget_finished_jobs(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED_JOB_STATUSES]
+        for job_id in finished[: max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self._jobs[job_id]
@@ -0,0 +1,90 @@
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+from small_blk_forensics.ml.progress import ScanCancelled
+from small_blk_forensics.ml.stats import ScanStats
+
+# Content type of the Prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ScanStats counters exported as totals over all runs, with their help text
+_COUNTERS = [
+    ("files_visited", "Files listed in known content directories and targets"),
+    ("blocks_read", "Blocks read and hashed from known content and targets"),
+    ("bytes_read", "Bytes read from known content and targets"),
+    ("hash_seconds", "Time spent hashing blocks, summed over threads and processes"),
+    ("db_queries", "Queries of known content DBs for sampled target hashes"),
+    ("db_query_seconds", "Time spent querying known content DBs"),
+    ("blocks_filtered", "Low-information blocks skipped before hashing or lookup"),
+]
+
+Sample = Tuple[Dict[str, str], float]
+
+
+def format_metric(name: str, metric_type: str, help_text: str, samples: List[Sample]) -> List[str]:
+    """
+    The lines of a metric in the Prometheus text format, one per (labels, value) sample.
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        label_str = ",".join(f'{key}="{label}"' for key, label in labels.items())
+        lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+    return lines
+
+
+class ServerMetrics:
+    """
+    Totals of the stats of every model run served, by the synchronous routes and by background jobs alike.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs: Dict[str, int] = {}  # by outcome
+        self._totals: Dict[str, float] = {counter: 0 for counter, _ in _COUNTERS}
+        self._stage_seconds: Dict[str, float] = {}
+
+    @contextmanager
+    def recording(self, stats: ScanStats) -> Iterator[None]:
+        """
+        Add the stats of the model run in the block to the totals once it is done, whether it completes,
+        fails or is cancelled.
+        """
+        outcome = "failed"
+        try:
+            yield
+            outcome = "completed"
+        except ScanCancelled:
+            outcome = "cancelled"
+            raise
+        finally:
+            self.record(stats, outcome)
+
+    def record(self, stats: ScanStats, outcome: str) -> None:
+        run_stats = stats.to_dict()
+        with self._lock:
+            self._runs[outcome] = self._runs.get(outcome, 0) + 1
+            for counter, _ in _COUNTERS:
+                self._totals[counter] += run_stats[counter]
+            for stage, seconds in run_stats["stage_seconds"].items():
+                self._stage_seconds[stage] = self._stage_seconds.get(stage, 0.0) + seconds
+
+    def to_prometheus(self) -> List[str]:
+        with self._lock:
+            lines = format_metric(
+                "sbf_runs_total",
+                "counter",
+                "Model runs by outcome",
+                [({"outcome": outcome}, count) for outcome, count in sorted(self._runs.items())],
+            )
+            for counter, help_text in _COUNTERS:
+                lines += format_metric(
+                    f"sbf_{counter}_total", "counter", help_text, [({}, self._totals[counter])]
+                )
+            lines += format_metric(
+                "sbf_stage_seconds_total",
+                "counter",
+                "Wall time spent in each stage of the model runs",
+                [({"stage": stage}, seconds) for stage, seconds in sorted(self._stage_seconds.items())],
+            )
+        return lines
@@ -2,11 +2,15 @@ import os
 from logging import Logger
 from pathlib import Path
 from textwrap import dedent
-from typing import Optional, TypedDict
+from typing import Callable, Dict, Optional, Tuple, TypedDict
 
+from flask import Response, jsonify, request
 from flask_ml.flask_ml_server import MLServer, load_file_as_string
+from flask_ml.flask_ml_server.errors import BadRequestError
 from flask_ml.flask_ml_server.models import (
     DirectoryInput,
+    EnumParameterDescriptor,
+    EnumVal,
     FileInput,
     FloatRangeDescriptor,
     InputSchema,
@@ -20,14 +24,40 @@ from flask_ml.flask_ml_server.models import (
     TaskSchema,
     NewFileInputType,
 )
+from flask_ml.flask_ml_server.utils import schema_get_inputs, schema_get_parameters
+from pydantic import ValidationError
+
+from small_blk_forensics.utils.common import is_dir_path, is_image_path
+from small_blk_forensics.utils.data import (
+    MyModelResponse,
+    Parameters,
+    ParametersExhaustive,
+    ParametersKnownContentDirectory,
+    ParametersKnownContentSql,
+)
 
-from small_blk_forensics.utils.common import is_dir_path
-from small_blk_forensics.utils.data import MyModelResponse, Parameters
-
+from ..ml.cache import KnownContentCache
+from ..ml.filtering import DEFAULT_COMMON_BLOCK_THRESHOLD, MAX_ENTROPY, BlockFilter
+from ..ml.hashing import DEFAULT_HASH_ALGORITHM, available_hash_algorithms
 from ..ml.model import SmallBlockForensicsModel
+from ..ml.progress import ScanProgress
+from ..ml.shards import MAX_SHARDS
+from .jobs import JobManager, JobStatus
+from .metrics import PROMETHEUS_CONTENT_TYPE, ServerMetrics, format_metric
 
 server = MLServer(__name__)
 logger = Logger(__name__)
+server_metrics = ServerMetrics()
+job_manager = JobManager(max_workers=int(os.environ.get("SBF_MAX_CONCURRENT_JOBS") or 2))
+known_content_cache = KnownContentCache(
+    memory_limit=int(os.environ.get("SBF_KNOWN_CONTENT_CACHE_MB") or 1024) * 1024 * 1024
+)
+# Listings of target directories are cached here when set, so rescanning an unmodified tree skips walking it
+block_map_cache_dir = (
+    Path(os.environ["SBF_BLOCK_MAP_CACHE_DIR"]) if os.environ.get("SBF_BLOCK_MAP_CACHE_DIR") else None
+)
+# Sampling scans save their progress here when set, so an interrupted scan is resumed when it is run again
+checkpoint_dir = Path(os.environ["SBF_CHECKPOINT_DIR"]) if os.environ.get("SBF_CHECKPOINT_DIR") else None
 
 server.add_app_metadata(
     name="Small Block Forensics",
@@ -43,13 +73,23 @@ def _execute_throws(
     known_content_directory: Optional[str] = None,
     input_sql: Optional[str] = None,
     output_sql: Optional[str] = None,
+    num_workers: int = 1,
+    index_memory_limit: int = 0,
+    progress: Optional[ScanProgress] = None,
+    target_image: Optional[str] = None,
+    hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+    adaptive_sampling: bool = False,
 ) -> ResponseBody:
 
-    if target_directory is None or not is_dir_path(target_directory):
+    if target_image is not None:
+        if not is_image_path(target_image):
+            raise Exception(f"{target_image} is not a raw image file or block device")
+        target_path = Path(target_image)
+    elif target_directory is None or not is_dir_path(target_directory):
         raise Exception(f"{target_directory} is not provided or is not a valid path")
-
-    target_directory_path = Path(target_directory)
-    del target_directory
+    else:
+        target_path = Path(target_directory)
+    del target_directory, target_image
 
     if not (known_content_directory or input_sql):
         raise Exception("Either known_content_directory or input_sql must be specified")
@@ -57,7 +97,18 @@ def _execute_throws(
     if known_content_directory and input_sql:
         raise Exception("Both known_content_directory and input_sql cannot be specified")
 
-    model = SmallBlockForensicsModel(parameters["block_size"], parameters["target_probability"])
+    model = SmallBlockForensicsModel(
+        parameters["block_size"],
+        parameters["target_probability"],
+        num_workers,
+        index_memory_limit,
+        parameters["num_io_threads"],
+        progress=progress,
+        hash_algorithm=hash_algorithm,
+        block_map_cache_dir=block_map_cache_dir,
+        checkpoint_dir=checkpoint_dir,
+        adaptive_sampling=adaptive_sampling,
+    )
 
     if known_content_directory:
         if not is_dir_path(known_content_directory):
@@ -71,18 +122,22 @@ def _execute_throws(
         output_sql_path = Path(output_sql)
         del output_sql
 
-        logger.info(f"{known_content_directory_path}, {target_directory_path}, {output_sql_path}")
+        logger.info(f"{known_content_directory_path}, {target_path}, {output_sql_path}")
 
-        results: MyModelResponse = model.run_with_known_content_directory(
-            known_content_directory_path, target_directory_path, output_sql_path
-        )
+        with server_metrics.recording(model.stats):
+            results: MyModelResponse = model.run_with_known_content_directory(
+                known_content_directory_path, target_path, output_sql_path
+            )
     else:
         if input_sql is None:
             raise Exception(f"{input_sql} is not a valid path")
         input_sql_path = Path(input_sql)
         del input_sql
 
-        results = model.run_with_known_content_sqlite(input_sql_path, target_directory_path)
+        with server_metrics.recording(model.stats):
+            results = model.run_with_known_content_sqlite(
+                input_sql_path, target_path, known_content_cache
+            )
 
     return ResponseBody(
         root=MarkdownResponse(
@@ -112,6 +167,38 @@ def _execute_throws(
     )
 
 
+def _num_workers_parameter_schema():
+    return ParameterSchema(
+        key="num_workers",
+        label="Number of Workers",
+        subtitle="The number of processes used to hash the known content directory. Defaults to 1.",
+        value=RangedIntParameterDescriptor(
+            range=IntRangeDescriptor(min=1, max=os.cpu_count() or 1), default=1
+        ),
+    )
+
+
+def _num_io_threads_parameter_schema():
+    return ParameterSchema(
+        key="num_io_threads",
+        label="Number of I/O Threads",
+        subtitle="The number of threads walking the target directory, and reading and hashing its sampled blocks. Defaults to 1.",
+        value=RangedIntParameterDescriptor(range=IntRangeDescriptor(min=1, max=256), default=1),
+    )
+
+
+def _hash_algorithm_parameter_schema():
+    return ParameterSchema(
+        key="hash_algorithm",
+        label="Hash Algorithm",
+        subtitle="The algorithm used to hash blocks. Scans of an existing DB always use the algorithm it was generated with. Defaults to md5.",
+        value=EnumParameterDescriptor(
+            enum_vals=[EnumVal(key=algorithm, label=algorithm) for algorithm in available_hash_algorithms()],
+            default=DEFAULT_HASH_ALGORITHM,
+        ),
+    )
+
+
 def task_schema_func_known_directory():
     return TaskSchema(
         inputs=[
@@ -158,6 +245,9 @@ def task_schema_func_known_directory():
                     default=0.95,
                 ),
             ),
+            _num_io_threads_parameter_schema(),
+            _num_workers_parameter_schema(),
+            _hash_algorithm_parameter_schema(),
         ],
     )
 
@@ -168,21 +258,32 @@ class InputsKnownContentDirectory(TypedDict):
     output_sql_path: FileInput
 
 
+def _gen_hash_random(
+    inputs: InputsKnownContentDirectory,
+    parameters: ParametersKnownContentDirectory,
+    progress: Optional[ScanProgress] = None,
+) -> ResponseBody:
+    return _execute_throws(
+        parameters,
+        inputs["target_directory"].path,
+        inputs["known_content_directory"].path,
+        None,
+        inputs["output_sql_path"].path,
+        parameters["num_workers"],
+        progress=progress,
+        hash_algorithm=parameters["hash_algorithm"],
+    )
+
+
 @server.route(
     "/gen_hash_random",
     task_schema_func=task_schema_func_known_directory,
     short_title="Hash random blocks of a target directory",
     order=0,
 )
-def execute(inputs: InputsKnownContentDirectory, parameters: Parameters):
+def execute(inputs: InputsKnownContentDirectory, parameters: ParametersKnownContentDirectory):
     try:
-        return _execute_throws(
-            parameters,
-            inputs["target_directory"].path,
-            inputs["known_content_directory"].path,
-            None,
-            inputs["output_sql_path"].path,
-        )
+        return _gen_hash_random(inputs, parameters)
     except Exception as e:
         logger.error("An error occurred while executing the model")
         logger.error(e)
@@ -224,6 +325,22 @@ def task_schema_func_known_sql():
                     default=0.95,
                 ),
             ),
+            _num_io_threads_parameter_schema(),
+            ParameterSchema(
+                key="index_memory_limit_mb",
+                label="Index Memory Limit (MB)",
+                subtitle="Memory budget for an in-memory index of the known hashes. Defaults to 0, which disables it.",
+                value=RangedIntParameterDescriptor(range=IntRangeDescriptor(min=0, max=1 << 20), default=0),
+            ),
+            ParameterSchema(
+                key="adaptive_sampling",
+                label="Adaptive Sampling",
+                subtitle="Skip target files smaller than the smallest known file, and sample in rounds that stop once the target probability is met given the blocks filtered so far. Assumes known files are present whole in the target. Defaults to No.",
+                value=EnumParameterDescriptor(
+                    enum_vals=[EnumVal(key="no", label="No"), EnumVal(key="yes", label="Yes")],
+                    default="no",
+                ),
+            ),
         ],
     )
 
@@ -233,17 +350,32 @@ class InputsKnownContentSql(TypedDict):
     input_sql: FileInput
 
 
+def _hash_random(
+    inputs: InputsKnownContentSql,
+    parameters: ParametersKnownContentSql,
+    progress: Optional[ScanProgress] = None,
+) -> ResponseBody:
+    return _execute_throws(
+        parameters,
+        inputs["target_directory"].path,
+        None,
+        inputs["input_sql"].path,
+        None,
+        index_memory_limit=parameters["index_memory_limit_mb"] * 1024 * 1024,
+        progress=progress,
+        adaptive_sampling=parameters["adaptive_sampling"] == "yes",
+    )
+
+
 @server.route(
     "/hash_random",
     task_schema_func=task_schema_func_known_sql,
     order=1,
     short_title="Hash random blocks of a target directory with seed DB",
 )
-def execute_sql(inputs: InputsKnownContentSql, parameters: Parameters):
+def execute_sql(inputs: InputsKnownContentSql, parameters: ParametersKnownContentSql):
     try:
-        return _execute_throws(
-            parameters, inputs["target_directory"].path, None, inputs["input_sql"].path, None
-        )
+        return _hash_random(inputs, parameters)
     except Exception as e:
         logger.error("An error occurred while executing the model")
         logger.error(e)
@@ -275,6 +407,43 @@ def task_schema_func_gen_hash():
                     range=IntRangeDescriptor(min=1, max=8192), default=4096
                 ),
             ),
+            _num_workers_parameter_schema(),
+            ParameterSchema(
+                key="incremental",
+                label="Incremental",
+                subtitle="Only rehash files that were added or changed since the DB was last generated, and remove the hashes of deleted files. Defaults to No.",
+                value=EnumParameterDescriptor(
+                    enum_vals=[EnumVal(key="no", label="No"), EnumVal(key="yes", label="Yes")],
+                    default="no",
+                ),
+            ),
+            _hash_algorithm_parameter_schema(),
+            ParameterSchema(
+                key="num_shards",
+                label="Number of Shards",
+                subtitle="The number of shard DBs the hashes of a new DB are split into, each written by its own process. An existing DB keeps its shards. Defaults to 1.",
+                value=RangedIntParameterDescriptor(
+                    range=IntRangeDescriptor(min=1, max=MAX_SHARDS), default=1
+                ),
+            ),
+            ParameterSchema(
+                key="filter_low_information_blocks",
+                label="Filter Low-Information Blocks",
+                subtitle=f"Skip blocks that repeat a single byte, and known hashes shared by {DEFAULT_COMMON_BLOCK_THRESHOLD} blocks or more, on both sides of a scan. Defaults to No.",
+                value=EnumParameterDescriptor(
+                    enum_vals=[EnumVal(key="no", label="No"), EnumVal(key="yes", label="Yes")],
+                    default="no",
+                ),
+            ),
+            ParameterSchema(
+                key="min_entropy",
+                label="Minimum Entropy",
+                subtitle="Also skip blocks with less entropy than this, in bits per byte. Defaults to 0, which disables it.",
+                value=RangedFloatParameterDescriptor(
+                    range=FloatRangeDescriptor(min=0, max=MAX_ENTROPY),
+                    default=0,
+                ),
+            ),
         ],
     )
 
@@ -286,6 +455,12 @@ class InputsGenerateSqlDb(TypedDict):
 
 class ParametersGenerateSqlDb(TypedDict):
     block_size: int
+    num_workers: int
+    incremental: str
+    hash_algorithm: str
+    num_shards: int
+    filter_low_information_blocks: str
+    min_entropy: float
 
 
 @server.route(
@@ -295,10 +470,37 @@ class ParametersGenerateSqlDb(TypedDict):
     order=2,
 )
 def execute_gen_hash(inputs: InputsGenerateSqlDb, parameters: ParametersGenerateSqlDb):
-    model = SmallBlockForensicsModel(parameters["block_size"])
-    model.hash_directory(
-        Path(inputs["known_content_directory"].path), Path(inputs["output_sql_path"].path)
+    return _gen_hash(inputs, parameters)
+
+
+def _block_filter(parameters: ParametersGenerateSqlDb) -> BlockFilter:
+    filter_blocks = parameters["filter_low_information_blocks"] == "yes"
+    return BlockFilter(
+        skip_constant=filter_blocks,
+        min_entropy=parameters["min_entropy"],
+        common_block_threshold=DEFAULT_COMMON_BLOCK_THRESHOLD if filter_blocks else 0,
     )
+
+
+def _gen_hash(
+    inputs: InputsGenerateSqlDb,
+    parameters: ParametersGenerateSqlDb,
+    progress: Optional[ScanProgress] = None,
+) -> ResponseBody:
+    model = SmallBlockForensicsModel(
+        parameters["block_size"],
+        num_workers=parameters["num_workers"],
+        progress=progress,
+        hash_algorithm=parameters["hash_algorithm"],
+        num_shards=parameters["num_shards"],
+        block_filter=_block_filter(parameters),
+    )
+    with server_metrics.recording(model.stats):
+        model.hash_directory(
+            Path(inputs["known_content_directory"].path),
+            Path(inputs["output_sql_path"].path),
+            incremental=parameters["incremental"] == "yes",
+        )
     return ResponseBody(
         root=MarkdownResponse(
             title="Small Block Forensics",
@@ -313,5 +515,299 @@ def execute_gen_hash(inputs: InputsGenerateSqlDb, parameters: ParametersGenerate
     )
 
 
+def _target_image_input_schema():
+    return InputSchema(
+        key="target_image",
+        label="Target Image",
+        subtitle="A raw disk image file or a block device (e.g. /dev/sdb) to analyze, including its unallocated space",
+        input_type=InputType.FILE,
+    )
+
+
+def task_schema_func_known_directory_image():
+    task_schema = task_schema_func_known_directory()
+    task_schema.inputs[0] = _target_image_input_schema()
+    return task_schema
+
+
+class InputsKnownContentDirectoryImage(TypedDict):
+    target_image: FileInput
+    known_content_directory: DirectoryInput
+    output_sql_path: FileInput
+
+
+def _gen_hash_random_image(
+    inputs: InputsKnownContentDirectoryImage,
+    parameters: ParametersKnownContentDirectory,
+    progress: Optional[ScanProgress] = None,
+) -> ResponseBody:
+    return _execute_throws(
+        parameters,
+        None,
+        inputs["known_content_directory"].path,
+        None,
+        inputs["output_sql_path"].path,
+        parameters["num_workers"],
+        progress=progress,
+        target_image=inputs["target_image"].path,
+        hash_algorithm=parameters["hash_algorithm"],
+    )
+
+
+@server.route(
+    "/gen_hash_random_image",
+    task_schema_func=task_schema_func_known_directory_image,
+    short_title="Hash random blocks of a raw disk image or block device",
+    order=3,
+)
+def execute_image(inputs: InputsKnownContentDirectoryImage, parameters: ParametersKnownContentDirectory):
+    try:
+        return _gen_hash_random_image(inputs, parameters)
+    except Exception as e:
+        logger.error("An error occurred while executing the model")
+        logger.error(e)
+        raise
+
+
+def task_schema_func_known_sql_image():
+    task_schema = task_schema_func_known_sql()
+    task_schema.inputs[0] = _target_image_input_schema()
+    return task_schema
+
+
+class InputsKnownContentSqlImage(TypedDict):
+    target_image: FileInput
+    input_sql: FileInput
+
+
+def _hash_random_image(
+    inputs: InputsKnownContentSqlImage,
+    parameters: ParametersKnownContentSql,
+    progress: Optional[ScanProgress] = None,
+) -> ResponseBody:
+    return _execute_throws(
+        parameters,
+        None,
+        None,
+        inputs["input_sql"].path,
+        None,
+        index_memory_limit=parameters["index_memory_limit_mb"] * 1024 * 1024,
+        progress=progress,
+        target_image=inputs["target_image"].path,
+        adaptive_sampling=parameters["adaptive_sampling"] == "yes",
+    )
+
+
+@server.route(
+    "/hash_random_image",
+    task_schema_func=task_schema_func_known_sql_image,
+    order=4,
+    short_title="Hash random blocks of a raw disk image or block device with seed DB",
+)
+def execute_sql_image(inputs: InputsKnownContentSqlImage, parameters: ParametersKnownContentSql):
+    try:
+        return _hash_random_image(inputs, parameters)
+    except Exception as e:
+        logger.error("An error occurred while executing the model")
+        logger.error(e)
+        raise
+
+
+def task_schema_func_exhaustive():
+    return TaskSchema(
+        inputs=[
+            InputSchema(
+                key="target_directory",
+                label="Target Directory",
+                subtitle="The directory containing files/folders of the content to analyze",
+                input_type=InputType.DIRECTORY,
+            ),
+            InputSchema(
+                key="input_sql",
+                label="Input SQL",
+                subtitle="The path to the existing SQLite DB containing hashes of known content",
+                input_type=InputType.FILE,
+            ),
+            InputSchema(
+                key="output_results_path",
+                label="Output Results Path",
+                subtitle="The path to save the matches of each target file to, as JSON lines",
+                input_type=NewFileInputType(
+                    allowed_extensions=[".jsonl"],
+                    default_extension=".jsonl",
+                ),
+            ),
+        ],
+        parameters=[
+            ParameterSchema(
+                key="block_size",
+                label="Block Size",
+                value=RangedIntParameterDescriptor(
+                    range=IntRangeDescriptor(min=1, max=8192), default=4096
+                ),
+            ),
+            _num_io_threads_parameter_schema(),
+            ParameterSchema(
+                key="index_memory_limit_mb",
+                label="Index Memory Limit (MB)",
+                subtitle="Memory budget for an in-memory index of the known hashes. Defaults to 0, which disables it.",
+                value=RangedIntParameterDescriptor(range=IntRangeDescriptor(min=0, max=1 << 20), default=0),
+            ),
+        ],
+    )
+
+
+class InputsExhaustive(TypedDict):
+    target_directory: DirectoryInput
+    input_sql: FileInput
+    output_results_path: FileInput
+
+
+def _hash_all(
+    inputs: InputsExhaustive,
+    parameters: ParametersExhaustive,
+    progress: Optional[ScanProgress] = None,
+) -> ResponseBody:
+    target_directory = inputs["target_directory"].path
+    if not is_dir_path(target_directory):
+        raise Exception(f"{target_directory} is not a valid path")
+
+    model = SmallBlockForensicsModel(
+        parameters["block_size"],
+        index_memory_limit=parameters["index_memory_limit_mb"] * 1024 * 1024,
+        num_io_threads=parameters["num_io_threads"],
+        progress=progress,
+        block_map_cache_dir=block_map_cache_dir,
+    )
+    with server_metrics.recording(model.stats):
+        results = model.run_exhaustive_with_known_content_sqlite(
+            Path(inputs["input_sql"].path),
+            Path(target_directory),
+            Path(inputs["output_results_path"].path),
+            known_content_cache,
+        )
+    return ResponseBody(
+        root=MarkdownResponse(
+            title="Small Block Forensics",
+            value=dedent(
+                f"""
+        ## Results
+        
+        - Files Scanned: {results.files_scanned}
+        - Files With Matches: {results.files_matched}
+        - Blocks Matched: {results.blocks_matched} of {results.blocks_scanned}
+        - Matches saved at {results.results_path}
+    """
+            ),
+        )
+    )
+
+
+@server.route(
+    "/hash_all",
+    task_schema_func=task_schema_func_exhaustive,
+    order=5,
+    short_title="Find all blocks of a target directory matching a seed DB",
+)
+def execute_exhaustive(inputs: InputsExhaustive, parameters: ParametersExhaustive):
+    try:
+        return _hash_all(inputs, parameters)
+    except Exception as e:
+        logger.error("An error occurred while executing the model")
+        logger.error(e)
+        raise
+
+
+# Tasks that can be run as background jobs, by the name of their synchronous route
+JOB_TASKS: Dict[str, Tuple[Callable[[], TaskSchema], Callable[..., ResponseBody]]] = {
+    "gen_hash_random": (task_schema_func_known_directory, _gen_hash_random),
+    "hash_random": (task_schema_func_known_sql, _hash_random),
+    "gen_hash": (task_schema_func_gen_hash, _gen_hash),
+    "gen_hash_random_image": (task_schema_func_known_directory_image, _gen_hash_random_image),
+    "hash_random_image": (task_schema_func_known_sql_image, _hash_random_image),
+    "hash_all": (task_schema_func_exhaustive, _hash_all),
+}
+
+
+def _job_error(error, status_code: int):
+    return jsonify({"error": error, "status": "VALIDATION_ERROR"}), status_code
+
+
+@server.app.route("/jobs", methods=["POST"])
+def submit_job():
+    """
+    Start a task in the background. The body is the one of the task's synchronous route, with an extra "task" key
+    naming the route. Responds straight away with the job, to be polled at /jobs/<job_id>.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not {"task", "inputs", "parameters"} <= data.keys():
+        return _job_error("Request body must contain the keys 'task', 'inputs' and 'parameters'", 400)
+    if data["task"] not in JOB_TASKS:
+        return _job_error(f"Unknown task {data['task']}, must be one of {list(JOB_TASKS)}", 400)
+
+    task_schema_func, run_task = JOB_TASKS[data["task"]]
+    task_schema = task_schema_func()
+    try:
+        inputs = schema_get_inputs(task_schema, data["inputs"])
+        parameters = schema_get_parameters(task_schema, data["parameters"])
+    except ValidationError as e:
+        return _job_error(e.errors(), 400)
+    except BadRequestError as e:
+        return _job_error(str(e), 400)
+
+    job = job_manager.submit(data["task"], lambda progress: run_task(inputs, parameters, progress))
+    return jsonify(job.to_dict()), 202
+
+
+@server.app.route("/jobs", methods=["GET"])
+def list_jobs():
+    return jsonify([job.to_dict() for job in job_manager.list()])
+
+
+@server.app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": f"No job with id {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+
+@server.app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id: str):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({"error": f"No job with id {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+
+@server.app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Totals of the counters and stage timings of all model runs, along with the state of the known content
+    cache and of the jobs, in the Prometheus text format.
+    """
+    jobs = job_manager.list()
+    lines = server_metrics.to_prometheus()
+    lines += format_metric(
+        "sbf_jobs",
+        "gauge",
+        "Background jobs by status",
+        [({"status": status.value}, sum(job.status == status for job in jobs)) for status in JobStatus],
+    )
+    lines += format_metric(
+        "sbf_known_content_cache_entries",
+        "gauge",
+        "Known content DBs cached",
+        [({}, len(known_content_cache))],
+    )
+    lines += format_metric(
+        "sbf_known_content_cache_bytes",
+        "gauge",
+        "Memory charged to the cached known content DBs",
+        [({}, known_content_cache.nbytes)],
+    )
+    return Response("\n".join(lines) + "\n", content_type=PROMETHEUS_CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     server.run(port=os.environ.get("FLASK_RUN_PORT") or 5000)
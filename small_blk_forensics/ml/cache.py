@@ -0,0 +1,165 @@
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from small_blk_forensics.ml.index import db_signature
+from small_blk_forensics.ml.schema import read_num_shards
+
+# Open connections kept per cached DB, for concurrent requests against the same DB
+MAX_IDLE_CONNECTIONS_PER_DB = 4
+
+# Memory charged per idle connection, the size of SQLite's default page cache
+CONNECTION_NBYTES = 2 * 1024 * 1024
+
+# State derived from a known content DB when it is opened, see SmallBlockForensicsModel._load_known_content
+KnownContent = namedtuple(
+    "KnownContent",
+    [
+        "schema_version",
+        "hash_algorithm",
+        "num_shards",
+        "block_filter",
+        "num_hashed_blocks",
+        "common_hashes",
+        "known_index",
+    ],
+)
+
+
+class _CacheEntry:
+    def __init__(self, signature: bytes, known_content: KnownContent):
+        self.signature = signature  # db_signature of the DB and its shards when it was loaded
+        self.known_content = known_content
+        self.idle_connections: List[sqlite3.Connection] = []
+        self.evicted = False
+
+    @property
+    def nbytes(self) -> int:
+        index = self.known_content.known_index
+        index_nbytes = index.nbytes if index is not None else 0
+        common_hashes = self.known_content.common_hashes
+        common_nbytes = sys.getsizeof(common_hashes) + sum(sys.getsizeof(h) for h in common_hashes)
+        return index_nbytes + common_nbytes + MAX_IDLE_CONNECTIONS_PER_DB * CONNECTION_NBYTES
+
+
+class KnownContentCache:
+    """
+    Process-wide cache of opened known content DBs and the state derived from them, so that a server running
+    the same DBs against many targets only counts the hashes and builds the in-memory index once per DB.
+
+    Entries are keyed by the path of the DB and the index memory limit it was loaded with, and are reloaded
+    when the mtime or size of the DB file, of its shards or of their WAL files changes, so that commits still
+    in the WAL are seen too. The least recently used entries are evicted once the memory used by the cached
+    indexes goes over `memory_limit` bytes.
+    A connection is only used by one request at a time: concurrent requests against the same DB each check
+    out their own connection.
+    """
+
+    def __init__(self, memory_limit: int):
+        self.memory_limit = memory_limit
+        self._entries: "OrderedDict[Tuple[str, int], _CacheEntry]" = OrderedDict()
+        self._load_locks: Dict[Tuple[str, int], threading.Lock] = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def open(
+        self,
+        db_path: Path,
+        index_memory_limit: int,
+        load: Callable[[sqlite3.Connection], KnownContent],
+    ) -> Iterator[Tuple[KnownContent, sqlite3.Connection]]:
+        """
+        Yields the known content of a DB and a read-only connection to it, calling `load` on a new connection
+        if the DB is not cached yet.
+        """
+        key = (str(db_path.resolve()), index_memory_limit)
+        entry, db_conn = self._checkout(key, db_path, load)
+        try:
+            yield entry.known_content, db_conn
+        finally:
+            self._checkin(entry, db_conn)
+
+    def _checkout(
+        self,
+        key: Tuple[str, int],
+        db_path: Path,
+        load: Callable[[sqlite3.Connection], KnownContent],
+    ) -> Tuple[_CacheEntry, sqlite3.Connection]:
+        db_conn: Optional[sqlite3.Connection] = None
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Only one request loads a given DB, the others wait for it and then hit the cache
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+            signature = db_signature(db_path, entry.known_content.num_shards) if entry is not None else None
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry.signature != signature:
+                    self._evict(key)
+                    entry = None
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    db_conn = entry.idle_connections.pop() if entry.idle_connections else None
+            if entry is not None:
+                print(f"INFO: Using the cached known content of {db_path}")
+                return entry, db_conn or self._connect(db_path)
+
+            db_conn = self._connect(db_path)
+            try:
+                # Taken before loading, so that a commit made while loading reloads the DB on the next request
+                signature = db_signature(db_path, read_num_shards(db_conn))
+                entry = _CacheEntry(signature, load(db_conn))
+            except BaseException:
+                db_conn.close()
+                raise
+            with self._lock:
+                if entry.nbytes > self.memory_limit:
+                    # Too large to ever be cached, the connection is closed once the request is done
+                    entry.evicted = True
+                else:
+                    self._entries[key] = entry
+                    self._nbytes += entry.nbytes
+                    while self._nbytes > self.memory_limit:
+                        self._evict(next(iter(self._entries)))
+            return entry, db_conn
+
+    def _checkin(self, entry: _CacheEntry, db_conn: sqlite3.Connection) -> None:
+        with self._lock:
+            if not entry.evicted and len(entry.idle_connections) < MAX_IDLE_CONNECTIONS_PER_DB:
+                entry.idle_connections.append(db_conn)
+                return
+        db_conn.close()
+
+    def _evict(self, key: Tuple[str, int]) -> None:
+        """
+        Must be called with the lock held. Connections still checked out are closed when they are returned.
+        """
+        entry = self._entries.pop(key)
+        entry.evicted = True
+        self._nbytes -= entry.nbytes
+        for db_conn in entry.idle_connections:
+            db_conn.close()
+        entry.idle_connections.clear()
+
+    def _connect(self, db_path: Path) -> sqlite3.Connection:
+        # Connections are shared across the threads serving requests, but never used by two of them at once
+        return sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._entries):
+                self._evict(key)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import sqlite3
+import time
+from array import array
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+# Version of the layout of scan checkpoint files, a checkpoint file with another version is ignored
+SCAN_CHECKPOINT_VERSION = 1
+
+# Seconds between two saves of the progress of a build or a scan
+CHECKPOINT_INTERVAL = 30.0
+
+
+class ScanPlan(NamedTuple):
+    """
+    The blocks a sampling scan reads and how far it got. Only the blocks after the cursor are left to read.
+    """
+
+    sampled: array  # sorted global indices of every block sampled so far, including by earlier rounds
+    # (file_path, block_nums) of the current round, in read order
+    random_blocks_info: List[Tuple[Path, array]]
+    cursor: int  # blocks of the current round that were read and resolved without a match
+    blocks_filtered: int  # blocks of the current round before the cursor that were filtered
+    earlier_blocks_filtered: int  # blocks of the earlier rounds that were filtered
+
+
+class ScanCheckpoint:
+    """
+    The plan of a sampling scan of a target against a known content DB, saved in a checkpoint directory along
+    with a cursor that is moved forward at most every CHECKPOINT_INTERVAL seconds, so that a scan that is
+    interrupted can be resumed rather than started over.
+
+    A checkpoint is only used by a scan of the same target and DB with the same signature, which covers the
+    block size and the number of blocks of the target and of the known content. The plan is written to a file
+    next to the checkpoint and renamed over it, so a crash never leaves a partial plan behind.
+    """
+
+    def __init__(self, checkpoint_dir: Path, target: Path, known_content_sqlite: Path, signature: str):
+        key = f"{target.resolve()}\n{known_content_sqlite.resolve()}"
+        self.path = checkpoint_dir / f"{hashlib.sha1(key.encode()).hexdigest()}.sqlite"
+        self.signature = signature
+        self._last_save = time.monotonic()
+
+    def load(self) -> Optional[ScanPlan]:
+        """
+        The plan saved by an interrupted scan, or None if there is none or it was saved for another signature.
+        """
+        if not self.path.is_file():
+            return None
+        db_conn = sqlite3.connect(self.path)
+        try:
+            c = db_conn.cursor()
+            c.execute("SELECT key, value FROM meta")
+            meta = dict(c.fetchall())
+            if meta.get("version") != str(SCAN_CHECKPOINT_VERSION) or meta.get("signature") != self.signature:
+                return None
+            c.execute("SELECT indices FROM sampled")
+            sampled = array("Q")
+            sampled.frombytes(c.fetchone()[0])
+            random_blocks_info = []
+            c.execute("SELECT file_path, block_nums FROM plan ORDER BY rowid")
+            for file_path, block_nums_blob in c:
+                block_nums = array("Q")
+                block_nums.frombytes(block_nums_blob)
+                random_blocks_info.append((Path(file_path), block_nums))
+            return ScanPlan(
+                sampled,
+                random_blocks_info,
+                int(meta["cursor"]),
+                int(meta["blocks_filtered"]),
+                int(meta.get("earlier_blocks_filtered", 0)),
+            )
+        except sqlite3.DatabaseError:
+            return None  # Not a checkpoint file written by this version
+        finally:
+            db_conn.close()
+
+    def save_plan(
+        self, sampled: array, random_blocks_info: List[Tuple[Path, array]], earlier_blocks_filtered: int = 0
+    ) -> None:
+        """
+        Save the plan of a new round of the scan, with its cursor at the start.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        db_conn = sqlite3.connect(tmp_path)
+        try:
+            c = db_conn.cursor()
+            c.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            c.execute("CREATE TABLE sampled (indices BLOB NOT NULL)")
+            c.execute("CREATE TABLE plan (file_path TEXT NOT NULL, block_nums BLOB NOT NULL)")
+            c.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?)",
+                [
+                    ("version", str(SCAN_CHECKPOINT_VERSION)),
+                    ("signature", self.signature),
+                    ("cursor", "0"),
+                    ("blocks_filtered", "0"),
+                    ("earlier_blocks_filtered", str(earlier_blocks_filtered)),
+                ],
+            )
+            c.execute("INSERT INTO sampled (indices) VALUES (?)", (sampled.tobytes(),))
+            c.executemany(
+                "INSERT INTO plan (file_path, block_nums) VALUES (?, ?)",
+                ((str(file_path), block_nums.tobytes()) for file_path, block_nums in random_blocks_info),
+            )
+            db_conn.commit()
+        finally:
+            db_conn.close()
+        os.replace(tmp_path, self.path)
+        self._last_save = time.monotonic()
+
+    def save_cursor(self, cursor: int, blocks_filtered: int) -> None:
+        """
+        Move the cursor of the current round forward, unless it was saved less than CHECKPOINT_INTERVAL
+        seconds ago.
+        """
+        if time.monotonic() - self._last_save < CHECKPOINT_INTERVAL:
+            return
+        db_conn = sqlite3.connect(self.path)
+        try:
+            db_conn.executemany(
+                "UPDATE meta SET value = ? WHERE key = ?",
+                [(str(cursor), "cursor"), (str(blocks_filtered), "blocks_filtered")],
+            )
+            db_conn.commit()
+        finally:
+            db_conn.close()
+        self._last_save = time.monotonic()
+
+    def remove(self) -> None:
+        """
+        Remove the checkpoint of a scan that completed.
+        """
+        self.path.unlink(missing_ok=True)
+
+
+def skip_planned_blocks(
+    random_blocks_info: List[Tuple[Path, array]], num_blocks: int
+) -> List[Tuple[Path, array]]:
+    """
+    The (file_path, block_nums) left to read once the first num_blocks blocks of a plan are read.
+    """
+    remaining = []
+    for file_path, block_nums in random_blocks_info:
+        if num_blocks >= len(block_nums):
+            num_blocks -= len(block_nums)
+            continue
+        remaining.append((file_path, block_nums[num_blocks:]))
+        num_blocks = 0
+    return remaining
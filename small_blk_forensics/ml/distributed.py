@@ -0,0 +1,439 @@
+import argparse
+import os
+import queue
+import socket
+import threading
+from array import array
+from collections import deque
+from multiprocessing import AuthenticationError, get_context
+from multiprocessing.connection import Client, Connection, Listener
+from multiprocessing.process import BaseProcess
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Sequence, Tuple, cast
+
+from small_blk_forensics.ml.model import LOOKUP_BATCH_SIZE, SmallBlockForensicsModel
+from small_blk_forensics.ml.progress import ScanCancelled
+from small_blk_forensics.ml.stats import ScanStats
+from small_blk_forensics.utils.data import MyModelResponse
+
+# A scan split across worker processes. The coordinator selects the blocks to sample and splits them into work
+# units, which it hands out one at a time to the workers connected to it. Workers can run on any host that
+# sees the target and the known content DB at the same paths, the connections are authenticated with a
+# shared key but not encrypted. Messages are pickled tuples:
+#
+#   coordinator -> worker   ("config", dict)  ("unit", unit_id, work_unit)  ("stop",)
+#   worker -> coordinator   ("ready",)  ("result", unit_id, match or None, stats)  ("error", message)
+
+# Sampled blocks per work unit. Small units leave little work in flight when a worker finds a match, and
+# each unit still covers several DB queries so the round trips to the coordinator stay cheap.
+WORK_UNIT_SIZE = 4 * LOOKUP_BATCH_SIZE
+
+# Seconds between the checks of the coordinator for cancellation and for workers that have all exited
+POLL_INTERVAL = 0.1
+
+# Seconds a local worker is given to exit once stopped, before it is terminated. It only reads the DB and the
+# target, and only sees the stop once it has loaded the known content.
+WORKER_EXIT_TIMEOUT = 5.0
+
+# Environment variable holding the key shared by the coordinator and the workers it did not start itself
+AUTHKEY_ENV_VAR = "SBF_AUTHKEY"
+
+# Counters of the ScanStats of a worker that are added to the ones of the coordinator
+_WORKER_COUNTERS = [
+    "blocks_read",
+    "bytes_read",
+    "hash_seconds",
+    "db_queries",
+    "db_query_seconds",
+    "blocks_filtered",
+]
+
+# (file_path, block_nums) pairs, in sampling order
+WorkUnit = List[Tuple[Path, array]]
+
+
+def split_work_units(
+    random_blocks_info: List[Tuple[Path, array]], unit_size: int = WORK_UNIT_SIZE
+) -> List[WorkUnit]:
+    """
+    Split the sampled blocks into units of at most unit_size blocks, keeping their order. The samples of a
+    file are split across units when there are more of them than fit in one.
+    """
+    units: List[WorkUnit] = []
+    unit: WorkUnit = []
+    unit_blocks = 0
+    for file_path, block_nums in random_blocks_info:
+        start = 0
+        while start < len(block_nums):
+            part = block_nums[start : start + unit_size - unit_blocks]
+            unit.append((file_path, part))
+            unit_blocks += len(part)
+            start += len(part)
+            if unit_blocks == unit_size:
+                units.append(unit)
+                unit, unit_blocks = [], 0
+    if unit:
+        units.append(unit)
+    return units
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+class ScanCoordinator:
+    """
+    Hands out the work units of a scan to the workers that connect to it, and stops all of them once one
+    reports a match. The unit of a worker that disconnects before reporting it goes back to the queue.
+    """
+
+    def __init__(
+        self,
+        model: SmallBlockForensicsModel,
+        known_content_sqlite: Path,
+        units: List[WorkUnit],
+        address: Tuple[str, int],
+        authkey: bytes,
+    ):
+        self.model = model
+        self.config = {
+            "known_content_sqlite": str(known_content_sqlite.resolve()),
+            "block_size": model.block_size,
+            "num_io_threads": model.num_io_threads,
+            "index_memory_limit": model.index_memory_limit,
+        }
+        self.authkey = authkey
+        self.response: Optional[MyModelResponse] = None
+        self.error: Optional[str] = None
+        self._units: Deque[Tuple[int, WorkUnit]] = deque(enumerate(units))
+        self._num_units_left = len(units)
+        self._changed = threading.Condition()
+        self._finished = threading.Event()
+        self._connections: Dict[Connection, threading.Lock] = {}  # with the lock serializing sends to each
+        self._num_active = 0  # connections being served
+        self._listener = Listener(address, authkey=authkey)
+        self.address = cast(Tuple[str, int], self._listener.address)  # with the port picked if it was 0
+
+    def run(self, local_workers: Sequence[BaseProcess], wait_for_remote_workers: bool) -> MyModelResponse:
+        """
+        Serve the workers until one finds a match or every unit is scanned. Without remote workers, the scan
+        fails once all local workers have exited with units left.
+        """
+        accept_thread = threading.Thread(target=self._accept, daemon=True)
+        accept_thread.start()
+        try:
+            if not self._units:
+                self._finish()
+            while not self._finished.wait(POLL_INTERVAL):
+                if self.model.progress.cancelled:
+                    self._finish()
+                    raise ScanCancelled()
+                with self._changed:
+                    all_exited = self._num_active == 0 and not any(p.is_alive() for p in local_workers)
+                if all_exited and not wait_for_remote_workers:
+                    self._finish(error="All workers exited before the scan finished")
+        finally:
+            self._finish()
+            self._stop_accepting(accept_thread)
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return self.response or MyModelResponse(found=False)
+
+    def _accept(self) -> None:
+        while not self._finished.is_set():
+            try:
+                conn = self._listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError) as e:
+                # The connection waking this thread up once the scan is finished fails the handshake too
+                if not self._finished.is_set():
+                    print(f"WARNING: Rejected a connection that failed authentication: {e!r}")
+                continue
+            except OSError:
+                return
+            with self._changed:
+                if not self._finished.is_set():
+                    self._connections[conn] = threading.Lock()
+                    self._num_active += 1
+                    threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+                    continue
+            # A worker joining once the scan is finished
+            with conn:
+                conn.send(("stop",))
+
+    def _stop_accepting(self, accept_thread: threading.Thread) -> None:
+        # Closing a listening socket does not wake up a thread blocked accepting on it, while a connection
+        # does. It is a plain socket, which cannot block on the handshake once the thread stopped accepting.
+        try:
+            socket.create_connection(self.address).close()
+        except OSError:
+            pass
+        accept_thread.join()
+        self._listener.close()
+
+    def _serve(self, conn: Connection) -> None:
+        unit: Optional[Tuple[int, WorkUnit]] = None
+        try:
+            self._send(conn, ("config", self.config))
+            message = conn.recv()
+            while message[0] != "error":
+                if message[0] == "result":
+                    _, _, match, stats = message
+                    self._add_worker_stats(stats)
+                    unit = None
+                    if match is not None:
+                        self._finish(response=MyModelResponse(**match))
+                        return
+                    with self._changed:
+                        self._num_units_left -= 1
+                        if self._num_units_left == 0:
+                            self._finish()
+                            return
+                unit = self._next_unit()
+                if unit is None:
+                    return
+                self._send(conn, ("unit", *unit))
+                message = conn.recv()
+            self._finish(error=f"A worker failed: {message[1]}")
+        except (EOFError, OSError):
+            # The worker went away, and its unit goes to another one
+            if unit is not None:
+                with self._changed:
+                    self._units.appendleft(unit)
+                    self._changed.notify()
+        finally:
+            with self._changed:
+                self._num_active -= 1
+                send_lock = self._connections.pop(conn)
+            with send_lock:
+                conn.close()
+
+    def _next_unit(self) -> Optional[Tuple[int, WorkUnit]]:
+        """
+        The next unit to scan, waiting for one while units are in flight on other workers that may
+        disconnect. None once the scan is finished.
+        """
+        with self._changed:
+            while not self._units and not self._finished.is_set():
+                self._changed.wait()
+            if self._finished.is_set():
+                return None
+            return self._units.popleft()
+
+    def _send(self, conn: Connection, message: tuple) -> None:
+        with self._changed:
+            send_lock = self._connections[conn]
+        with send_lock:
+            conn.send(message)
+
+    def _add_worker_stats(self, stats: dict) -> None:
+        self.model.stats.add(**{counter: stats[counter] for counter in _WORKER_COUNTERS})
+        self.model.progress.add(stats["blocks_read"], stats["bytes_read"])
+
+    def _finish(self, response: Optional[MyModelResponse] = None, error: Optional[str] = None) -> None:
+        """
+        End the scan with the given match or error, unless it has ended already, and stop every worker.
+        """
+        with self._changed:
+            if self._finished.is_set():
+                return
+            self.response, self.error = response, error
+            self._finished.set()
+            self._changed.notify_all()
+            connections = list(self._connections.items())
+        for conn, send_lock in connections:
+            with send_lock:
+                try:
+                    conn.send(("stop",))
+                except OSError:
+                    pass  # The worker is gone already
+
+
+def run_distributed_scan(
+    model: SmallBlockForensicsModel,
+    known_content_sqlite: Path,
+    target: Path,
+    num_local_workers: int,
+    address: Tuple[str, int] = ("127.0.0.1", 0),
+    wait_for_remote_workers: bool = False,
+) -> MyModelResponse:
+    """
+    Scan random blocks of a target like SmallBlockForensicsModel.run_with_known_content_sqlite, with the
+    sampled blocks read, hashed and looked up by worker processes. num_local_workers of them are started
+    here, and with wait_for_remote_workers set, more can connect to the address with run_worker using the
+    key in the SBF_AUTHKEY environment variable.
+    The match reported is the first one a worker finds, which may not be the first in sampling order.
+    """
+    if not known_content_sqlite.is_file():
+        raise FileNotFoundError(known_content_sqlite)
+    if num_local_workers < 1 and not wait_for_remote_workers:
+        raise ValueError("A scan without remote workers needs at least one local worker")
+    authkey = os.environb.get(AUTHKEY_ENV_VAR.encode())
+    if authkey is None:
+        if wait_for_remote_workers:
+            raise ValueError(f"Set {AUTHKEY_ENV_VAR} to the key shared with the remote workers")
+        authkey = os.urandom(32)
+
+    # The coordinator only needs the number of matchable known blocks to size the sample, the same way a
+    # local scan does, and the workers load the rest
+    db_conn = model._get_db_conn(known_content_sqlite, read_only=True)
+    try:
+        with model.stats.stage("known_content_loading"):
+            model._load_matchable_known_blocks(db_conn)
+    finally:
+        model._close_db_conn(db_conn)
+
+    # Workers on other hosts open the sampled paths on their own, so they must not depend on the working
+    # directory
+    random_blocks_info = model._plan_random_blocks(target.resolve())
+    units = split_work_units(random_blocks_info)
+
+    with model.stats.stage("target_scanning"):
+        coordinator = ScanCoordinator(model, known_content_sqlite, units, address, authkey)
+        host, port = coordinator.address
+        print(f"INFO: Scanning {len(units)} work units with workers connecting to {host}:{port}")
+        # Forked workers would hold on to the listening socket of the coordinator, and a worker connecting
+        # after the scan finished would wait on it for a handshake that never comes
+        spawn = get_context("spawn")
+        local_workers = [
+            spawn.Process(target=run_worker, args=(coordinator.address, authkey), daemon=True)
+            for _ in range(num_local_workers)
+        ]
+        for process in local_workers:
+            process.start()
+        try:
+            response = coordinator.run(local_workers, wait_for_remote_workers)
+        finally:
+            for process in local_workers:
+                process.join(WORKER_EXIT_TIMEOUT)
+                if process.is_alive():
+                    process.terminate()
+    response.stats = model.stats.to_dict()
+    return response
+
+
+def run_worker(address: Tuple[str, int], authkey: bytes) -> None:
+    """
+    Connect to a coordinator and scan the work units it hands out against a read-only connection to the
+    known content DB, until it sends stop or goes away.
+    """
+    try:
+        conn = Client(address, authkey=authkey)
+        message = conn.recv()
+    except (EOFError, ConnectionResetError):
+        print("INFO: The coordinator finished its scan before this worker joined")
+        return
+    with conn:
+        if message[0] == "stop":
+            return
+        config = message[1]
+        model = SmallBlockForensicsModel(
+            config["block_size"],
+            num_io_threads=config["num_io_threads"],
+            index_memory_limit=config["index_memory_limit"],
+        )
+        try:
+            db_conn = model._get_db_conn(Path(config["known_content_sqlite"]), read_only=True)
+            try:
+                model._load_known_content(db_conn)
+                _serve_work_units(model, db_conn, conn)
+            finally:
+                model._close_db_conn(db_conn)
+        except Exception as e:
+            try:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+            except OSError:
+                pass
+            raise
+
+
+def _serve_work_units(model: SmallBlockForensicsModel, db_conn, conn: Connection) -> None:
+    # Messages are received on their own thread, so that a stop cancels the unit being scanned
+    messages: queue.Queue = queue.Queue()
+
+    def receive():
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == "stop":
+                    break
+                messages.put(message)
+        except (EOFError, OSError):
+            pass
+        model.progress.cancel()
+        messages.put(None)
+
+    threading.Thread(target=receive, daemon=True).start()
+    conn.send(("ready",))
+    while (message := messages.get()) is not None:
+        _, unit_id, unit = message
+        model.stats = ScanStats()
+        try:
+            response = model._scan_random_blocks(unit, db_conn, show_progress_bar=False)
+        except ScanCancelled:
+            return
+        match = response.model_dump() if response.found else None
+        conn.send(("result", unit_id, match, model.stats.to_dict()))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Scan random blocks of a target with several worker processes"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scan_parser = subparsers.add_parser("scan", help="Coordinate a scan, starting local workers")
+    scan_parser.add_argument("--input_sql", type=Path, required=True, help="Known content SQLite DB")
+    scan_parser.add_argument("--target", type=Path, required=True, help="Target directory, image or device")
+    scan_parser.add_argument("--block_size", type=int, default=4096, help="Defaults to 4096.")
+    scan_parser.add_argument("--target_probability", type=float, default=0.95, help="Defaults to 0.95.")
+    scan_parser.add_argument(
+        "--num_io_threads", type=int, default=1, help="Threads per worker. Defaults to 1."
+    )
+    scan_parser.add_argument(
+        "--index_memory_limit_mb", type=int, default=0, help="Per worker. Defaults to 0."
+    )
+    scan_parser.add_argument(
+        "--num_local_workers", type=int, default=os.cpu_count() or 1, help="Defaults to the number of CPUs."
+    )
+    scan_parser.add_argument(
+        "--address", default="127.0.0.1:0", help="Address workers connect to. Defaults to a free local port."
+    )
+    scan_parser.add_argument(
+        "--remote_workers",
+        action="store_true",
+        help=f"Also wait for workers started with the worker command, using the key in {AUTHKEY_ENV_VAR}",
+    )
+
+    worker_parser = subparsers.add_parser(
+        "worker", help=f"Join the scan of a coordinator, using the key in {AUTHKEY_ENV_VAR}"
+    )
+    worker_parser.add_argument("--address", required=True, help="host:port of the coordinator")
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        authkey = os.environb.get(AUTHKEY_ENV_VAR.encode())
+        if authkey is None:
+            parser.error(f"Set {AUTHKEY_ENV_VAR} to the key of the coordinator")
+        run_worker(parse_address(args.address), authkey)
+        return
+
+    model = SmallBlockForensicsModel(
+        args.block_size,
+        args.target_probability,
+        index_memory_limit=args.index_memory_limit_mb * 1024 * 1024,
+        num_io_threads=args.num_io_threads,
+    )
+    response = run_distributed_scan(
+        model,
+        args.input_sql,
+        args.target,
+        args.num_local_workers,
+        parse_address(args.address),
+        args.remote_workers,
+    )
+    print(response.model_dump_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import sqlite3
+from collections import Counter
+from math import log2
+from typing import List, NamedTuple, Tuple
+
+# Known blocks with a hash shared by at least this many blocks are flagged as too common when filtering is on.
+# Runs of padding, headers and blank pages repeat across files, and a match on them says nothing about the
+# target.
+DEFAULT_COMMON_BLOCK_THRESHOLD = 8
+
+# Bits per byte of a block of uniformly random bytes, the highest entropy a block can have
+MAX_ENTROPY = 8.0
+
+
+class BlockFilter(NamedTuple):
+    """
+    Which blocks carry too little information to be worth hashing, storing or looking up. The filter of a
+    known content DB is recorded in it, and scans against the DB apply the same one to the target.
+    """
+
+    skip_constant: bool = False  # blocks that repeat a single byte, such as zeroed space
+    min_entropy: float = 0.0  # in bits per byte, 0 disables it
+    common_block_threshold: int = 0  # known blocks sharing a hash for it to be too common, 0 disables it
+
+    @property
+    def enabled(self) -> bool:
+        return self.skip_constant or self.min_entropy > 0 or self.common_block_threshold > 0
+
+    def is_low_information(self, block: bytes) -> bool:
+        """
+        Whether a block is filtered before it is even hashed. Hashes too common are filtered after.
+        """
+        if self.skip_constant and is_constant_block(block):
+            return True
+        return self.min_entropy > 0 and block_entropy(block) < self.min_entropy
+
+
+def is_constant_block(block: bytes) -> bool:
+    if not block:
+        return True
+    # Most blocks already differ in their last byte, which spares a pass over them
+    return block[-1] == block[0] and bytes(block).count(block[0]) == len(block)
+
+
+def block_entropy(block: bytes) -> float:
+    """
+    Shannon entropy of the byte values of a block, in bits per byte.
+    """
+    if not block:
+        return 0.0
+    n = len(block)
+    return log2(n) - sum(count * log2(count) for count in Counter(block).values()) / n
+
+
+def insert_hash_rows(
+    db_conn: sqlite3.Connection, rows: List[Tuple[bytes, int, int]], count_common: bool
+) -> None:
+    """
+    Insert (hash, file_id, block_num) rows into the hashes table, keeping the first owner of a hash.
+    The rows ignored because their hash is already owned by a block of another file are kept in the
+    duplicate_hashes table, one per file. With count_common set, they are also counted in the common_hashes
+    table, along with that owner, as are the rows of repeated blocks of the same file.
+    """
+    total_changes = db_conn.total_changes
+    db_conn.executemany("INSERT OR IGNORE INTO hashes (hash, file_id, block_num) VALUES (?, ?, ?)", rows)
+    if db_conn.total_changes - total_changes == len(rows):
+        return
+
+    # Duplicates are rare outside of the blocks the filter is for, so they are only looked for when some
+    # rows of the chunk were ignored. Those are the rows whose hash ended up with another owner.
+    db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS chunk (hash BLOB, file_id INTEGER, block_num INTEGER)")
+    db_conn.execute("DELETE FROM temp.chunk")
+    db_conn.executemany("INSERT INTO temp.chunk (hash, file_id, block_num) VALUES (?, ?, ?)", rows)
+    db_conn.execute(
+        """INSERT OR IGNORE INTO duplicate_hashes (hash, file_id, block_num)
+        SELECT chunk.hash, chunk.file_id, chunk.block_num
+        FROM temp.chunk AS chunk JOIN hashes ON hashes.hash = chunk.hash
+        WHERE hashes.file_id != chunk.file_id"""
+    )
+    if count_common:
+        db_conn.execute(
+            """INSERT INTO common_hashes (hash, count)
+            SELECT chunk.hash, 2 FROM temp.chunk AS chunk JOIN hashes ON hashes.hash = chunk.hash
+            WHERE hashes.file_id != chunk.file_id OR hashes.block_num != chunk.block_num
+            ON CONFLICT (hash) DO UPDATE SET count = count + 1"""
+        )
+
+
+def delete_file_hash_rows(db_conn: sqlite3.Connection, file_condition: str, parameters: tuple = ()) -> None:
+    """
+    Delete the hash rows of the files matching file_condition, an SQL condition on file_id. A hash whose
+    owner is deleted passes to another file that holds it according to the duplicate_hashes table, so that a
+    block shared with a deleted file is still found.
+    The counts of common hashes are not decreased for the deleted rows.
+    """
+    db_conn.execute(f"DELETE FROM duplicate_hashes WHERE {file_condition}", parameters)
+    db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS orphaned_hashes (hash BLOB PRIMARY KEY)")
+    db_conn.execute("DELETE FROM temp.orphaned_hashes")
+    db_conn.execute(
+        f"""INSERT INTO temp.orphaned_hashes (hash)
+        SELECT hash FROM hashes WHERE {file_condition}""",
+        parameters,
+    )
+    db_conn.execute(f"DELETE FROM hashes WHERE {file_condition}", parameters)
+    # Of the files left holding an orphaned hash, the one added first becomes its owner
+    db_conn.execute(
+        """INSERT OR IGNORE INTO hashes (hash, file_id, block_num)
+        SELECT hash, file_id, block_num FROM duplicate_hashes
+        WHERE hash IN (SELECT hash FROM temp.orphaned_hashes)
+        ORDER BY hash, file_id"""
+    )
+    db_conn.execute(
+        """DELETE FROM duplicate_hashes
+        WHERE hash IN (SELECT hash FROM temp.orphaned_hashes)
+        AND file_id = (SELECT file_id FROM hashes WHERE hashes.hash = duplicate_hashes.hash)"""
+    )
@@ -0,0 +1,85 @@
+import argparse
+import hashlib
+import os
+import time
+from typing import Callable, Dict, List, Union
+
+try:
+    import xxhash  # type: ignore
+except ImportError:  # xxhash is optional, the xxh3 and xxh128 algorithms are only available with it
+    xxhash = None  # type: ignore
+
+HashFunction = Callable[[Union[bytes, memoryview]], bytes]
+
+# Algorithm of databases that do not record one, i.e. all databases written before it was selectable
+DEFAULT_HASH_ALGORITHM = "md5"
+
+# Block digests are only compared for equality against our own known content, so collision resistance does
+# not matter and the fastest algorithm can be used. blake2b is truncated to 16 bytes like md5 and xxh128.
+_HASH_FUNCTIONS: Dict[str, HashFunction] = {
+    "md5": lambda block: hashlib.md5(block).digest(),
+    "sha1": lambda block: hashlib.sha1(block).digest(),
+    "blake2b": lambda block: hashlib.blake2b(block, digest_size=16).digest(),
+}
+if xxhash is not None:
+    _HASH_FUNCTIONS["xxh3"] = xxhash.xxh3_64_digest
+    _HASH_FUNCTIONS["xxh128"] = xxhash.xxh3_128_digest
+
+HASH_ALGORITHMS = ["md5", "sha1", "blake2b", "xxh3", "xxh128"]
+
+# Random data hashed over and over by the benchmark, large enough to not fit in the CPU caches
+BENCHMARK_BUFFER_SIZE = 64 * 1024 * 1024
+
+
+def available_hash_algorithms() -> List[str]:
+    return [algorithm for algorithm in HASH_ALGORITHMS if algorithm in _HASH_FUNCTIONS]
+
+
+def get_hash_function(algorithm: str) -> HashFunction:
+    """
+    The function computing the digest of a block with the given algorithm.
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm {algorithm}, must be one of {HASH_ALGORITHMS}")
+    if algorithm not in _HASH_FUNCTIONS:
+        raise ValueError(f"Hash algorithm {algorithm} requires the xxhash package to be installed")
+    return _HASH_FUNCTIONS[algorithm]
+
+
+def benchmark(algorithm: str, block_size: int, total_bytes: int) -> float:
+    """
+    Hash total_bytes of random data block by block with the given algorithm, and return the throughput in
+    GB/s.
+    """
+    hash_function = get_hash_function(algorithm)
+    buffer = memoryview(os.urandom(min(total_bytes, BENCHMARK_BUFFER_SIZE)))
+    blocks = [buffer[offset : offset + block_size] for offset in range(0, len(buffer), block_size)]
+
+    bytes_hashed = 0
+    start = time.perf_counter()
+    while bytes_hashed < total_bytes:
+        for block in blocks:
+            hash_function(block)
+        bytes_hashed += len(buffer)
+    return bytes_hashed / (time.perf_counter() - start) / 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the throughput of the block hash algorithms")
+    parser.add_argument("--block_size", type=int, default=4096, help="Block size in bytes. Defaults to 4096.")
+    parser.add_argument(
+        "--megabytes", type=int, default=256, help="Data hashed per algorithm. Defaults to 256."
+    )
+    args = parser.parse_args()
+
+    print(f"Hashing {args.megabytes} MB in blocks of {args.block_size} bytes")
+    for algorithm in HASH_ALGORITHMS:
+        if algorithm not in _HASH_FUNCTIONS:
+            print(f"{algorithm:<8} unavailable, requires the xxhash package")
+            continue
+        throughput = benchmark(algorithm, args.block_size, args.megabytes * 1_000_000)
+        print(f"{algorithm:<8} {throughput:6.2f} GB/s")
+
+
+if __name__ == "__main__":
+    main()
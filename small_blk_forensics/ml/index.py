@@ -0,0 +1,284 @@
+import argparse
+import hashlib
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Sequence, Union, cast
+
+from small_blk_forensics.ml.schema import read_num_shards
+from small_blk_forensics.ml.shards import ShardSet, shard_path
+
+# Bytes needed per known block by the sorted array of 64-bit hash prefixes
+PREFIX_BYTES_PER_BLOCK = array("Q").itemsize
+
+# Layout of the sidecar file written next to a known content DB: this header, then the sorted 64-bit hash
+# prefixes of the DB in native byte order, which the scanner maps into memory instead of loading the hashes.
+# The header holds the number of prefixes and a digest of the size and mtime of the DB files when the sidecar
+# was written, so a sidecar left behind by an earlier version of the DB is ignored.
+SIDECAR_MAGIC = b"SBFIDX\x00\x00"
+SIDECAR_VERSION = 1
+_SIDECAR_HEADER = struct.Struct("<8sI?3x20sQ20x")  # magic, version, little endian, DB signature, count
+
+# Known hashes per bucket of the directory of an in-memory index, which narrows each bisection to a bucket
+INDEX_BUCKET_SIZE = 16
+
+# Prefixes read from the DB and converted per chunk, when loading the index or writing a sidecar
+PREFIX_CHUNK_SIZE = 65536
+
+
+def _hash_prefix(hash_value: bytes) -> int:
+    """
+    The first 64 bits of a digest as an integer.
+    """
+    return int.from_bytes(hash_value[:8], "big")
+
+
+def _contains_prefix(prefixes: Sequence[int], prefix: int) -> bool:
+    """
+    Whether a sorted sequence of hash prefixes holds a prefix. Digests are uniformly distributed, so the
+    search starts from the position the prefix would have in an evenly spread array and widens from there,
+    which touches a few neighbouring pages of a mapped sidecar instead of one page per step of a bisection.
+    """
+    n = len(prefixes)
+    if n == 0:
+        return False
+    guess = min(prefix * n >> 64, n - 1)
+    step = max(64, math.isqrt(n))  # around the deviation of a uniform sample from its expected position
+    lo, hi = max(0, guess - step), min(n, guess + step)
+    while lo > 0 and prefixes[lo] >= prefix:
+        step *= 2
+        lo = max(0, lo - step)
+    while hi < n and prefixes[hi - 1] < prefix:
+        step *= 2
+        hi = min(n, hi + step)
+    i = bisect_left(prefixes, prefix, lo, hi)
+    return i < n and prefixes[i] == prefix
+
+
+def _iter_prefix_chunks(hashes: Iterable[Union[bytes, str]]) -> Iterator[array]:
+    """
+    The 64-bit prefixes of hashes given in sorted order, in arrays of up to PREFIX_CHUNK_SIZE. Each chunk is
+    converted at once from the joined bytes of its prefixes rather than one integer at a time.
+    Version 1 databases store lowercase hex digests, which sort in the same order as the raw bytes.
+    """
+    it = iter(hashes)
+    while True:
+        chunk = list(islice(it, PREFIX_CHUNK_SIZE))
+        if not chunk:
+            return
+        if isinstance(chunk[0], str):
+            prefix_bytes = bytes.fromhex("".join(hash_value[:16] for hash_value in cast(List[str], chunk)))
+        else:
+            prefix_bytes = b"".join(hash_value[:8] for hash_value in cast(List[bytes], chunk))
+        prefixes = array("Q", prefix_bytes)
+        if sys.byteorder == "little":
+            prefixes.byteswap()  # The prefixes are big endian, so that they sort like the digests
+        yield prefixes
+
+
+class KnownHashIndex:
+    """
+    In-memory index of the hashes of known content, used to reject target blocks that cannot be in the DB
+    without querying SQLite.
+    It is a sorted array of the 64-bit prefixes of the hashes, along with a directory of where each range of
+    prefixes starts, so that a lookup only bisects the few prefixes of its bucket. A hash whose prefix is
+    found still has to be confirmed against the DB.
+    The prefixes may also be mapped from a sidecar file written by write_sidecar, in which case they are in
+    the page cache shared by every process scanning against the DB rather than in the memory of this one,
+    and are searched without a directory so that loading the index does not read every page.
+    """
+
+    def __init__(self, prefixes: Sequence[int], mapped: bool = False):
+        self.prefixes = prefixes
+        self.mapped = mapped  # whether the prefixes are mapped from a sidecar file
+        self._bucket_shift = 64
+        self._bucket_starts: Optional[array] = None
+        if not mapped:
+            # The prefixes are uniformly distributed, so the buckets of their top bits hold between
+            # INDEX_BUCKET_SIZE and twice as many each on average
+            bucket_bits = max(0, (len(prefixes) // INDEX_BUCKET_SIZE).bit_length() - 1)
+            self._bucket_shift = 64 - bucket_bits
+            self._bucket_starts = array(
+                "Q",
+                (
+                    bisect_left(prefixes, bucket << self._bucket_shift)
+                    for bucket in range((1 << bucket_bits) + 1)
+                ),
+            )
+
+    @classmethod
+    def from_db(
+        cls, db_conn: sqlite3.Connection, num_hashes: int, memory_limit: int
+    ) -> Optional["KnownHashIndex"]:
+        """
+        Load the hashes table into an index that uses at most `memory_limit` bytes.
+        """
+        # The hash column is the primary key, so rows come back in sorted order and the prefixes need no sort.
+        c = db_conn.cursor()
+        c.execute("SELECT hash FROM hashes ORDER BY hash")
+        return cls.from_hashes((hash_value for (hash_value,) in c), num_hashes, memory_limit)
+
+    @classmethod
+    def from_hashes(
+        cls, hashes: Iterable[Union[bytes, str]], num_hashes: int, memory_limit: int
+    ) -> Optional["KnownHashIndex"]:
+        """
+        Load hashes given in sorted order into an index that uses at most `memory_limit` bytes.
+        Returns None if the prefixes of the hashes do not fit in the budget.
+        """
+        if num_hashes * (PREFIX_BYTES_PER_BLOCK + 1) > memory_limit:  # with the directory, under a byte each
+            return None
+        prefixes = array("Q")
+        for chunk in _iter_prefix_chunks(hashes):
+            prefixes.extend(chunk)
+        return cls(prefixes)
+
+    @classmethod
+    def from_sidecar(cls, db_path: Path, num_shards: int) -> Optional["KnownHashIndex"]:
+        """
+        Map the sidecar of a DB into memory, which takes the same time whatever the size of the DB.
+        Returns None if the DB has no sidecar or the sidecar does not match the current DB files.
+        """
+        path = sidecar_path(db_path)
+        try:
+            with open(path, "rb") as f:
+                header = f.read(_SIDECAR_HEADER.size)
+                if len(header) < _SIDECAR_HEADER.size:
+                    return None
+                magic, version, little_endian, signature, count = _SIDECAR_HEADER.unpack(header)
+                if (
+                    magic != SIDECAR_MAGIC
+                    or version != SIDECAR_VERSION
+                    or little_endian != (sys.byteorder == "little")
+                    or signature != db_signature(db_path, num_shards)
+                    or os.fstat(f.fileno()).st_size != _SIDECAR_HEADER.size + count * PREFIX_BYTES_PER_BLOCK
+                ):
+                    return None
+                if count == 0:
+                    return cls(array("Q"), mapped=True)
+                # The mapping stays open as long as the view on it is referenced, after the file is closed
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        return cls(memoryview(mapping)[_SIDECAR_HEADER.size :].cast("Q"), mapped=True)
+
+    def __contains__(self, hash_value: bytes) -> bool:
+        """
+        False if the hash is definitely not in the DB, True if it may be.
+        """
+        return bool(self.filter([hash_value]))
+
+    def filter(self, hashes: Iterable[bytes]) -> List[bytes]:
+        """
+        The hashes of a batch that may be in the DB, leaving out those that are definitely not.
+        """
+        prefixes = self.prefixes
+        if self._bucket_starts is None:
+            return [
+                hash_value for hash_value in hashes if _contains_prefix(prefixes, _hash_prefix(hash_value))
+            ]
+        # Inlined, as this runs for every sampled block
+        bucket_starts, bucket_shift = self._bucket_starts, self._bucket_shift
+        candidates = []
+        for hash_value in hashes:
+            prefix = int.from_bytes(hash_value[:8], "big")
+            bucket = prefix >> bucket_shift
+            end = bucket_starts[bucket + 1]
+            i = bisect_left(prefixes, prefix, bucket_starts[bucket], end)
+            if i < end and prefixes[i] == prefix:
+                candidates.append(hash_value)
+        return candidates
+
+    @property
+    def nbytes(self) -> int:
+        # Mapped prefixes are in the page cache, which the OS reclaims as needed
+        if self.mapped:
+            return 0
+        directory_nbytes = (
+            len(self._bucket_starts) * self._bucket_starts.itemsize if self._bucket_starts else 0
+        )
+        return len(self.prefixes) * PREFIX_BYTES_PER_BLOCK + directory_nbytes
+
+
+def sidecar_path(db_path: Path) -> Path:
+    return db_path.with_name(f"{db_path.name}.idx")
+
+
+def db_signature(db_path: Path, num_shards: int) -> bytes:
+    """
+    Digest of the size and mtime of the files of a DB and of its shards, including their WAL files, which
+    changes whenever a commit is written to any of them.
+    """
+    paths = [db_path]
+    if num_shards > 1:
+        paths += [shard_path(db_path, shard_index) for shard_index in range(num_shards)]
+    parts = []
+    for path in paths:
+        file_stat = path.stat()
+        wal_path = path.with_name(f"{path.name}-wal")
+        wal_stat = wal_path.stat() if wal_path.exists() else None
+        wal_signature = f"{wal_stat.st_size}:{wal_stat.st_mtime_ns}" if wal_stat is not None else "0:0"
+        parts.append(f"{file_stat.st_size}:{file_stat.st_mtime_ns}:{wal_signature}")
+    return hashlib.sha1("\n".join(parts).encode()).digest()
+
+
+def write_sidecar(db_path: Path) -> int:
+    """
+    Write the sorted hash prefixes of a known content DB to its sidecar file, replacing any earlier one.
+    The sidecar must be written again whenever the DB changes, otherwise scans ignore it.
+    Returns the number of prefixes written.
+    """
+    db_conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+    shards: Optional[ShardSet] = None
+    try:
+        num_shards = read_num_shards(db_conn)
+        signature = db_signature(db_path, num_shards)
+        if num_shards > 1:
+            shards = ShardSet.open(db_path, num_shards)
+            hashes: Iterable[Union[bytes, str]] = shards.iter_hashes()
+        else:
+            hashes = (
+                hash_value for (hash_value,) in db_conn.execute("SELECT hash FROM hashes ORDER BY hash")
+            )
+
+        path = sidecar_path(db_path)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        count = 0
+        with open(tmp_path, "wb") as f:
+            f.write(bytes(_SIDECAR_HEADER.size))
+            for chunk in _iter_prefix_chunks(hashes):
+                chunk.tofile(f)
+                count += len(chunk)
+            f.seek(0)
+            f.write(
+                _SIDECAR_HEADER.pack(
+                    SIDECAR_MAGIC, SIDECAR_VERSION, sys.byteorder == "little", signature, count
+                )
+            )
+        os.replace(tmp_path, path)
+        return count
+    finally:
+        if shards is not None:
+            shards.close()
+        db_conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write the sidecar index of a known content DB, which scans map instead of its hashes"
+    )
+    parser.add_argument("db_path", type=Path, help="Path of the known content DB")
+    args = parser.parse_args()
+    count = write_sidecar(args.db_path)
+    print(f"Wrote {count} hash prefixes to {sidecar_path(args.db_path)}")
+
+
+if __name__ == "__main__":
+    main()
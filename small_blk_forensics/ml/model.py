@@ -1,94 +1,478 @@
-import hashlib
+import json
 import os
 import random
 import sqlite3
-from collections import namedtuple
-from math import prod
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from itertools import accumulate, chain, groupby, islice
+from math import exp, floor, lgamma, log, log1p, pi, sqrt
+from multiprocessing import Pool
+from multiprocessing.pool import AsyncResult
 from pathlib import Path
-from typing import List, Tuple
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 from tqdm import tqdm
 
-from small_blk_forensics.utils.data import MyModelResponse
+from small_blk_forensics.ml.cache import KnownContent, KnownContentCache
+from small_blk_forensics.ml.checkpoint import (
+    CHECKPOINT_INTERVAL,
+    ScanCheckpoint,
+    skip_planned_blocks,
+)
+from small_blk_forensics.ml.filtering import (
+    BlockFilter,
+    delete_file_hash_rows,
+    insert_hash_rows,
+)
+from small_blk_forensics.ml.hashing import DEFAULT_HASH_ALGORITHM, get_hash_function
+from small_blk_forensics.ml.index import KnownHashIndex
+from small_blk_forensics.ml.progress import ScanProgress
+from small_blk_forensics.ml.reader import iter_file_blocks
+from small_blk_forensics.ml.scheduler import iter_merged_reads, order_by_location
+from small_blk_forensics.ml.schema import (
+    BULK_LOAD_PRAGMAS,
+    END_BULK_LOAD_PRAGMAS,
+    SCHEMA_VERSION,
+    create_duplicate_hashes_table,
+    create_manifest_table,
+    create_schema,
+    read_block_filter,
+    read_build_in_progress,
+    read_hash_algorithm,
+    read_num_shards,
+    read_schema_version,
+    set_build_in_progress,
+)
+from small_blk_forensics.ml.shards import (
+    ShardSet,
+    ShardWriters,
+    db_file_path,
+    remove_shards,
+)
+from small_blk_forensics.ml.stats import ScanStats
+from small_blk_forensics.ml.walker import list_directory
+from small_blk_forensics.utils.data import ExhaustiveScanResponse, MyModelResponse
 
 IS_TEST_MODE = "TESTING" in os.environ
 
+# Number of sampled target blocks resolved against the known content DB per query.
+# Kept below SQLite's default limit of 999 host parameters per statement.
+LOOKUP_BATCH_SIZE = 512
+
+# Number of known content rows handed to a single executemany call. This also bounds the number of blocks
+# hashed by a worker process per task, so memory stays flat regardless of the size of a known content file.
+INSERT_CHUNK_SIZE = 16384
+
+# Blocks sampled from a raw disk image or block device must start on a sector boundary
+SECTOR_SIZE = 512
+
+# Bytes of a target file read and hashed by a single task of an exhaustive scan
+EXHAUSTIVE_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# An adaptive scan samples in rounds of half the blocks it still needs, and of at least this many blocks, so
+# that it stops as soon as the blocks filtered so far prove the target probability
+ADAPTIVE_MIN_ROUND_SIZE = 64
+
+# Share of the miss probability an adaptive scan allows for its estimate of the filtered blocks of the target
+# being too high, the rest goes to missing the known content in the blocks it samples
+ADAPTIVE_ESTIMATE_RISK = 0.1
+
+# Up to this many known blocks, the probability of missing them is summed term by term. Above it, it is
+# evaluated with Stirling's series, which is accurate once its arguments are at least STIRLING_MIN_ARGUMENT.
+MAX_MISS_PROBABILITY_TERMS = 1024
+STIRLING_MIN_ARGUMENT = 16
+
 
 def _ensure_output_file_path(path: Path):
     path.parent.mkdir(parents=True, exist_ok=True)
 
 
-def prod_prob(n_samples, blocks_of_known_content, total_blocks_to_scan):
+def miss_probability(n_samples, blocks_of_known_content, total_blocks_to_scan) -> float:
+    """
+    Probability that n_samples blocks drawn without replacement from total_blocks_to_scan blocks all miss the
+    blocks_of_known_content blocks, i.e. the hypergeometric probability of zero hits.
+    This is the product prod_{i=0}^{n-1} (N - i - C) / (N - i), which is also prod_{j=0}^{C-1} (N - j - n) /
+    (N - j). Its log is summed over the C terms of the latter when there are few of them. Otherwise it is
+    [(N - C)! (N - n)!] / [(N - C - n)! N!], whose log gamma values are of the order of N log N and lose the
+    result to cancellation when subtracted, so the differences are taken inside Stirling's series instead.
+    """
     C, N = blocks_of_known_content, total_blocks_to_scan
-    return prod(((N - (i - 1)) - C) / (N - (i - 1)) for i in range(1, n_samples + 1))
+    if n_samples <= 0:
+        return 1.0
+    if n_samples > N - C:
+        return 0.0  # More samples than blocks outside the known content, so one of them must hit
+    if C <= MAX_MISS_PROBABILITY_TERMS:
+        return exp(sum(log1p(-n_samples / (N - j)) for j in range(C)))
+    if N - C - n_samples + 1 < STIRLING_MIN_ARGUMENT:
+        # Nearly every block outside the known content is sampled, and the probability is negligible anyway
+        return exp(
+            lgamma(N - C + 1) - lgamma(N - C - n_samples + 1) - lgamma(N + 1) + lgamma(N - n_samples + 1)
+        )
+    return exp(
+        C * log1p(-n_samples / (N + 1))
+        + _log_gamma_ratio_remainder(N + 1, C)
+        - _log_gamma_ratio_remainder(N - n_samples + 1, C)
+    )
+
+
+def _log_gamma_ratio_remainder(x, c) -> float:
+    """
+    lgamma(x - c) - lgamma(x) + c log(x), from Stirling's series. Its terms are of the order of c rather than
+    of x log x, so it keeps its precision for large x.
+    """
+
+    def series(z):
+        return 1 / (12 * z) - 1 / (360 * z**3) + 1 / (1260 * z**5)
+
+    return (x - c - 0.5) * log1p(-c / x) + c + series(x - c) - series(x)
+
+
+def _get_target_size(fd: int) -> int:
+    """
+    Size in bytes of an open file. st_size is 0 for block devices, while seeking to the end works for both
+    them and regular files.
+    """
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def _advise_random_reads(fd: int, reads: Iterable[Sequence[int]], block_size: int) -> None:
+    """
+    Tell the kernel that the file is read at random offsets, so that it does not read ahead of every sampled
+    block, and that the given runs of blocks are about to be read, so that it can queue all of their reads at
+    once.
+    """
+    if not hasattr(os, "posix_fadvise"):  # Not available on macOS
+        return
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+    for run in reads:
+        length = (run[-1] - run[0] + 1) * block_size
+        os.posix_fadvise(fd, run[0] * block_size, length, os.POSIX_FADV_WILLNEED)
 
 
 TableCell = namedtuple("TableCell", ["file_path", "block_num", "hash_value"])
+KnownFile = namedtuple("KnownFile", ["path", "stat"])
+FileBlockMap = namedtuple("FileBlockMap", ["file_paths", "block_counts", "total_blocks"])
+
+
+class TargetFileMatches:
+    """
+    The blocks of a target file that match known content. The matched blocks of each known file are merged
+    into ranges of consecutive target blocks that are also consecutive in the known file, so a copied file
+    is a single range however large it is.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.num_blocks = 0
+        self.matched_blocks = 0
+        # [first target block, last target block, first known block] by known file path
+        self.block_ranges: Dict[str, List[List[int]]] = {}
+
+    def add_block(self, block_num: int, match: Optional[Tuple[str, int]]) -> None:
+        """
+        Add the next block of the file, with the (known_file_path, block_num) it matched if any.
+        """
+        self.num_blocks += 1
+        if match is None:
+            return
+        self.matched_blocks += 1
+        known_file_path, known_block_num = match
+        ranges = self.block_ranges.setdefault(known_file_path, [])
+        if ranges:
+            last_range = ranges[-1]
+            if (
+                block_num == last_range[1] + 1
+                and known_block_num == last_range[2] + block_num - last_range[0]
+            ):
+                last_range[1] = block_num
+                return
+        ranges.append([block_num, block_num, known_block_num])
+
+    def to_dict(self) -> dict:
+        return {
+            "target_file": self.file_path,
+            "num_blocks": self.num_blocks,
+            "matched_blocks": self.matched_blocks,
+            "fraction_matched": self.matched_blocks / self.num_blocks if self.num_blocks else 0.0,
+            "known_files": [
+                {
+                    "known_file": known_file_path,
+                    "matched_blocks": sum(last - first + 1 for first, last, _ in ranges),
+                    "block_ranges": [
+                        {"target_start": first, "target_end": last, "known_start": known_first}
+                        for first, last, known_first in ranges
+                    ],
+                }
+                for known_file_path, ranges in self.block_ranges.items()
+            ],
+        }
+
+
+def _iter_file_cells(
+    file_path: Path,
+    block_size: int,
+    start_block: int = 0,
+    max_blocks: Optional[int] = None,
+    hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+    stats: Optional[ScanStats] = None,
+    block_filter: BlockFilter = BlockFilter(),
+) -> Iterator[TableCell]:
+    """
+    Hash the blocks of a file, or of a segment of it, and yield one TableCell per block that is not filtered
+    as low-information.
+    The time spent hashing and the number of blocks filtered are added to stats, if given, once the file is
+    done.
+    """
+    file_path_str = str(file_path)
+    hash_function = get_hash_function(hash_algorithm)
+    hash_seconds = 0.0
+    blocks_filtered = 0
+    try:
+        for block_num, block in iter_file_blocks(file_path, block_size, start_block, max_blocks):
+            if block_filter.is_low_information(block):
+                blocks_filtered += 1
+                continue
+            start = time.perf_counter()
+            block_hash = hash_function(block)
+            hash_seconds += time.perf_counter() - start
+            yield TableCell(file_path_str, block_num, block_hash)
+    finally:
+        if stats is not None:
+            stats.add(hash_seconds=hash_seconds, blocks_filtered=blocks_filtered)
+
+
+def _lookup_hashes(cells: Iterable[TableCell]) -> List[bytes]:
+    """
+    The distinct hashes of a batch of hashed blocks to look up, leaving out the filtered blocks.
+    """
+    return list({cell.hash_value for cell in cells if cell.hash_value is not None})
+
+
+def _hash_file_segment(
+    file_path: Path,
+    block_size: int,
+    start_block: int,
+    max_blocks: Optional[int],
+    hash_algorithm: str,
+    block_filter: BlockFilter,
+):
+    """
+    Hash a segment of a file in a worker process. Lives at module level so that it can be pickled.
+    Returns the hashed blocks, the time spent hashing them and the number of blocks filtered.
+    """
+    stats = ScanStats()
+    cells = list(
+        _iter_file_cells(file_path, block_size, start_block, max_blocks, hash_algorithm, stats, block_filter)
+    )
+    return cells, stats.hash_seconds, stats.blocks_filtered
 
 
 class SmallBlockForensicsModel:
-    def __init__(self, block_size: int = 4096, target_probability: float = 1):
+    def __init__(
+        self,
+        block_size: int = 4096,
+        target_probability: float = 1,
+        num_workers: int = 1,
+        index_memory_limit: int = 0,
+        num_io_threads: int = 1,
+        progress: Optional[ScanProgress] = None,
+        hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+        block_map_cache_dir: Optional[Path] = None,
+        num_shards: int = 1,
+        block_filter: Optional[BlockFilter] = None,
+        checkpoint_dir: Optional[Path] = None,
+        adaptive_sampling: bool = False,
+    ):
         self.block_size = block_size
         self.target_probability = target_probability
+        self.num_workers = num_workers  # number of processes used to hash known content
+        self.index_memory_limit = index_memory_limit  # bytes for the index of known hashes, 0 disables it
+        self.num_io_threads = num_io_threads  # number of threads reading and hashing sampled target blocks
+        self.progress = progress or ScanProgress()  # progress and cancellation of the current run
+        self.stats = ScanStats()  # counters and timers of the runs of this model
+        self.hash_algorithm = hash_algorithm  # replaced by the algorithm of an existing database when opened
+        self._hash_function = get_hash_function(hash_algorithm)
+        self.block_map_cache_dir = (
+            block_map_cache_dir  # where listings of target directories are cached, if set
+        )
+        self.num_shards = (
+            num_shards  # shard DBs a new database is split into, replaced by those of an existing one
+        )
+        self.shards: Optional[ShardSet] = None  # read-only shards of the opened database, if it has several
+        self.shard_writers: Optional[ShardWriters] = None  # writers of the shards while they are being built
+        # Low-information blocks skipped by a new database, replaced by the filter of an existing one
+        self.block_filter = block_filter or BlockFilter()
+        self.common_hashes: FrozenSet[bytes] = frozenset()  # known hashes too common to be looked up
+        self.checkpoint_dir = checkpoint_dir  # where plans of target scans are saved to be resumed, if set
+        self.adaptive_sampling = (
+            adaptive_sampling  # sample in rounds and stop once the target probability is met
+        )
+        self._last_checkpoint = 0.0  # monotonic time of the last commit of a known content build
+        self.known_index: Optional[KnownHashIndex] = None  # will be set at runtime
+        self.schema_version = 0  # will be set at runtime from the opened database
         self.num_hashed_blocks_in_known_cntnt = 0  # will be set at runtime
         self.num_random_blocks = (
             0  # will be set at runtime based on number of blocks in target and known directory
         )
 
     def run_with_known_content_directory(
-        self, known_content_directory: Path, target_directory: Path, out_sql_path: Path
+        self,
+        known_content_directory: Path,
+        target: Path,
+        out_sql_path: Path,
+        incremental: bool = False,
     ) -> MyModelResponse:
         """
-        Applies the small block technique to the known content directory and target directory.
+        Applies the small block technique to the known content directory and a target, which is either a
+        directory or a raw disk image or block device.
+        With incremental set, an existing output database is refreshed instead of being rebuilt from scratch.
+        An output database whose build from the same directory was interrupted is resumed either way.
         """
-        if out_sql_path.is_file():
+        if (
+            out_sql_path.is_file()
+            and not incremental
+            and not self._is_interrupted_build(out_sql_path, known_content_directory)
+        ):
             out_sql_path.unlink()
+            remove_shards(out_sql_path)
         _ensure_output_file_path(out_sql_path)
         db_conn = self._get_db_conn(out_sql_path)
 
         # Fully hash the known content directory and store hashes in the output directory's database
-        self._hash_directory(known_content_directory, db_conn, out_sql_path)
+        self._hash_directory(known_content_directory, db_conn, out_sql_path, incremental)
         print()
 
         # Set number of hashed blocks
-        self.num_hashed_blocks_in_known_cntnt = self._get_number_of_hashed_blocks(db_conn)
+        self._load_known_content(db_conn)
 
-        # Hash the target directory and check for matches using random blocks
-        response = self._hash_directory_random_blocks(target_directory, db_conn)
-        db_conn.close()
+        # Hash the target and check for matches using random blocks
+        response = self._hash_target_random_blocks(target, db_conn)
+        self._close_db_conn(db_conn)
 
+        response.stats = self.stats.to_dict()
         return response
 
     def run_with_known_content_sqlite(
-        self, known_content_sqlite: Path, target_directory: Path
+        self,
+        known_content_sqlite: Path,
+        target: Path,
+        known_content_cache: Optional[KnownContentCache] = None,
     ) -> MyModelResponse:
         """
         Applies the small block technique using known content from an SQLite database.
+        With a cache, the database and the state loaded from it are reused across runs.
+        """
+        with self._open_known_content(known_content_sqlite, known_content_cache) as db_conn:
+            # Hash the target and check for matches
+            response = self._hash_target_random_blocks(target, db_conn)
+        response.stats = self.stats.to_dict()
+        return response
+
+    def run_exhaustive_with_known_content_sqlite(
+        self,
+        known_content_sqlite: Path,
+        target: Path,
+        out_results_path: Path,
+        known_content_cache: Optional[KnownContentCache] = None,
+    ) -> ExhaustiveScanResponse:
+        """
+        Hashes every block of the target, a directory or a raw image or block device, and finds all of the
+        blocks that match known content rather than stopping at the first one.
+        The target files with matches are written to out_results_path as they are found, one JSON object per
+        line, so memory stays bounded however large the target is.
+        """
+        response = ExhaustiveScanResponse(results_path=str(out_results_path))
+        _ensure_output_file_path(out_results_path)
+        with self._open_known_content(known_content_sqlite, known_content_cache) as db_conn, open(
+            out_results_path, "w"
+        ) as results_file:
+            for file_matches in self._hash_target_all_blocks(target, db_conn):
+                response.files_scanned += 1
+                response.blocks_scanned += file_matches.num_blocks
+                if not file_matches.matched_blocks:
+                    continue
+                response.files_matched += 1
+                response.blocks_matched += file_matches.matched_blocks
+                results_file.write(json.dumps(file_matches.to_dict()) + "\n")
+        print(
+            f"INFO: {response.blocks_matched} of {response.blocks_scanned} blocks in {response.files_matched} "
+            f"of {response.files_scanned} files match known content"
+        )
+        response.stats = self.stats.to_dict()
+        return response
+
+    @contextmanager
+    def _open_known_content(
+        self, known_content_sqlite: Path, known_content_cache: Optional[KnownContentCache]
+    ) -> Iterator[sqlite3.Connection]:
+        """
+        Open a known content database and load the state needed to scan a target against it, from the cache if
+        one is given.
         """
         if not known_content_sqlite.is_file():
             raise FileNotFoundError(known_content_sqlite)
-        db_conn = self._get_db_conn(known_content_sqlite)
-
-        # Set number of hashed blocks
-        self.num_hashed_blocks_in_known_cntnt = self._get_number_of_hashed_blocks(db_conn)
 
-        # Hash the target directory and check for matches
-        response = self._hash_directory_random_blocks(target_directory, db_conn)
-        db_conn.close()
+        if known_content_cache is None:
+            db_conn = self._get_db_conn(known_content_sqlite)
+            try:
+                self._load_known_content(db_conn)
+                yield db_conn
+            finally:
+                self._close_db_conn(db_conn)
+            return
 
-        return response
+        with known_content_cache.open(
+            known_content_sqlite, self.index_memory_limit, self._load_known_content
+        ) as (known_content, db_conn):
+            (
+                self.schema_version,
+                self.hash_algorithm,
+                self.num_shards,
+                self.block_filter,
+                self.num_hashed_blocks_in_known_cntnt,
+                self.common_hashes,
+                self.known_index,
+            ) = known_content
+            self._hash_function = get_hash_function(self.hash_algorithm)
+            try:
+                self._open_shards(db_conn)
+                yield db_conn
+            finally:
+                self._close_shards()
 
-    def _calculate_num_random_blocks(self, blocks_of_known_content, blocks_in_target) -> int:
+    def _calculate_num_random_blocks(
+        self, blocks_of_known_content, blocks_in_target, max_miss_probability: Optional[float] = None
+    ) -> int:
         """Find the minimum number of samples where the probability < threshold."""
         if self.target_probability == 1:
             return blocks_in_target
+        if max_miss_probability is None:
+            max_miss_probability = 1 - self.target_probability
         lo, hi = 0, blocks_in_target
 
         while lo <= hi:
             mid = (lo + hi) // 2
-            probability = prod_prob(mid, blocks_of_known_content, blocks_in_target)
+            probability = miss_probability(mid, blocks_of_known_content, blocks_in_target)
 
-            if probability <= 1 - self.target_probability:
+            if probability <= max_miss_probability:
                 # Continue searching in the lower half to find the minimum n_samples
                 hi = mid - 1
             else:
@@ -97,48 +481,205 @@ class SmallBlockForensicsModel:
 
         return lo  # At the end, lo will be the smallest n_samples where probability < threshold
 
-    def _hash_block(self, block: bytes) -> str:
+    def _hash_block(self, block: bytes) -> bytes:
         """
-        Computes the MD5 hash of a given block.
+        Computes the digest of a given block with the hash algorithm of the database.
         """
-        return hashlib.md5(block).hexdigest()
+        return self._hash_function(block)
 
-    def _store_hashes_in_db(self, cells: list[TableCell], db_conn: sqlite3.Connection) -> None:
+    def _store_hashes_in_db(self, cells: Iterable[TableCell], db_conn: sqlite3.Connection) -> None:
         """
-        Store the computed hash along with the file path in an SQLite database.
+        Store the computed hashes along with the file paths in an SQLite database.
+        Rows are consumed from the iterable in chunks of INSERT_CHUNK_SIZE, so it can be a generator over a file
+        of any size. The caller is responsible for committing.
         """
+        cells = iter(cells)
+        while chunk := list(islice(cells, INSERT_CHUNK_SIZE)):
+            self.progress.check_cancelled()
+            self._store_hash_chunk_in_db(chunk, db_conn)
+            self.progress.add(len(chunk), 0)
+            self.stats.add(blocks_read=len(chunk))
+
+    def _store_hash_chunk_in_db(self, cells: List[TableCell], db_conn: sqlite3.Connection) -> None:
         c = db_conn.cursor()
-        c.execute(
-            """CREATE TABLE IF NOT EXISTS hashes (
-            hash TEXT PRIMARY KEY,
-            file_path TEXT,
-            block_num INTEGER
-        )"""
-        )
-        c.executemany(
-            "INSERT OR IGNORE INTO hashes (file_path, block_num, hash) VALUES (?, ?, ?)",
-            cells,
-        )
+        if self.schema_version == 1:
+            c.executemany(
+                "INSERT OR IGNORE INTO hashes (file_path, block_num, hash) VALUES (?, ?, ?)",
+                ((file_path, block_num, hash_value.hex()) for file_path, block_num, hash_value in cells),
+            )
+        else:
+            file_ids = {
+                file_path: self._get_file_id(file_path, db_conn)
+                for file_path in dict.fromkeys(cell.file_path for cell in cells)
+            }
+            rows = (
+                (hash_value, file_ids[file_path], block_num) for file_path, block_num, hash_value in cells
+            )
+            if self.shard_writers is not None:
+                self.shard_writers.insert(rows)
+                return
+            insert_hash_rows(db_conn, list(rows), self.block_filter.common_block_threshold > 0)
 
-        db_conn.commit()
+    def _get_file_id(self, file_path: str, db_conn: sqlite3.Connection) -> int:
+        """
+        Returns the id of a known content file in the files table, adding the file if it is not there yet.
+        """
+        c = db_conn.cursor()
+        c.execute("INSERT OR IGNORE INTO files (path) VALUES (?)", (file_path,))
+        c.execute("SELECT id FROM files WHERE path = ?", (file_path,))
+        return c.fetchone()[0]
 
-    def _query_hash_in_db(self, target_hash: str, db_conn: sqlite3.Connection) -> Tuple[bool, str, int]:
+    def _query_hashes_in_db(
+        self, target_hashes: List[bytes], db_conn: sqlite3.Connection
+    ) -> Dict[bytes, Tuple[str, int]]:
         """
-        Query the SQLite database to check if a given target hash exists.
-        Returns a tuple of (found: bool, file_path: str, block_num: int).
+        Query the SQLite database for a batch of target hashes in a single statement.
+        Returns a dict mapping each hash that exists in the database to (file_path, block_num).
         """
+        if self.common_hashes:
+            target_hashes = [
+                target_hash for target_hash in target_hashes if target_hash not in self.common_hashes
+            ]
+        if self.known_index is not None:
+            # Only hashes that may be in the DB are worth a query
+            target_hashes = self.known_index.filter(target_hashes)
+        if not target_hashes:
+            return {}
+        placeholders = ",".join("?" * len(target_hashes))
         c = db_conn.cursor()
-        c.execute("SELECT file_path, block_num FROM hashes WHERE hash = ?", (target_hash,))
-        result = c.fetchone()
-        if result:
-            return True, result[0], result[1]
-        return False, "", -1
+        start = time.perf_counter()
+        if self.schema_version == 1:
+            # Version 1 databases key the hashes by their hex digest
+            c.execute(
+                f"SELECT hash, file_path, block_num FROM hashes WHERE hash IN ({placeholders})",
+                [target_hash.hex() for target_hash in target_hashes],
+            )
+            matches = {
+                bytes.fromhex(hash_value): (file_path, block_num)
+                for hash_value, file_path, block_num in c.fetchall()
+            }
+        elif self.shards is not None:
+            # Each hash is looked up in its own shard, and the paths of the matching files in this database
+            shard_matches = self.shards.query(target_hashes)
+            file_ids = list({file_id for file_id, _ in shard_matches.values()})
+            c.execute(f"SELECT id, path FROM files WHERE id IN ({','.join('?' * len(file_ids))})", file_ids)
+            file_paths = dict(c.fetchall())
+            matches = {
+                hash_value: (file_paths[file_id], block_num)
+                for hash_value, (file_id, block_num) in shard_matches.items()
+            }
+        else:
+            c.execute(
+                f"""SELECT hashes.hash, files.path, hashes.block_num
+                FROM hashes JOIN files ON files.id = hashes.file_id
+                WHERE hashes.hash IN ({placeholders})""",
+                target_hashes,
+            )
+            matches = {
+                hash_value: (file_path, block_num) for hash_value, file_path, block_num in c.fetchall()
+            }
+        self.stats.add(db_queries=1, db_query_seconds=time.perf_counter() - start)
+        return matches
+
+    def _load_known_content(self, db_conn: sqlite3.Connection) -> KnownContent:
+        """
+        Load the state needed to scan a target against a known content database.
+        """
+        with self.stats.stage("known_content_loading"):
+            self._load_matchable_known_blocks(db_conn)
+            self._load_known_index(db_conn)
+        return KnownContent(
+            self.schema_version,
+            self.hash_algorithm,
+            self.num_shards,
+            self.block_filter,
+            self.num_hashed_blocks_in_known_cntnt,
+            self.common_hashes,
+            self.known_index,
+        )
+
+    def _load_matchable_known_blocks(self, db_conn: sqlite3.Connection) -> None:
+        """
+        Load the number of known blocks and the common hashes left out of it, which size the sample of a scan.
+        """
+        self._read_db_metadata(db_conn)
+        self._open_shards(db_conn)
+        self.num_hashed_blocks_in_known_cntnt = self._get_number_of_hashed_blocks(db_conn)
+        self._load_common_hashes(db_conn)
+
+    def _load_common_hashes(self, db_conn: sqlite3.Connection) -> None:
+        """
+        Load the known hashes shared by at least common_block_threshold blocks, which are not looked up.
+        """
+        threshold = self.block_filter.common_block_threshold
+        if threshold <= 0:
+            self.common_hashes = frozenset()
+            return
+        if self.shards is not None:
+            rows: Iterable[Tuple[bytes, int]] = self.shards.iter_common_rows()
+        else:
+            rows = db_conn.execute("SELECT hash, count FROM common_hashes")
+        self.common_hashes = frozenset(hash_value for hash_value, count in rows if count >= threshold)
+        if self.common_hashes:
+            print(
+                f"INFO: Skipping {len(self.common_hashes)} known hashes shared by {threshold} blocks or more"
+            )
+
+    def _num_matchable_known_blocks(self) -> int:
+        """
+        Known blocks a sampled target block can match, which leaves out the ones too common to be looked up.
+        """
+        return self.num_hashed_blocks_in_known_cntnt - len(self.common_hashes)
+
+    def _open_shards(self, db_conn: sqlite3.Connection) -> None:
+        """
+        Open the shards of a database split into several, unless they are open already.
+        """
+        if self.num_shards > 1 and self.shards is None:
+            self.shards = ShardSet.open(db_file_path(db_conn), self.num_shards)
+
+    def _close_shards(self) -> None:
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+
+    def _close_db_conn(self, db_conn: sqlite3.Connection) -> None:
+        self._close_shards()
+        db_conn.close()
+
+    def _load_known_index(self, db_conn: sqlite3.Connection) -> None:
+        """
+        Map the sidecar index of the known content if it has an up-to-date one, and otherwise load its hashes
+        into memory if an index memory limit is set.
+        """
+        self.known_index = KnownHashIndex.from_sidecar(db_file_path(db_conn), self.num_shards)
+        if self.known_index is not None:
+            print(f"INFO: Mapped the sidecar index of {self.num_hashed_blocks_in_known_cntnt} known hashes")
+            return
+        if self.index_memory_limit <= 0:
+            return
+        if self.shards is not None:
+            self.known_index = KnownHashIndex.from_hashes(
+                self.shards.iter_hashes(), self.num_hashed_blocks_in_known_cntnt, self.index_memory_limit
+            )
+        else:
+            self.known_index = KnownHashIndex.from_db(
+                db_conn, self.num_hashed_blocks_in_known_cntnt, self.index_memory_limit
+            )
+        if self.known_index is None:
+            print(
+                f"INFO: Index memory limit of {self.index_memory_limit} bytes is too small, using the DB only"
+            )
+        else:
+            print(f"INFO: Loaded an in-memory index of known hashes using {self.known_index.nbytes} bytes")
 
     def _get_number_of_hashed_blocks(self, db_conn: sqlite3.Connection) -> int:
         """
         Query the SQLite database to check if a given target hash exists.
         Returns a tuple of (found: bool, file_path: str, block_num: int).
         """
+        if self.shards is not None:
+            return self.shards.count()
         c = db_conn.cursor()
         c.execute("SELECT COUNT(*) FROM hashes")
         result = c.fetchone()
@@ -148,163 +689,889 @@ class SmallBlockForensicsModel:
         """
         Hash all blocks from a given file and store the hashes and file paths in the database.
         """
-        file_size = os.path.getsize(file_path)
-        num_blocks = (file_size + self.block_size - 1) // self.block_size
-
-        if file_size == 0:
-            return
+        self._store_hashes_in_db(
+            _iter_file_cells(
+                file_path,
+                self.block_size,
+                hash_algorithm=self.hash_algorithm,
+                stats=self.stats,
+                block_filter=self.block_filter,
+            ),
+            db_conn,
+        )
 
-        with open(file_path, "rb") as f:
-            cells: list[TableCell] = []
-            for block_num in range(num_blocks):
-                f.seek(block_num * self.block_size)
-                block = f.read(self.block_size)
+    def _hash_random_blocks_from_file(
+        self, file_path: Path, random_blocks: Iterable[int]
+    ) -> Iterator[Tuple[int, bytes]]:
+        """
+        Given a file and a list of random block offsets, hash those blocks.
+        Yields (block_num, block_hash) in the order of random_blocks, leaving out the low-information blocks
+        and the ones with a hash too common to be looked up.
+        The sampled blocks of a file are in ascending order, so the reads sweep it in a single direction, and
+        blocks close to each other are read with a single pread.
+        """
+        blocks_hashed = bytes_read = blocks_filtered = 0
+        hash_seconds = 0.0
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            num_blocks = (
+                _get_target_size(fd) + self.block_size - 1
+            ) // self.block_size  # Total blocks in the file
 
-                block_hash = self._hash_block(block)
-                cells.append(TableCell(str(file_path), block_num, block_hash))
+            # Skip block numbers that exceed the total blocks in this file
+            random_blocks = [block_num for block_num in random_blocks if block_num < num_blocks]
+            reads = list(iter_merged_reads(random_blocks, self.block_size))
+            _advise_random_reads(fd, reads, self.block_size)
 
-            self._store_hashes_in_db(cells, db_conn)
+            for run in reads:
+                # Read the run at its offset without moving the file position, and hash each of its samples
+                data = memoryview(
+                    os.pread(fd, (run[-1] - run[0] + 1) * self.block_size, run[0] * self.block_size)
+                )
+                bytes_read += len(data)
+                for block_num in run:
+                    offset = (block_num - run[0]) * self.block_size
+                    block = data[offset : offset + self.block_size]
+                    blocks_hashed += 1
+                    if self.block_filter.is_low_information(block):
+                        blocks_filtered += 1
+                        continue
+                    start = time.perf_counter()
+                    block_hash = self._hash_block(block)
+                    hash_seconds += time.perf_counter() - start
+                    if block_hash in self.common_hashes:
+                        blocks_filtered += 1
+                        continue
+                    yield block_num, block_hash
+        finally:
+            os.close(fd)
+            self.progress.add(blocks_hashed, bytes_read)
+            self.stats.add(
+                blocks_read=blocks_hashed,
+                bytes_read=bytes_read,
+                hash_seconds=hash_seconds,
+                blocks_filtered=blocks_filtered,
+            )
 
-    def _get_random_blocks_from_file(
-        self, file_path: Path, random_blocks: List[int], db_conn: sqlite3.Connection
-    ) -> Tuple[bool, str, int, int]:
+    def _find_first_match(
+        self, window: List[TableCell], db_conn: sqlite3.Connection
+    ) -> Optional[MyModelResponse]:
         """
-        Given a file and a list of random block offsets, hash those blocks and check the DB for matches.
-        If a match is found, return immediately with the True, file path, block_num_in_target, block_num_in_known_content
+        Resolve a window of hashed target blocks against the known content database, one query per
+        LOOKUP_BATCH_SIZE blocks.
+        Returns the response for the first match in sampling order, or None if nothing in the window matched.
         """
-        file_size = os.path.getsize(file_path)
-
-        if file_size == 0:
-            return False, "", -1, -1
+        for start in range(0, len(window), LOOKUP_BATCH_SIZE):
+            batch = window[start : start + LOOKUP_BATCH_SIZE]
+            matches = self._query_hashes_in_db(list({cell.hash_value for cell in batch}), db_conn)
+            for file_path, block_num_in_target, block_hash in batch:
+                if block_hash in matches:
+                    known_file_path, block_num_in_known_dataset = matches[block_hash]
+                    return MyModelResponse(
+                        found=True,
+                        target_file=str(file_path),
+                        known_dataset_file=known_file_path,
+                        block_num_in_target_file=block_num_in_target,
+                        block_num_in_known_dataset_file=block_num_in_known_dataset,
+                    )
+        return None
 
-        num_blocks = (file_size + self.block_size - 1) // self.block_size  # Total blocks in the file
-
-        with open(file_path, "rb") as f:
-            for block_num in random_blocks:
-                if block_num >= num_blocks:
-                    continue  # Skip if the block number exceeds the total blocks in this file
+    def _generate_file_block_map(self, directory: Path, min_file_size: int = 0) -> FileBlockMap:
+        """
+        The non-empty files of a directory and their number of blocks, leaving out those smaller than
+        min_file_size bytes. The directory is walked with num_io_threads threads, unless an unmodified listing
+        of it is cached in block_map_cache_dir.
+        """
+        listing = list_directory(directory, self.num_io_threads, self.block_map_cache_dir)
+        self.stats.add(files_visited=len(listing.file_paths))
+        file_paths, file_sizes = listing.file_paths, listing.file_sizes
+        if min_file_size > 0:
+            kept = [i for i, file_size in enumerate(file_sizes) if file_size >= min_file_size]
+            if len(kept) < len(file_paths):
+                print(
+                    f"INFO: Skipping {len(file_paths) - len(kept)} files smaller than the smallest known "
+                    f"file, of {min_file_size} bytes"
+                )
+                file_paths = [file_paths[i] for i in kept]
+                file_sizes = array("Q", (file_sizes[i] for i in kept))
 
-                # Move to the start of the block
-                f.seek(block_num * self.block_size)
+        # Calculate total number of blocks in all files
+        block_counts = array(
+            "Q", ((file_size + self.block_size - 1) // self.block_size for file_size in file_sizes)
+        )
+        total_blocks = sum(block_counts)
 
-                # Read the block and hash it
-                block = f.read(self.block_size)
-                block_hash = self._hash_block(block)
+        # Set the number of blocks parameter
+        self.num_random_blocks = self._calculate_num_random_blocks(
+            self._num_matchable_known_blocks(), total_blocks
+        )
 
-                # Check if this hash exists in the known content database
-                found, known_file_path, block_num_in_known_content = self._query_hash_in_db(
-                    block_hash, db_conn
-                )
-                if found:
-                    # Return the match immediately if found
-                    return True, known_file_path, block_num, block_num_in_known_content
+        print(f"INFO: {str(directory)} has a total of {total_blocks} blocks")
 
-        return False, "", -1, -1
+        return FileBlockMap(file_paths, block_counts, total_blocks)
 
-    def _generate_file_block_map(self, directory: Path) -> Tuple[List[Tuple[Path, int]], int]:
-        file_block_map = []
-        total_blocks = 0
+    def _generate_image_block_map(self, image_path: Path) -> FileBlockMap:
+        """
+        A raw disk image or block device is scanned as a single file, which covers its unallocated space too.
+        """
+        if self.block_size % SECTOR_SIZE:
+            raise ValueError(
+                f"Block size {self.block_size} must be a multiple of the {SECTOR_SIZE} byte sector size to scan "
+                "a raw image or block device"
+            )
 
-        # Calculate total number of blocks in all files
-        for file_path in directory.rglob("*"):
-            if file_path.is_file():
-                file_size = os.path.getsize(file_path)
-                if file_size == 0:
-                    continue
-                num_blocks_in_file = (file_size + self.block_size - 1) // self.block_size
-                file_block_map.append((file_path, num_blocks_in_file))
-                total_blocks += num_blocks_in_file
+        fd = os.open(image_path, os.O_RDONLY)
+        try:
+            image_size = _get_target_size(fd)
+        finally:
+            os.close(fd)
+        total_blocks = (image_size + self.block_size - 1) // self.block_size
+        self.stats.add(files_visited=1)
 
         # Set the number of blocks parameter
         self.num_random_blocks = self._calculate_num_random_blocks(
-            self.num_hashed_blocks_in_known_cntnt, total_blocks
+            self._num_matchable_known_blocks(), total_blocks
         )
 
-        print(f"INFO: {str(directory)} has a total of {total_blocks} blocks")
+        print(f"INFO: {str(image_path)} has a total of {total_blocks} blocks")
 
-        return file_block_map, total_blocks
+        if total_blocks == 0:
+            return FileBlockMap([], array("Q"), 0)
+        return FileBlockMap([str(image_path)], array("Q", [total_blocks]), total_blocks)
 
-    def _select_random_blocks(self, directory: Path) -> List[Tuple[Path, List[int]]]:
+    def _sample_block_indices(self, total_blocks: int) -> array:
         """
-        Select random blocks from all files in the directory.
-        Returns a list of tuples (file_path, block_indices).
+        The sorted global indices of num_random_blocks blocks drawn at random across all files.
         """
-        file_block_map, total_blocks = self._generate_file_block_map(directory)
-
         # Ensure we don't try to select more blocks than exist
         num_blocks_to_select = min(self.num_random_blocks, total_blocks)
+        self.progress.set_total_blocks(num_blocks_to_select)
+        return array("Q", sorted(random.sample(range(total_blocks), num_blocks_to_select)))
+
+    def _sample_more_block_indices(self, total_blocks: int, sampled: array, num_blocks: int) -> array:
+        """
+        The sorted global indices of up to num_blocks more blocks drawn at random among those not in the
+        sorted sampled indices.
+        """
+        num_blocks = min(num_blocks, total_blocks - len(sampled))
+        if num_blocks <= 0:
+            return array("Q")
+        if total_blocks - len(sampled) <= 2 * num_blocks:
+            # Few blocks are left, so they are drawn from the remaining ones rather than by rejection
+            remaining = sorted(set(range(total_blocks)).difference(sampled))
+            return array("Q", sorted(random.sample(remaining, num_blocks)))
+        new_indices: Set[int] = set()
+        while len(new_indices) < num_blocks:
+            i = random.randrange(total_blocks)
+            position = bisect_left(sampled, i)
+            if position == len(sampled) or sampled[position] != i:
+                new_indices.add(i)
+        return array("Q", sorted(new_indices))
+
+    def _select_random_blocks(
+        self, file_block_map: FileBlockMap, random_block_indices: Optional[array] = None
+    ) -> List[Tuple[Path, array]]:
+        """
+        Select random blocks from all files in the file block map, or the blocks at the given sorted global
+        indices.
+        Returns a list of tuples (file_path, block_indices), with the block indices local to each file.
+        """
+        file_paths, block_counts, total_blocks = file_block_map
 
         # Select random blocks globally across all files
-        random_block_indices = sorted(random.sample(range(total_blocks), num_blocks_to_select))
+        if random_block_indices is None:
+            random_block_indices = self._sample_block_indices(total_blocks)
+
+        # file_starts[i] is the global index of the first block of the i-th file
+        file_starts = array("Q", accumulate(block_counts, initial=0))
 
         selected_blocks = []
         current_block_index = 0
 
-        # Distribute random block indices across files
-        for file_path, num_blocks_in_file in file_block_map:
-            block_indices = []
-            while (
-                current_block_index < len(random_block_indices)
-                and random_block_indices[current_block_index] < num_blocks_in_file
-            ):
-                block_indices.append(random_block_indices[current_block_index])
-                current_block_index += 1
-
-            random_block_indices = [i - num_blocks_in_file for i in random_block_indices]  # Shift indices
+        # Distribute random block indices across files. Each file that holds a sample is located with a binary
+        # search over the prefix sums, and its samples are the run of indices below the start of the next file.
+        while current_block_index < len(random_block_indices):
+            file_index = bisect_right(file_starts, random_block_indices[current_block_index]) - 1
+            file_start, next_file_start = file_starts[file_index], file_starts[file_index + 1]
+            end_block_index = bisect_left(random_block_indices, next_file_start, lo=current_block_index)
 
-            if block_indices:
-                selected_blocks.append((file_path, block_indices))
+            block_indices = array(
+                "Q", (i - file_start for i in random_block_indices[current_block_index:end_block_index])
+            )
+            selected_blocks.append((Path(file_paths[file_index]), block_indices))
+            current_block_index = end_block_index
 
-        return selected_blocks
+        # The files are read in the order of their location on disk rather than in listing order
+        return order_by_location(selected_blocks, self.block_size)
 
-    def _hash_directory_random_blocks(self, directory: Path, db_conn: sqlite3.Connection) -> MyModelResponse:
+    def _hash_target_random_blocks(self, target: Path, db_conn: sqlite3.Connection) -> MyModelResponse:
         """
-        Hashes random blocks from all files in the directory, and checks the known content hashes in the DB.
+        Hashes random blocks from all files in the target directory, or from the target raw image or block
+        device, and checks the known content hashes in the DB.
         If a match is found, it returns immediately with the file path and hash.
+        Sampled blocks filtered as low-information do not count toward the number of samples, so as many
+        others are sampled in their place until none of them is filtered or the target has no blocks left.
+        With a checkpoint directory, the plan of the scan and how far it got are saved there, and a scan that
+        was interrupted resumes from them.
+        With adaptive sampling, target files smaller than every known file are not sampled, and against a DB
+        with a block filter the blocks are sampled in rounds instead, each of half the blocks still needed to
+        meet the target probability given the blocks filtered so far.
         """
-        print(f"INFO: Hashing random blocks from {str(directory)}")
-        random_blocks_info = self._select_random_blocks(directory)
+        print(f"INFO: Hashing random blocks from {str(target)}")
+        self.progress.start_stage("scanning target")
+        adaptive_rounds = self.adaptive_sampling and self.block_filter.enabled and self.target_probability < 1
+        min_file_size = self._min_known_file_size(db_conn) if self.adaptive_sampling else 0
+        file_block_map = self._generate_target_block_map(target, min_file_size)
+        total_blocks = file_block_map.total_blocks
+        checkpoint = self._open_scan_checkpoint(target, file_block_map, db_conn)
+        plan = checkpoint.load() if checkpoint is not None else None
+        with self.stats.stage("block_selection"):
+            if plan is None:
+                if adaptive_rounds:
+                    sampled = self._sample_more_block_indices(
+                        total_blocks, array("Q"), self._num_adaptive_random_blocks(total_blocks, 0, 0)
+                    )
+                    self.progress.set_total_blocks(len(sampled))
+                else:
+                    sampled = self._sample_block_indices(total_blocks)
+                random_blocks_info = self._select_random_blocks(file_block_map, sampled)
+                cursor = blocks_filtered_before_cursor = earlier_blocks_filtered = 0
+                if checkpoint is not None:
+                    checkpoint.save_plan(sampled, random_blocks_info)
+            else:
+                (
+                    sampled,
+                    random_blocks_info,
+                    cursor,
+                    blocks_filtered_before_cursor,
+                    earlier_blocks_filtered,
+                ) = plan
+                print(f"INFO: Resuming the scan of {str(target)} after {cursor} of its sampled blocks")
+                self.progress.set_total_blocks(len(sampled))
 
-        for file_path, random_blocks in tqdm(random_blocks_info, disable=IS_TEST_MODE):
-            (
-                found,
-                known_file_path,
-                block_num_in_target,
-                block_num_in_known_dataset,
-            ) = self._get_random_blocks_from_file(file_path, random_blocks, db_conn)
-            if found:
-                return MyModelResponse(
-                    found=True,
-                    target_file=str(file_path),
-                    known_dataset_file=known_file_path,
-                    block_num_in_target_file=block_num_in_target,
-                    block_num_in_known_dataset_file=block_num_in_known_dataset,
+        with self.stats.stage("target_scanning"):
+            blocks_filtered = self.stats.blocks_filtered - blocks_filtered_before_cursor
+            response = self._scan_planned_blocks(
+                random_blocks_info, cursor, blocks_filtered, db_conn, checkpoint
+            )
+            while not response.found:
+                blocks_filtered_in_round = self.stats.blocks_filtered - blocks_filtered
+                if adaptive_rounds:
+                    num_more = self._num_adaptive_random_blocks(
+                        total_blocks, len(sampled), earlier_blocks_filtered + blocks_filtered_in_round
+                    )
+                else:
+                    num_more = blocks_filtered_in_round
+                more = self._sample_more_block_indices(total_blocks, sampled, num_more)
+                if not more:
+                    break
+                if adaptive_rounds:
+                    print(f"INFO: Sampling {len(more)} more blocks to meet the target probability")
+                else:
+                    print(f"INFO: Sampling {len(more)} more blocks in place of the low-information ones")
+                sampled = array("Q", sorted(chain(sampled, more)))
+                self.progress.set_total_blocks(len(sampled))
+                random_blocks_info = self._select_random_blocks(file_block_map, more)
+                earlier_blocks_filtered += blocks_filtered_in_round
+                if checkpoint is not None:
+                    checkpoint.save_plan(sampled, random_blocks_info, earlier_blocks_filtered)
+                blocks_filtered = self.stats.blocks_filtered
+                response = self._scan_planned_blocks(
+                    random_blocks_info, 0, blocks_filtered, db_conn, checkpoint
+                )
+        if adaptive_rounds and not response.found:
+            print(f"INFO: Met the target probability after sampling {len(sampled)} of {total_blocks} blocks")
+        if checkpoint is not None:
+            checkpoint.remove()
+        return response
+
+    def _num_adaptive_random_blocks(self, total_blocks: int, num_sampled: int, num_filtered: int) -> int:
+        """
+        How many more blocks an adaptive scan samples once num_sampled blocks were resolved without a match,
+        num_filtered of them filtered, or 0 once the target probability is met.
+        Filtered blocks cannot match, so the known content is among the blocks of the target that are not
+        filtered. The sampled blocks are a uniform sample of the target, so the share of them that was
+        filtered bounds how many blocks are left, with a Hoeffding bound that may fail with
+        ADAPTIVE_ESTIMATE_RISK of the miss probability. That risk is spread over the rounds, round k having
+        sampled at least k * ADAPTIVE_MIN_ROUND_SIZE blocks.
+        """
+        max_miss_probability = 1 - self.target_probability
+        blocks_left = total_blocks - num_filtered
+        if num_sampled > 0:
+            risk = (
+                max_miss_probability
+                * ADAPTIVE_ESTIMATE_RISK
+                * 6
+                / pi**2
+                * (ADAPTIVE_MIN_ROUND_SIZE / max(num_sampled, ADAPTIVE_MIN_ROUND_SIZE)) ** 2
+            )
+            filtered_share = num_filtered / num_sampled - sqrt(log(1 / risk) / (2 * num_sampled))
+            blocks_left = min(blocks_left, total_blocks - floor(filtered_share * total_blocks))
+        num_needed = self._calculate_num_random_blocks(
+            self._num_matchable_known_blocks(),
+            blocks_left,
+            max_miss_probability * (1 - ADAPTIVE_ESTIMATE_RISK),
+        ) - (num_sampled - num_filtered)
+        if num_needed <= 0:
+            return 0
+        return max((num_needed + 1) // 2, ADAPTIVE_MIN_ROUND_SIZE)
+
+    def _min_known_file_size(self, db_conn: sqlite3.Connection) -> int:
+        """
+        Size in bytes of the smallest non-empty known file, or 0 if the DB does not record the size of every
+        known file, as with databases built before the manifest.
+        """
+        if self.schema_version < 2:
+            return 0
+        try:
+            min_size, num_files, num_recorded = db_conn.execute(
+                """SELECT MIN(CASE WHEN manifest.size > 0 THEN manifest.size END), COUNT(*),
+                COUNT(manifest.file_id) FROM files LEFT JOIN manifest ON manifest.file_id = files.id"""
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return 0  # Built before the manifest was introduced
+        return (min_size or 0) if num_recorded == num_files else 0
+
+    def _open_scan_checkpoint(
+        self, target: Path, file_block_map: FileBlockMap, db_conn: sqlite3.Connection
+    ) -> Optional[ScanCheckpoint]:
+        """
+        The checkpoint of the scan of a target against the opened known content DB, if a checkpoint directory
+        is set. A saved plan is only resumed if the target and the known content still have as many blocks.
+        """
+        if self.checkpoint_dir is None:
+            return None
+        signature = (
+            f"{self.block_size}:{file_block_map.total_blocks}:{self.num_random_blocks}:"
+            f"{self.hash_algorithm}:{self.num_hashed_blocks_in_known_cntnt}:{int(self.adaptive_sampling)}"
+        )
+        return ScanCheckpoint(self.checkpoint_dir, target, db_file_path(db_conn), signature)
+
+    def _scan_planned_blocks(
+        self,
+        random_blocks_info: List[Tuple[Path, array]],
+        cursor: int,
+        blocks_filtered: int,
+        db_conn: sqlite3.Connection,
+        checkpoint: Optional[ScanCheckpoint],
+    ) -> MyModelResponse:
+        """
+        Scan the blocks of a round of the plan after its cursor, and move the cursor of the checkpoint forward
+        as they are resolved. blocks_filtered is the value of the counter of filtered blocks at the start of
+        the round.
+        """
+
+        def save_cursor(num_blocks_resolved: int) -> None:
+            if checkpoint is not None:
+                checkpoint.save_cursor(
+                    cursor + num_blocks_resolved, self.stats.blocks_filtered - blocks_filtered
                 )
 
-        return MyModelResponse(found=False)
+        return self._scan_random_blocks(
+            skip_planned_blocks(random_blocks_info, cursor), db_conn, on_resolved=save_cursor
+        )
 
-    def hash_directory(self, directory: Path, out_sql_path: Path) -> None:
+    def _plan_random_blocks(self, target: Path) -> List[Tuple[Path, array]]:
+        """
+        List the target directory, or size the target raw image or block device, and select the blocks to
+        sample from it. The number of hashed blocks of the known content must be set.
+        """
+        print(f"INFO: Hashing random blocks from {str(target)}")
+        self.progress.start_stage("scanning target")
+        file_block_map = self._generate_target_block_map(target)
+        with self.stats.stage("block_selection"):
+            return self._select_random_blocks(file_block_map)
+
+    def _generate_target_block_map(self, target: Path, min_file_size: int = 0) -> FileBlockMap:
+        """
+        The block map of a target directory, without its files smaller than min_file_size bytes, or of a
+        target raw image or block device.
+        """
+        with self.stats.stage("target_listing"):
+            if target.is_dir():
+                return self._generate_file_block_map(target, min_file_size)
+            return self._generate_image_block_map(target)
+
+    def _scan_random_blocks(
+        self,
+        random_blocks_info: List[Tuple[Path, array]],
+        db_conn: sqlite3.Connection,
+        show_progress_bar: bool = True,
+        on_resolved: Optional[Callable[[int], None]] = None,
+    ) -> MyModelResponse:
+        """
+        Hash the selected blocks of the target and check them against the known content hashes in the DB,
+        returning as soon as one matches. Each time a window of blocks is resolved without a match,
+        on_resolved is called, if given, with the number of selected blocks resolved so far.
+        """
+        # Sampled blocks are read and hashed by a pool of threads while this thread resolves them against the DB
+        # in windows of LOOKUP_BATCH_SIZE. Results are consumed in sampling order, so the first match reported
+        # is the same as with a sequential scan.
+        window: List[TableCell] = []
+        # Selected blocks of the tasks in the window, and of all the tasks resolved before it
+        window_blocks = blocks_resolved = 0
+        task_sizes = (
+            len(random_blocks) for _, random_blocks in self._iter_random_block_tasks(random_blocks_info)
+        )
+        with closing(self._hash_random_blocks_pipelined(random_blocks_info)) as hashed_blocks:
+            for cells, task_size in zip(
+                tqdm(hashed_blocks, disable=IS_TEST_MODE or not show_progress_bar), task_sizes
+            ):
+                self.progress.check_cancelled()
+                window.extend(cells)
+                window_blocks += task_size
+                if len(window) < LOOKUP_BATCH_SIZE:
+                    continue
+                response = self._find_first_match(window, db_conn)
+                if response:
+                    return response
+                window.clear()
+                blocks_resolved += window_blocks
+                window_blocks = 0
+                if on_resolved is not None:
+                    on_resolved(blocks_resolved)
+
+        return self._find_first_match(window, db_conn) or MyModelResponse(found=False)
+
+    def _hash_random_blocks_pipelined(
+        self, random_blocks_info: List[Tuple[Path, array]]
+    ) -> Generator[List[TableCell], None, None]:
+        """
+        Read and hash the sampled blocks in a pool of num_io_threads threads, hashlib releases the GIL while
+        it hashes a block so reads and hashing overlap with each other and with the DB lookups of the caller.
+        Each task covers at most LOOKUP_BATCH_SIZE blocks of a single file, and at most four tasks per thread
+        are in flight, so memory stays bounded. Yields the hashed blocks of each task in sampling order.
+        Closing the generator, e.g. once a match is found, cancels the tasks that have not finished yet.
+        """
+        return self._run_hash_tasks_pipelined(
+            (self._hash_random_blocks_task, task)
+            for task in self._iter_random_block_tasks(random_blocks_info)
+        )
+
+    def _iter_random_block_tasks(
+        self, random_blocks_info: List[Tuple[Path, array]]
+    ) -> Iterator[Tuple[Path, array]]:
+        """
+        Split the selected blocks into (file_path, block_nums) tasks of at most LOOKUP_BATCH_SIZE blocks.
+        """
+        for file_path, random_blocks in random_blocks_info:
+            for start in range(0, len(random_blocks), LOOKUP_BATCH_SIZE):
+                yield file_path, random_blocks[start : start + LOOKUP_BATCH_SIZE]
+
+    def _run_hash_tasks_pipelined(
+        self, tasks: Iterable[Tuple[Callable[..., List[TableCell]], tuple]]
+    ) -> Generator[List[TableCell], None, None]:
+        """
+        Run (task, args) hashing tasks in a pool of num_io_threads threads with at most four tasks per thread
+        in flight, and yield their results in order. Each task is called with its args and an event that is
+        set once the generator is closed, at which point the tasks that have not started are cancelled.
+        """
+        cancelled = threading.Event()
+        max_in_flight = 4 * self.num_io_threads
+        with ThreadPoolExecutor(self.num_io_threads) as executor:
+            in_flight: Deque[Future] = deque()
+            try:
+                for task, args in tasks:
+                    in_flight.append(executor.submit(task, *args, cancelled))
+                    if len(in_flight) >= max_in_flight:
+                        yield in_flight.popleft().result()
+                while in_flight:
+                    yield in_flight.popleft().result()
+            finally:
+                cancelled.set()
+                for future in in_flight:
+                    future.cancel()
+
+    def _hash_random_blocks_task(
+        self, file_path: Path, random_blocks: Iterable[int], cancelled: threading.Event
+    ) -> List[TableCell]:
+        cells = []
+        for block_num, block_hash in self._hash_random_blocks_from_file(file_path, random_blocks):
+            if cancelled.is_set():
+                break
+            cells.append(TableCell(file_path, block_num, block_hash))
+        return cells
+
+    def _hash_target_all_blocks(
+        self, target: Path, db_conn: sqlite3.Connection
+    ) -> Generator[TargetFileMatches, None, None]:
+        """
+        Hashes every block of every file in the target directory, or of the target raw image or block device,
+        and yields the matches of each file in turn.
+        Files are read sequentially in segments of EXHAUSTIVE_SEGMENT_SIZE bytes by a pool of threads, while this
+        thread resolves the hashes against the DB in batches of LOOKUP_BATCH_SIZE.
+        """
+        print(f"INFO: Hashing all blocks of {str(target)}")
+        file_block_map = self._generate_target_block_map(target)
+        self.progress.start_stage("scanning target", file_block_map.total_blocks)
+
+        segment_blocks = max(1, EXHAUSTIVE_SEGMENT_SIZE // self.block_size)
+        tasks = (
+            (self._hash_file_segment_task, (file_path, start_block, segment_blocks))
+            for file_path, num_blocks in zip(file_block_map.file_paths, file_block_map.block_counts)
+            for start_block in range(0, num_blocks, segment_blocks)
+        )
+        with self.stats.stage("target_scanning"), closing(
+            self._run_hash_tasks_pipelined(tasks)
+        ) as hashed_blocks:
+            resolved_blocks = self._resolve_hashed_blocks(hashed_blocks, db_conn)
+            for file_path, file_blocks in groupby(
+                resolved_blocks, key=lambda resolved: resolved[0].file_path
+            ):
+                file_matches = TargetFileMatches(file_path)
+                for cell, match in file_blocks:
+                    file_matches.add_block(cell.block_num, match)
+                yield file_matches
+
+    def _resolve_hashed_blocks(
+        self, hashed_blocks: Iterable[List[TableCell]], db_conn: sqlite3.Connection
+    ) -> Iterator[Tuple[TableCell, Optional[Tuple[str, int]]]]:
+        """
+        Look up hashed blocks in the known content DB in batches of LOOKUP_BATCH_SIZE, and yield each block in
+        order with the (known_file_path, block_num) it matched, or None. Filtered blocks have no hash and are
+        not looked up.
+        """
+        window: List[TableCell] = []
+        for cells in hashed_blocks:
+            self.progress.check_cancelled()
+            window.extend(cells)
+            while len(window) >= LOOKUP_BATCH_SIZE:
+                batch, window = window[:LOOKUP_BATCH_SIZE], window[LOOKUP_BATCH_SIZE:]
+                matches = self._query_hashes_in_db(_lookup_hashes(batch), db_conn)
+                for cell in batch:
+                    yield cell, matches.get(cell.hash_value)
+        matches = self._query_hashes_in_db(_lookup_hashes(window), db_conn)
+        for cell in window:
+            yield cell, matches.get(cell.hash_value)
+
+    def _hash_file_segment_task(
+        self, file_path: str, start_block: int, max_blocks: int, cancelled: threading.Event
+    ) -> List[TableCell]:
+        """
+        Read a segment of a file sequentially and hash each of its blocks. Low-information blocks are kept
+        with no hash, so that they still count as blocks of the file.
+        """
+        cells = []
+        bytes_read = blocks_filtered = 0
+        hash_seconds = 0.0
+        for block_num, block in iter_file_blocks(Path(file_path), self.block_size, start_block, max_blocks):
+            if cancelled.is_set():
+                break
+            bytes_read += len(block)
+            if self.block_filter.is_low_information(block):
+                blocks_filtered += 1
+                cells.append(TableCell(file_path, block_num, None))
+                continue
+            start = time.perf_counter()
+            block_hash = self._hash_block(block)
+            hash_seconds += time.perf_counter() - start
+            cells.append(TableCell(file_path, block_num, block_hash))
+        self.progress.add(len(cells), bytes_read)
+        self.stats.add(
+            blocks_read=len(cells),
+            bytes_read=bytes_read,
+            hash_seconds=hash_seconds,
+            blocks_filtered=blocks_filtered,
+        )
+        return cells
+
+    def hash_directory(self, directory: Path, out_sql_path: Path, incremental: bool = False) -> None:
         _ensure_output_file_path(out_sql_path)
         db_conn = self._get_db_conn(out_sql_path)
 
         # Fully hash the known content directory and store hashes in the output directory's database
-        self._hash_directory(directory, db_conn, out_sql_path)
-        db_conn.close()
+        self._hash_directory(directory, db_conn, out_sql_path, incremental)
+        self._close_db_conn(db_conn)
 
-    def _hash_directory(self, directory: Path, db_conn: sqlite3.Connection, out_path: Path) -> None:
+    def _hash_directory(
+        self, directory: Path, db_conn: sqlite3.Connection, out_path: Path, incremental: bool = False
+    ) -> None:
         """
         Fully hashes all blocks of files in the given directory and stores the results in the database.
+        With incremental set, only files that were added or changed since the last build are hashed, and the
+        rows of deleted files are removed. A build from the same directory that was interrupted is resumed
+        from its last checkpoint the same way.
         """
+        if not incremental and read_build_in_progress(db_conn) == str(directory):
+            print(f"INFO: Resuming the interrupted build of {out_path}")
+            incremental = True
         print(f"INFO: Hashing all files in {str(directory)}")
-        for file_path in tqdm(directory.rglob("*"), desc="      Hash Progress: ", disable=IS_TEST_MODE):
-            if file_path.is_file() and file_path.name != ".DS_Store":
-                self._hash_all_blocks_in_file(file_path, db_conn)
+        with self.stats.stage("known_content_hashing"):
+            self._hash_known_files(directory, db_conn, out_path, incremental)
         print(f"INFO: Successfully processed {str(directory)}")
         print(f"INFO: Stored hashes at {out_path}")
 
+    def _hash_known_files(
+        self, directory: Path, db_conn: sqlite3.Connection, out_path: Path, incremental: bool
+    ) -> None:
+        if self.schema_version == 0:
+            remove_shards(out_path)  # Left over from an earlier DB at the same path
+            create_schema(db_conn, self.hash_algorithm, self.num_shards, self.block_filter)
+            self.schema_version = SCHEMA_VERSION
+        if self.schema_version == 1:
+            if incremental:
+                raise ValueError(
+                    f"{out_path} uses schema version 1, which does not support incremental builds"
+                )
+        else:
+            create_manifest_table(db_conn)
+            create_duplicate_hashes_table(db_conn)
+        for pragma in BULK_LOAD_PRAGMAS:
+            db_conn.execute(pragma)
+        interrupted = read_build_in_progress(db_conn) is not None
+        if self.schema_version != 1:
+            set_build_in_progress(db_conn, str(directory))
+
+        if self.num_shards == 1:
+            self._store_known_files(directory, db_conn, incremental)
+        else:
+            # The hashes are written by one process per shard, and only the files and the manifest here
+            try:
+                with ShardWriters(
+                    out_path,
+                    self.num_shards,
+                    self.hash_algorithm,
+                    self.block_filter.common_block_threshold > 0,
+                ) as self.shard_writers:
+                    if interrupted:
+                        # Hashes committed to the shards after the last checkpoint belong to files that were
+                        # not, whose ids are above those of every committed file
+                        c = db_conn.execute("SELECT COALESCE(MAX(id), 0) FROM files")
+                        self.shard_writers.delete_file_ids_above(c.fetchone()[0])
+                    self._store_known_files(directory, db_conn, incremental)
+            finally:
+                self.shard_writers = None
+        if self.schema_version != 1:
+            set_build_in_progress(db_conn, None)
+        db_conn.commit()
+        for pragma in END_BULK_LOAD_PRAGMAS:
+            db_conn.execute(pragma)
+
+    def _is_interrupted_build(self, db_path: Path, directory: Path) -> bool:
+        """
+        Whether a database is left over from a build from the directory that did not complete.
+        """
+        try:
+            with closing(sqlite3.connect(db_path)) as db_conn:
+                return read_build_in_progress(db_conn) == str(directory)
+        except sqlite3.DatabaseError:
+            return False
+
+    def _checkpoint(self, db_conn: sqlite3.Connection) -> None:
+        """
+        Commit the known content stored so far, so that a build that is interrupted can be resumed from here.
+        The shards commit first, so the manifest never lists a file whose hashes are not committed.
+        """
+        if self.shard_writers is not None:
+            self.shard_writers.commit()
+        db_conn.commit()
+        self._last_checkpoint = time.monotonic()
+
+    def _maybe_checkpoint(self, db_conn: sqlite3.Connection) -> None:
+        if time.monotonic() - self._last_checkpoint >= CHECKPOINT_INTERVAL:
+            self._checkpoint(db_conn)
+
+    def _store_known_files(self, directory: Path, db_conn: sqlite3.Connection, incremental: bool) -> None:
+        known_files: List[KnownFile] = list(self._iter_known_files(directory))
+        self.stats.add(files_visited=len(known_files))
+        if incremental:
+            known_files = self._remove_stale_files(directory, known_files, db_conn)
+        # Deleted files are committed before new ones are added, so the ids of the files added after a
+        # checkpoint are always above those of the committed files
+        self._checkpoint(db_conn)
+        self.progress.start_stage(
+            "hashing known content",
+            sum((f.stat.st_size + self.block_size - 1) // self.block_size for f in known_files),
+        )
+
+        if self.num_workers > 1:
+            self._hash_files_parallel(known_files, db_conn)
+        else:
+            for file_path, file_stat in tqdm(known_files, desc="      Hash Progress: ", disable=IS_TEST_MODE):
+                self._hash_all_blocks_in_file(file_path, db_conn)
+                self._record_file_in_manifest(file_path, file_stat, db_conn)
+                self.progress.add(0, file_stat.st_size)
+                self.stats.add(bytes_read=file_stat.st_size)
+                self._maybe_checkpoint(db_conn)
+
+    def _iter_known_files(self, directory: Path) -> Iterator[KnownFile]:
+        for file_path in directory.rglob("*"):
+            if file_path.is_file() and file_path.name != ".DS_Store":
+                yield KnownFile(file_path, file_path.stat())
+
+    def _file_signature(self, file_stat: os.stat_result) -> Tuple[int, int, int, int]:
+        """
+        The manifest entry of a file. The file is rehashed by an incremental build if any of these change.
+        """
+        return file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, self.block_size
+
+    def _record_file_in_manifest(
+        self, file_path: Path, file_stat: os.stat_result, db_conn: sqlite3.Connection
+    ):
+        """
+        Record the stat of a file whose blocks have been stored. The stat is taken before the file is hashed, so
+        a file modified while it is being hashed is picked up again by the next incremental build.
+        """
+        if self.schema_version == 1:
+            return
+        db_conn.execute(
+            "INSERT OR REPLACE INTO manifest (file_id, size, mtime_ns, inode, block_size) VALUES (?, ?, ?, ?, ?)",
+            (self._get_file_id(str(file_path), db_conn), *self._file_signature(file_stat)),
+        )
+
+    def _remove_stale_files(
+        self, directory: Path, known_files: Iterable[KnownFile], db_conn: sqlite3.Connection
+    ) -> List[KnownFile]:
+        """
+        Compare the files in the directory against the manifest of the database.
+        Rows of files that changed or no longer exist are deleted, and the files that need to be hashed are
+        returned. A hash owned by a deleted block passes to another file that holds it, but the counts of
+        common hashes are not decreased for the deleted rows.
+        Paths are compared resolved, so the directory may be spelled differently than in the last build, and
+        a changed file is rehashed under the path it was stored with.
+        """
+        c = db_conn.cursor()
+        c.execute(
+            """SELECT files.id, files.path, manifest.size, manifest.mtime_ns, manifest.inode, manifest.block_size
+            FROM files LEFT JOIN manifest ON manifest.file_id = files.id"""
+        )
+        directory = directory.resolve()
+        manifest: Dict[Path, Tuple[int, str, tuple]] = {}
+        for file_id, path, *signature in c.fetchall():
+            resolved_path = Path(path).resolve()
+            if resolved_path.is_relative_to(directory):
+                manifest[resolved_path] = (file_id, path, tuple(signature))
+
+        files_to_hash = []
+        changed_file_ids = []
+        for known_file in known_files:
+            entry = manifest.pop(known_file.path.resolve(), None)
+            if entry is None:
+                files_to_hash.append(known_file)
+            elif entry[2] != self._file_signature(known_file.stat):
+                files_to_hash.append(KnownFile(Path(entry[1]), known_file.stat))
+                changed_file_ids.append(entry[0])
+        deleted_file_ids = [file_id for file_id, _, _ in manifest.values()]
+
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS stale_files (id INTEGER PRIMARY KEY)")
+        c.execute("DELETE FROM temp.stale_files")
+        c.executemany("INSERT INTO temp.stale_files (id) VALUES (?)", ((i,) for i in changed_file_ids))
+        c.executemany("INSERT INTO temp.stale_files (id) VALUES (?)", ((i,) for i in deleted_file_ids))
+        if self.shard_writers is not None:
+            self.shard_writers.delete_files(changed_file_ids + deleted_file_ids)
+        else:
+            delete_file_hash_rows(db_conn, "file_id IN (SELECT id FROM temp.stale_files)")
+        c.execute("DELETE FROM manifest WHERE file_id IN (SELECT id FROM temp.stale_files)")
+        c.executemany("DELETE FROM files WHERE id = ?", ((i,) for i in deleted_file_ids))
+
+        print(
+            f"INFO: {len(files_to_hash) - len(changed_file_ids)} added, {len(changed_file_ids)} changed and "
+            f"{len(deleted_file_ids)} deleted files since the last build"
+        )
+        return files_to_hash
+
+    def _hash_files_parallel(self, known_files: Iterable[KnownFile], db_conn: sqlite3.Connection) -> None:
+        """
+        Hash files in a pool of worker processes while this process is the single writer to the database.
+        Each task hashes a segment of at most INSERT_CHUNK_SIZE blocks of a file, and at most two tasks per
+        worker are in flight, so memory stays bounded however large the files are.
+        Results are consumed in submission order, so INSERT OR IGNORE keeps the same owner for a duplicated
+        block as the serial path and the resulting database is identical.
+        """
+        max_in_flight = 2 * self.num_workers
+        with Pool(self.num_workers) as pool:
+            # Each task is paired with its file once it is the last segment of that file
+            in_flight: Deque[Tuple[AsyncResult, Optional[KnownFile]]] = deque()
+            for segment, completed_file in tqdm(
+                self._iter_file_segments(known_files), desc="      Hash Progress: ", disable=IS_TEST_MODE
+            ):
+                in_flight.append((pool.apply_async(_hash_file_segment, segment), completed_file))
+                if len(in_flight) >= max_in_flight:
+                    self._store_segment_in_db(*in_flight.popleft(), db_conn)
+            while in_flight:
+                self._store_segment_in_db(*in_flight.popleft(), db_conn)
+
+    def _store_segment_in_db(
+        self, result: AsyncResult, completed_file: Optional[KnownFile], db_conn: sqlite3.Connection
+    ) -> None:
+        cells, hash_seconds, blocks_filtered = result.get()
+        self.stats.add(hash_seconds=hash_seconds, blocks_filtered=blocks_filtered)
+        self._store_hashes_in_db(cells, db_conn)
+        if completed_file is not None:
+            self._record_file_in_manifest(completed_file.path, completed_file.stat, db_conn)
+            self.progress.add(0, completed_file.stat.st_size)
+            self.stats.add(bytes_read=completed_file.stat.st_size)
+            self._maybe_checkpoint(db_conn)
+
+    def _iter_file_segments(
+        self, known_files: Iterable[KnownFile]
+    ) -> Iterator[Tuple[Tuple[Path, int, int, Optional[int], str, BlockFilter], Optional[KnownFile]]]:
+        """
+        Split files into (file_path, block_size, start_block, max_blocks, hash_algorithm, block_filter)
+        segments of INSERT_CHUNK_SIZE blocks.
+        The last segment of a file is open ended, so blocks appended while it is hashed are not lost, and is
+        yielded along with its file.
+        """
+        for known_file in known_files:
+            num_blocks = (known_file.stat.st_size + self.block_size - 1) // self.block_size
+            start_block = 0
+            while start_block + INSERT_CHUNK_SIZE < num_blocks:
+                yield (
+                    known_file.path,
+                    self.block_size,
+                    start_block,
+                    INSERT_CHUNK_SIZE,
+                    self.hash_algorithm,
+                    self.block_filter,
+                ), None
+                start_block += INSERT_CHUNK_SIZE
+            yield (
+                known_file.path,
+                self.block_size,
+                start_block,
+                None,
+                self.hash_algorithm,
+                self.block_filter,
+            ), known_file
+
     def _generate_db_filename(self, output_directory: Path):
         # return output_directory / f"known_content_hashes_{str(uuid4())[:8]}.sqlite"
         return output_directory / "known_content_hashes.sqlite"
 
-    def _get_db_conn(self, db_path: Path):
-        return sqlite3.connect(db_path)
+    def _get_db_conn(self, db_path: Path, read_only: bool = False):
+        if read_only:
+            db_conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+        else:
+            db_conn = sqlite3.connect(db_path)
+        self._read_db_metadata(db_conn)
+        return db_conn
+
+    def _read_db_metadata(self, db_conn: sqlite3.Connection) -> None:
+        """
+        Read the schema version of an opened database. An existing database also sets the hash algorithm and
+        the block filter, so that blocks are always hashed and filtered the same way as the known content it
+        holds.
+        """
+        self.schema_version = read_schema_version(db_conn)
+        if self.schema_version == 0:
+            return
+        num_shards = read_num_shards(db_conn)
+        if num_shards != self.num_shards:
+            if self.num_shards != 1:
+                print(f"INFO: Using the {num_shards} shards of the database instead of {self.num_shards}")
+            self.num_shards = num_shards
+        hash_algorithm = read_hash_algorithm(db_conn)
+        if hash_algorithm != self.hash_algorithm:
+            print(
+                f"INFO: Using the {hash_algorithm} hash algorithm of the database instead of {self.hash_algorithm}"
+            )
+            self.hash_algorithm = hash_algorithm
+            self._hash_function = get_hash_function(hash_algorithm)
+        block_filter = read_block_filter(db_conn)
+        if block_filter != self.block_filter:
+            if self.block_filter.enabled:
+                print(
+                    f"INFO: Using the block filter of the database {block_filter} instead of "
+                    f"{self.block_filter}"
+                )
+            self.block_filter = block_filter
@@ -0,0 +1,80 @@
+import threading
+import time
+from typing import Optional
+
+
+class ScanCancelled(Exception):
+    """
+    Raised inside the model when the scan it is running has been cancelled.
+    """
+
+
+class ScanProgress:
+    """
+    Progress of the current stage of a model run, shared between the thread running the model and the threads
+    reporting on it. A run has up to two stages: hashing the known content, and scanning the target.
+    Counters are only updated by the model, under a lock since the target scan hashes blocks on several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self.stage = "queued"
+        self.stage_started_at = time.monotonic()
+        self.total_blocks = 0  # blocks the current stage is expected to hash, 0 if unknown
+        self.blocks_hashed = 0
+        self.bytes_read = 0
+
+    def start_stage(self, stage: str, total_blocks: int = 0) -> None:
+        with self._lock:
+            self.stage = stage
+            self.stage_started_at = time.monotonic()
+            self.total_blocks = total_blocks
+            self.blocks_hashed = 0
+            self.bytes_read = 0
+
+    def set_total_blocks(self, total_blocks: int) -> None:
+        with self._lock:
+            self.total_blocks = total_blocks
+
+    def add(self, blocks_hashed: int, bytes_read: int) -> None:
+        with self._lock:
+            self.blocks_hashed += blocks_hashed
+            self.bytes_read += bytes_read
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check_cancelled(self) -> None:
+        """
+        Called by the model at points where it can stop cleanly.
+        """
+        if self._cancelled.is_set():
+            raise ScanCancelled()
+
+    def eta_seconds(self) -> Optional[float]:
+        """
+        Estimated time left in the current stage, extrapolated from its hashing rate so far.
+        """
+        with self._lock:
+            if not self.total_blocks or not self.blocks_hashed:
+                return None
+            elapsed = time.monotonic() - self.stage_started_at
+            remaining_blocks = max(self.total_blocks - self.blocks_hashed, 0)
+            return elapsed * remaining_blocks / self.blocks_hashed
+
+    def to_dict(self) -> dict:
+        eta_seconds = self.eta_seconds()
+        with self._lock:
+            return {
+                "stage": self.stage,
+                "blocks_hashed": self.blocks_hashed,
+                "total_blocks": self.total_blocks,
+                "bytes_read": self.bytes_read,
+                "stage_elapsed_seconds": round(time.monotonic() - self.stage_started_at, 3),
+                "eta_seconds": None if eta_seconds is None else round(eta_seconds, 3),
+            }
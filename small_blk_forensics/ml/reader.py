@@ -0,0 +1,48 @@
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+# Size of the sequential reads used to walk a file block by block. Rounded down to a multiple of the block size.
+READ_BUFFER_SIZE = 1 << 20
+
+
+def iter_file_blocks(
+    file_path: Path, block_size: int, start_block: int = 0, max_blocks: Optional[int] = None
+) -> Iterator[Tuple[int, memoryview]]:
+    """
+    Yields (block_num, block) for every block of a file, the last block being shorter if the file size is not
+    a multiple of the block size. Passing start_block and max_blocks restricts this to a segment of the file.
+
+    The file is read sequentially in large chunks into a single reused buffer, and each block is a zero-copy
+    memoryview into that buffer. A block is only valid until the next one is requested, so it must be consumed
+    (e.g. hashed) straight away.
+
+    The file is read until EOF rather than up to the size it had when it was opened, so a file that grows or
+    shrinks during the scan yields the blocks it actually contains instead of failing or padding.
+    """
+    buffer_blocks = max(1, READ_BUFFER_SIZE // block_size)
+    if max_blocks is not None:
+        buffer_blocks = max(1, min(buffer_blocks, max_blocks))
+    buffer = bytearray(buffer_blocks * block_size)
+    view = memoryview(buffer)
+    block_num = start_block
+    end_block = None if max_blocks is None else start_block + max_blocks
+
+    with open(file_path, "rb", buffering=0) as f:
+        f.seek(start_block * block_size)
+        while True:
+            # Fill the buffer, a single readinto may return less than requested before EOF
+            filled = 0
+            while filled < len(buffer):
+                n = f.readinto(view[filled:])
+                if not n:
+                    break
+                filled += n
+
+            for offset in range(0, filled, block_size):
+                if block_num == end_block:
+                    return
+                yield block_num, view[offset : min(offset + block_size, filled)]
+                block_num += 1
+
+            if filled < len(buffer):
+                return
@@ -0,0 +1,103 @@
+import os
+import struct
+from array import array
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where files are ordered by inode only
+    fcntl = None  # type: ignore
+
+# Sampled blocks of a file this close to each other are read with a single pread, reading the gap along with
+# them. Transferring that many bytes costs less than a seek on a spinning disk or a round trip to a network
+# mount.
+READ_MERGE_GAP = 64 * 1024
+
+# Largest single read of merged sampled blocks, which bounds the memory held by each reading thread
+MAX_MERGED_READ_SIZE = 1 << 20
+
+# ioctl of Linux that maps the logical extents of a file to physical ones, see linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_HEADER = struct.Struct("=QQIIII")  # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count
+_FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")  # fe_logical, fe_physical, fe_length, reserved, fe_flags
+# FIEMAP_EXTENT_UNKNOWN and FIEMAP_EXTENT_DELALLOC, the physical location of the extent is not known yet
+_FIEMAP_EXTENT_UNKNOWN = 0x2 | 0x4
+
+# (st_dev, has no physical location, physical offset, st_ino, logical offset) of the first sampled block of a
+# file
+LocationKey = Tuple[int, bool, int, int, int]
+
+
+def physical_offset(fd: int, offset: int) -> Optional[int]:
+    """
+    The offset on its device of the byte at the given offset of an open file, or None if the file system does
+    not map it, as with tmpfs and most network file systems, or the byte is in a hole.
+    """
+    if fcntl is None:
+        return None
+    request = bytearray(_FIEMAP_HEADER.size + _FIEMAP_EXTENT.size)
+    _FIEMAP_HEADER.pack_into(request, 0, offset, 1, 0, 0, 1, 0)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request, True)
+    except OSError:
+        return None
+    mapped_extents = _FIEMAP_HEADER.unpack_from(request)[3]
+    if not mapped_extents:
+        return None
+    logical, physical, _, _, _, flags, _, _, _ = _FIEMAP_EXTENT.unpack_from(request, _FIEMAP_HEADER.size)
+    if flags & _FIEMAP_EXTENT_UNKNOWN:
+        return None
+    return physical + offset - logical
+
+
+def _location_key(file_path: Path, first_block: int, block_size: int) -> LocationKey:
+    offset = first_block * block_size
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return 0, True, 0, 0, offset  # Left for the read to report
+    try:
+        file_stat = os.fstat(fd)
+        physical = physical_offset(fd, offset)
+    finally:
+        os.close(fd)
+    return file_stat.st_dev, physical is None, physical or 0, file_stat.st_ino, offset
+
+
+def order_by_location(
+    random_blocks_info: List[Tuple[Path, array]], block_size: int
+) -> List[Tuple[Path, array]]:
+    """
+    Order the (file_path, block_nums) samples of several files by where their first sampled block is on disk,
+    so that the reads sweep each device in a single direction rather than jumping across it in listing order.
+    Files are ordered by physical offset where the file system maps it, and otherwise by inode, which most
+    file systems allocate close to the data. The samples themselves are left unchanged.
+    """
+    if len(random_blocks_info) <= 1:
+        return random_blocks_info
+    keys = [
+        _location_key(file_path, block_nums[0], block_size) for file_path, block_nums in random_blocks_info
+    ]
+    order = sorted(range(len(random_blocks_info)), key=keys.__getitem__)
+    return [random_blocks_info[i] for i in order]
+
+
+def iter_merged_reads(block_nums: Sequence[int], block_size: int) -> Iterator[Sequence[int]]:
+    """
+    Split ascending block numbers into runs that are each read with a single pread, from the first block of
+    the run to the end of its last one. Blocks are merged while the gap to the previous one is at most
+    READ_MERGE_GAP bytes and the read stays within MAX_MERGED_READ_SIZE.
+    """
+    max_gap_blocks = READ_MERGE_GAP // block_size
+    max_run_blocks = max(1, MAX_MERGED_READ_SIZE // block_size)
+    start = 0
+    for i in range(1, len(block_nums)):
+        if (
+            block_nums[i] - block_nums[i - 1] - 1 > max_gap_blocks
+            or block_nums[i] - block_nums[start] >= max_run_blocks
+        ):
+            yield block_nums[start:i]
+            start = i
+    if block_nums:
+        yield block_nums[start:]
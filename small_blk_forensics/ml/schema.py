@@ -0,0 +1,224 @@
+import sqlite3
+from typing import Optional
+
+from small_blk_forensics.ml.filtering import BlockFilter
+from small_blk_forensics.ml.hashing import DEFAULT_HASH_ALGORITHM
+
+# Version 1 is the original layout: a single `hashes` table keyed by hex digests, with the file path repeated
+# on every row and no `meta` table.
+# Version 2 stores raw digests as BLOBs in a WITHOUT ROWID table and moves file paths into their own table.
+SCHEMA_VERSION = 2
+
+# Pragmas applied while building a known content DB. The build is committed at checkpoints so that it can be
+# resumed after a crash, and in WAL mode synchronous = NORMAL only syncs when the WAL is written back, so the
+# commits stay cheap while a crash cannot corrupt the DB.
+BULK_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -262144",  # 256 MiB
+]
+
+# Pragmas applied once a build is committed. The journal mode is stored in the DB file, so without them a
+# built DB would stay in WAL mode and every connection to it would leave its -wal and -shm files behind.
+END_BULK_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode = DELETE",
+]
+
+
+def read_schema_version(db_conn: sqlite3.Connection) -> int:
+    """
+    Returns the schema version of the database, or 0 if it does not contain a hashes table yet.
+    """
+    c = db_conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {name for (name,) in c.fetchall()}
+    if "meta" in tables:
+        c.execute("SELECT value FROM meta WHERE key = 'schema_version'")
+        return int(c.fetchone()[0])
+    return 1 if "hashes" in tables else 0
+
+
+def read_hash_algorithm(db_conn: sqlite3.Connection) -> str:
+    """
+    Returns the algorithm the block hashes of the database were computed with. Databases that do not record
+    one were all hashed with the default algorithm.
+    """
+    if read_schema_version(db_conn) < 2:
+        return DEFAULT_HASH_ALGORITHM
+    c = db_conn.cursor()
+    c.execute("SELECT value FROM meta WHERE key = 'hash_algorithm'")
+    row = c.fetchone()
+    return row[0] if row is not None else DEFAULT_HASH_ALGORITHM
+
+
+def read_num_shards(db_conn: sqlite3.Connection) -> int:
+    """
+    Returns the number of shard databases the hashes of the database are split into, 1 if they are all in its
+    own hashes table.
+    """
+    if read_schema_version(db_conn) < 2:
+        return 1
+    c = db_conn.cursor()
+    c.execute("SELECT value FROM meta WHERE key = 'num_shards'")
+    row = c.fetchone()
+    return int(row[0]) if row is not None else 1
+
+
+def read_build_in_progress(db_conn: sqlite3.Connection) -> Optional[str]:
+    """
+    Returns the known content directory of a build of the database that was interrupted before it completed,
+    or None.
+    """
+    if read_schema_version(db_conn) < 2:
+        return None
+    c = db_conn.cursor()
+    c.execute("SELECT value FROM meta WHERE key = 'build_in_progress'")
+    row = c.fetchone()
+    return row[0] if row is not None else None
+
+
+def set_build_in_progress(db_conn: sqlite3.Connection, directory: Optional[str]) -> None:
+    """
+    Record that the database is being built from a known content directory, or that its build completed with
+    None. Takes effect with the next commit.
+    """
+    if directory is None:
+        db_conn.execute("DELETE FROM meta WHERE key = 'build_in_progress'")
+    else:
+        db_conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('build_in_progress', ?)", (directory,)
+        )
+
+
+def read_block_filter(db_conn: sqlite3.Connection) -> BlockFilter:
+    """
+    Returns the filter of low-information blocks the database was built with. Databases that do not record
+    one hold every block.
+    """
+    if read_schema_version(db_conn) < 2:
+        return BlockFilter()
+    c = db_conn.cursor()
+    c.execute("SELECT key, value FROM meta")
+    meta = dict(c.fetchall())
+    return BlockFilter(
+        meta.get("skip_constant_blocks") == "1",
+        float(meta.get("min_entropy", 0)),
+        int(meta.get("common_block_threshold", 0)),
+    )
+
+
+def create_schema(
+    db_conn: sqlite3.Connection,
+    hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+    num_shards: int = 1,
+    block_filter: BlockFilter = BlockFilter(),
+) -> None:
+    """
+    Create the tables of the current schema version in an empty database, whose blocks are hashed with
+    hash_algorithm and filtered with block_filter. With several shards, the hashes table stays empty and the
+    hashes go to the shard databases instead.
+    """
+    c = db_conn.cursor()
+    _create_meta_table(db_conn)
+    c.execute(
+        """CREATE TABLE files (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE
+    )"""
+    )
+    _create_hashes_table(db_conn, " REFERENCES files (id)")
+    create_manifest_table(db_conn)
+    c.executemany(
+        "INSERT INTO meta (key, value) VALUES (?, ?)",
+        [
+            ("schema_version", str(SCHEMA_VERSION)),
+            ("hash_algorithm", hash_algorithm),
+            ("num_shards", str(num_shards)),
+            ("skip_constant_blocks", "1" if block_filter.skip_constant else "0"),
+            ("min_entropy", str(block_filter.min_entropy)),
+            ("common_block_threshold", str(block_filter.common_block_threshold)),
+        ],
+    )
+    db_conn.commit()
+
+
+def create_shard_schema(
+    db_conn: sqlite3.Connection, shard_index: int, num_shards: int, hash_algorithm: str
+) -> None:
+    """
+    Create the tables of a shard database in an empty database. A shard only holds a hashes table, whose
+    file ids refer to the files table of the main database.
+    """
+    _create_meta_table(db_conn)
+    _create_hashes_table(db_conn, "")
+    db_conn.executemany(
+        "INSERT INTO meta (key, value) VALUES (?, ?)",
+        [
+            ("schema_version", str(SCHEMA_VERSION)),
+            ("hash_algorithm", hash_algorithm),
+            ("shard_index", str(shard_index)),
+            ("num_shards", str(num_shards)),
+        ],
+    )
+    db_conn.commit()
+
+
+def _create_meta_table(db_conn: sqlite3.Connection) -> None:
+    db_conn.execute(
+        """CREATE TABLE meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )"""
+    )
+
+
+def _create_hashes_table(db_conn: sqlite3.Connection, file_id_constraint: str) -> None:
+    db_conn.execute(
+        f"""CREATE TABLE hashes (
+        hash BLOB PRIMARY KEY,
+        file_id INTEGER NOT NULL{file_id_constraint},
+        block_num INTEGER NOT NULL
+    ) WITHOUT ROWID"""
+    )
+    # Hashes of known content shared by several blocks, with the number of blocks sharing them
+    db_conn.execute(
+        """CREATE TABLE common_hashes (
+        hash BLOB PRIMARY KEY,
+        count INTEGER NOT NULL
+    ) WITHOUT ROWID"""
+    )
+    create_duplicate_hashes_table(db_conn)
+
+
+def create_duplicate_hashes_table(db_conn: sqlite3.Connection) -> None:
+    """
+    Create the table of the other files holding a hash owned by a block of the hashes table, if it does not
+    exist. When the owner is deleted by an incremental build, one of them takes its place.
+    Databases written before this table was introduced get it on their next build, but only record the
+    files that share a block from then on.
+    """
+    db_conn.execute(
+        """CREATE TABLE IF NOT EXISTS duplicate_hashes (
+        hash BLOB NOT NULL,
+        file_id INTEGER NOT NULL,
+        block_num INTEGER NOT NULL,
+        PRIMARY KEY (hash, file_id)
+    ) WITHOUT ROWID"""
+    )
+
+
+def create_manifest_table(db_conn: sqlite3.Connection) -> None:
+    """
+    Create the per-file manifest used for incremental rebuilds, if it does not exist.
+    Version 2 databases written before the manifest was introduced get it on their next build.
+    """
+    db_conn.execute(
+        """CREATE TABLE IF NOT EXISTS manifest (
+        file_id INTEGER PRIMARY KEY REFERENCES files (id),
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        block_size INTEGER NOT NULL
+    )"""
+    )
@@ -0,0 +1,555 @@
+import argparse
+import queue
+import sqlite3
+from collections import defaultdict
+from multiprocessing import Process, Queue, parent_process
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from small_blk_forensics.ml.filtering import delete_file_hash_rows, insert_hash_rows
+from small_blk_forensics.ml.schema import (
+    BULK_LOAD_PRAGMAS,
+    END_BULK_LOAD_PRAGMAS,
+    create_duplicate_hashes_table,
+    create_schema,
+    create_shard_schema,
+    read_block_filter,
+    read_hash_algorithm,
+    read_num_shards,
+    read_schema_version,
+)
+
+# Largest number of shards a known content DB can be split into
+MAX_SHARDS = 256
+
+# Messages queued per shard writer before the process feeding them blocks, which bounds memory when the
+# writers fall behind
+MAX_QUEUED_MESSAGES_PER_SHARD = 4
+
+# Rows per executemany call when merging databases
+MERGE_CHUNK_SIZE = 16384
+
+# (hash, file_id, block_num) row of a hashes table
+HashRow = Tuple[bytes, int, int]
+
+# (hash, count) row of a common_hashes table
+CommonHashRow = Tuple[bytes, int]
+
+
+def shard_path(db_path: Path, shard_index: int) -> Path:
+    return db_path.with_name(f"{db_path.name}.shard{shard_index:03}")
+
+
+def remove_shards(db_path: Path) -> None:
+    """
+    Delete the shard databases of a known content DB, along with their WAL files.
+    """
+    for path in db_path.parent.glob(f"{db_path.name}.shard*"):
+        path.unlink()
+
+
+def shard_of(hash_value: bytes, num_shards: int) -> int:
+    """
+    The shard holding a hash. Shards are contiguous ranges of the 32-bit hash prefix, so reading the shards
+    one after the other returns the hashes in sorted order.
+    """
+    return int.from_bytes(hash_value[:4], "big") * num_shards >> 32
+
+
+def db_file_path(db_conn: sqlite3.Connection) -> Path:
+    """
+    The path of the file of an open database.
+    """
+    for _, name, file_path in db_conn.execute("PRAGMA database_list"):
+        if name == "main":
+            return Path(file_path)
+    raise ValueError("Connection has no main database")
+
+
+class ShardSet:
+    """
+    Read-only connections to the shard databases of a known content DB. Each hash is looked up in the single
+    shard that can hold it, so a lookup only goes through the B-tree of that shard.
+    """
+
+    def __init__(self, db_conns: List[sqlite3.Connection]):
+        self.db_conns = db_conns
+
+    @classmethod
+    def open(cls, db_path: Path, num_shards: int) -> "ShardSet":
+        db_conns: List[sqlite3.Connection] = []
+        try:
+            for shard_index in range(num_shards):
+                path = shard_path(db_path, shard_index)
+                if not path.is_file():
+                    raise FileNotFoundError(f"Shard {shard_index} of {db_path} is missing at {path}")
+                db_conn = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+                db_conns.append(db_conn)
+                meta = dict(db_conn.execute("SELECT key, value FROM meta"))
+                if meta.get("shard_index") != str(shard_index) or meta.get("num_shards") != str(num_shards):
+                    raise ValueError(f"{path} is not shard {shard_index} of {num_shards}")
+        except BaseException:
+            for db_conn in db_conns:
+                db_conn.close()
+            raise
+        return cls(db_conns)
+
+    def query(self, target_hashes: List[bytes]) -> Dict[bytes, Tuple[int, int]]:
+        """
+        Returns a dict mapping each hash found in a shard to (file_id, block_num).
+        """
+        hashes_by_shard: Dict[int, List[bytes]] = defaultdict(list)
+        for target_hash in target_hashes:
+            hashes_by_shard[shard_of(target_hash, len(self.db_conns))].append(target_hash)
+
+        matches: Dict[bytes, Tuple[int, int]] = {}
+        for shard_index, shard_hashes in hashes_by_shard.items():
+            placeholders = ",".join("?" * len(shard_hashes))
+            c = self.db_conns[shard_index].execute(
+                f"SELECT hash, file_id, block_num FROM hashes WHERE hash IN ({placeholders})", shard_hashes
+            )
+            matches.update((hash_value, (file_id, block_num)) for hash_value, file_id, block_num in c)
+        return matches
+
+    def count(self) -> int:
+        return sum(db_conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0] for db_conn in self.db_conns)
+
+    def iter_rows(self) -> Iterator[HashRow]:
+        """
+        All rows of the shards in hash order.
+        """
+        for db_conn in self.db_conns:
+            yield from db_conn.execute("SELECT hash, file_id, block_num FROM hashes ORDER BY hash")
+
+    def iter_hashes(self) -> Iterator[bytes]:
+        return (hash_value for hash_value, _, _ in self.iter_rows())
+
+    def iter_common_rows(self) -> Iterator[CommonHashRow]:
+        for db_conn in self.db_conns:
+            yield from db_conn.execute("SELECT hash, count FROM common_hashes")
+
+    def iter_duplicate_rows(self) -> Iterator[HashRow]:
+        for db_conn in self.db_conns:
+            yield from _iter_duplicate_rows_of(db_conn)
+
+    def close(self) -> None:
+        for db_conn in self.db_conns:
+            db_conn.close()
+        self.db_conns = []
+
+
+def _run_shard_writer(
+    path: str,
+    shard_index: int,
+    num_shards: int,
+    hash_algorithm: str,
+    count_common: bool,
+    messages: Queue,
+    commits: Queue,
+    errors: Queue,
+) -> None:
+    """
+    Apply the messages queued for a shard to its database, in order, until the None that ends the build.
+    Each commit requested along the way is acknowledged on the commits queue once it is done. A writer whose
+    build process died exits without committing, rather than holding the lock on its shard forever.
+    Lives at module level so that it can be started in a new process.
+    """
+    try:
+        db_conn = sqlite3.connect(path)
+        if read_schema_version(db_conn) == 0:
+            create_shard_schema(db_conn, shard_index, num_shards, hash_algorithm)
+        else:
+            create_duplicate_hashes_table(db_conn)
+        for pragma in BULK_LOAD_PRAGMAS:
+            db_conn.execute(pragma)
+
+        while True:
+            try:
+                message = messages.get(timeout=1)
+            except queue.Empty:
+                parent = parent_process()
+                if parent is not None and not parent.is_alive():
+                    return
+                continue
+            if message is None:
+                break
+            kind, rows = message
+            if kind == "insert":
+                insert_hash_rows(db_conn, rows, count_common)
+            elif kind == "add_common":
+                add_common_hash_rows(db_conn, rows)
+            elif kind == "add_duplicates":
+                add_duplicate_hash_rows(db_conn, rows)
+            elif kind == "commit":
+                db_conn.commit()
+                commits.put(shard_index)
+            elif kind == "delete_file_ids_above":
+                delete_file_hash_rows(db_conn, "file_id > ?", (rows,))
+            else:
+                db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS stale_files (id INTEGER PRIMARY KEY)")
+                db_conn.execute("DELETE FROM temp.stale_files")
+                db_conn.executemany("INSERT INTO temp.stale_files (id) VALUES (?)", ((i,) for i in rows))
+                delete_file_hash_rows(db_conn, "file_id IN (SELECT id FROM temp.stale_files)")
+        db_conn.commit()
+        for pragma in END_BULK_LOAD_PRAGMAS:
+            db_conn.execute(pragma)
+        db_conn.close()
+    except BaseException as e:
+        errors.put(f"Writer of shard {shard_index} failed: {e!r}")
+        raise
+
+
+class ShardWriters:
+    """
+    One process per shard that writes the rows routed to it into its shard database, so that a sharded DB is
+    written by all of its shards in parallel rather than by a single writer.
+    Rows reach a shard in the order they are written here, so INSERT OR IGNORE keeps the same owner for a
+    duplicated block as with a single database, and the same blocks are counted as common. Nothing is
+    committed until a checkpoint is requested or the writers are closed cleanly.
+    """
+
+    def __init__(self, db_path: Path, num_shards: int, hash_algorithm: str, count_common: bool = False):
+        self.num_shards = num_shards
+        self._errors: Queue = Queue()
+        self._commits: Queue = Queue()
+        self._queues: List[Queue] = []
+        self._processes: List[Process] = []
+        for shard_index in range(num_shards):
+            messages: Queue = Queue(MAX_QUEUED_MESSAGES_PER_SHARD)
+            process = Process(
+                target=_run_shard_writer,
+                args=(
+                    str(shard_path(db_path, shard_index)),
+                    shard_index,
+                    num_shards,
+                    hash_algorithm,
+                    count_common,
+                    messages,
+                    self._commits,
+                    self._errors,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self._queues.append(messages)
+            self._processes.append(process)
+
+    def __enter__(self) -> "ShardWriters":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def insert(self, rows: Iterable[HashRow]) -> None:
+        rows_by_shard: Dict[int, List[HashRow]] = defaultdict(list)
+        for row in rows:
+            rows_by_shard[shard_of(row[0], self.num_shards)].append(row)
+        for shard_index, shard_rows in rows_by_shard.items():
+            self._send(shard_index, ("insert", shard_rows))
+
+    def add_common(self, rows: Iterable[CommonHashRow]) -> None:
+        rows_by_shard: Dict[int, List[CommonHashRow]] = defaultdict(list)
+        for row in rows:
+            rows_by_shard[shard_of(row[0], self.num_shards)].append(row)
+        for shard_index, shard_rows in rows_by_shard.items():
+            self._send(shard_index, ("add_common", shard_rows))
+
+    def add_duplicates(self, rows: Iterable[HashRow]) -> None:
+        rows_by_shard: Dict[int, List[HashRow]] = defaultdict(list)
+        for row in rows:
+            rows_by_shard[shard_of(row[0], self.num_shards)].append(row)
+        for shard_index, shard_rows in rows_by_shard.items():
+            self._send(shard_index, ("add_duplicates", shard_rows))
+
+    def delete_files(self, file_ids: List[int]) -> None:
+        """
+        Delete the hashes of the given files from every shard.
+        """
+        if file_ids:
+            for shard_index in range(self.num_shards):
+                self._send(shard_index, ("delete_files", file_ids))
+
+    def delete_file_ids_above(self, max_file_id: int) -> None:
+        """
+        Delete the hashes of file ids above max_file_id from every shard, which a crashed build may have
+        committed to the shards before it committed the files they belong to.
+        """
+        for shard_index in range(self.num_shards):
+            self._send(shard_index, ("delete_file_ids_above", max_file_id))
+
+    def commit(self) -> None:
+        """
+        Wait for the writers to apply everything sent to them so far and commit it.
+        """
+        for shard_index in range(self.num_shards):
+            self._send(shard_index, ("commit", None))
+        for _ in range(self.num_shards):
+            while True:
+                try:
+                    self._commits.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not all(process.is_alive() for process in self._processes):
+                        self._raise_writer_error()
+
+    def _send(self, shard_index: int, message: Optional[tuple]) -> None:
+        while True:
+            try:
+                self._queues[shard_index].put(message, timeout=1)
+                return
+            except queue.Full:
+                if not self._processes[shard_index].is_alive():
+                    self._raise_writer_error()
+
+    def close(self) -> None:
+        """
+        Wait for the writers to apply everything sent to them and commit.
+        """
+        for shard_index in range(self.num_shards):
+            self._send(shard_index, None)
+        for process in self._processes:
+            process.join()
+        if any(process.exitcode != 0 for process in self._processes):
+            self._raise_writer_error()
+
+    def terminate(self) -> None:
+        """
+        Stop the writers without committing.
+        """
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()
+
+    def _raise_writer_error(self) -> None:
+        self.terminate()
+        try:
+            error = self._errors.get(timeout=1)
+        except queue.Empty:
+            error = "A shard writer exited unexpectedly"
+        raise RuntimeError(error)
+
+
+def _iter_hash_rows(db_conn: sqlite3.Connection) -> Iterator[HashRow]:
+    """
+    All hash rows of a known content DB in hash order, from its shards if it has any.
+    """
+    num_shards = read_num_shards(db_conn)
+    if num_shards == 1:
+        yield from db_conn.execute("SELECT hash, file_id, block_num FROM hashes ORDER BY hash")
+        return
+    shard_set = ShardSet.open(db_file_path(db_conn), num_shards)
+    try:
+        yield from shard_set.iter_rows()
+    finally:
+        shard_set.close()
+
+
+def _iter_common_hash_rows(db_conn: sqlite3.Connection) -> Iterator[CommonHashRow]:
+    num_shards = read_num_shards(db_conn)
+    if num_shards == 1:
+        yield from db_conn.execute("SELECT hash, count FROM common_hashes")
+        return
+    shard_set = ShardSet.open(db_file_path(db_conn), num_shards)
+    try:
+        yield from shard_set.iter_common_rows()
+    finally:
+        shard_set.close()
+
+
+def _iter_duplicate_hash_rows(db_conn: sqlite3.Connection) -> Iterator[HashRow]:
+    num_shards = read_num_shards(db_conn)
+    if num_shards == 1:
+        yield from _iter_duplicate_rows_of(db_conn)
+        return
+    shard_set = ShardSet.open(db_file_path(db_conn), num_shards)
+    try:
+        yield from shard_set.iter_duplicate_rows()
+    finally:
+        shard_set.close()
+
+
+def _iter_duplicate_rows_of(db_conn: sqlite3.Connection) -> Iterator[HashRow]:
+    """
+    The duplicate_hashes rows of a single database, none if it was written before the table was introduced.
+    """
+    c = db_conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'duplicate_hashes'")
+    if c.fetchone() is not None:
+        yield from db_conn.execute("SELECT hash, file_id, block_num FROM duplicate_hashes")
+
+
+def add_duplicate_hash_rows(db_conn: sqlite3.Connection, rows: List[HashRow]) -> None:
+    """
+    Add the (hash, file_id, block_num) rows of the other files holding a hash of a merged source.
+    """
+    db_conn.executemany(
+        "INSERT OR IGNORE INTO duplicate_hashes (hash, file_id, block_num) VALUES (?, ?, ?)", rows
+    )
+
+
+def add_common_hash_rows(db_conn: sqlite3.Connection, rows: List[CommonHashRow]) -> None:
+    """
+    Add the (hash, count) rows of common hashes of a merged source whose hash rows are already inserted. A
+    hash owned by another source has been counted once for the row of this source, so the rest of its count
+    is added.
+    """
+    db_conn.executemany(
+        """INSERT INTO common_hashes (hash, count) VALUES (?, ?)
+        ON CONFLICT (hash) DO UPDATE SET count = count + excluded.count - 1""",
+        rows,
+    )
+
+
+def merge_known_content(sources: List[Path], destination: Path, num_shards: int = 1) -> None:
+    """
+    Merge known content DBs, sharded or not, into a new DB split into num_shards shards. A block found in
+    several sources keeps the owner it has in the first one.
+    Merging a single DB rewrites it with its hashes in order and without the free pages left by incremental
+    builds, and can change its number of shards.
+    """
+    if not 1 <= num_shards <= MAX_SHARDS:
+        raise ValueError(f"Number of shards must be between 1 and {MAX_SHARDS}")
+    if destination.exists():
+        raise FileExistsError(destination)
+
+    source_conns = [sqlite3.connect(f"{source.resolve().as_uri()}?mode=ro", uri=True) for source in sources]
+    try:
+        for source, source_conn in zip(sources, source_conns):
+            if read_schema_version(source_conn) != 2:
+                raise ValueError(f"{source} must use schema version 2 to be merged, regenerate it first")
+        hash_algorithms = {read_hash_algorithm(source_conn) for source_conn in source_conns}
+        if len(hash_algorithms) != 1:
+            raise ValueError(f"Cannot merge DBs hashed with different algorithms: {sorted(hash_algorithms)}")
+        block_sizes = {
+            block_size
+            for source_conn in source_conns
+            for (block_size,) in source_conn.execute("SELECT DISTINCT block_size FROM manifest")
+        }
+        if len(block_sizes) > 1:
+            raise ValueError(f"Cannot merge DBs hashed with different block sizes: {sorted(block_sizes)}")
+        block_filters = {read_block_filter(source_conn) for source_conn in source_conns}
+        if len(block_filters) != 1:
+            raise ValueError("Cannot merge DBs built with different filters of low-information blocks")
+        (hash_algorithm,) = hash_algorithms
+        (block_filter,) = block_filters
+        count_common = block_filter.common_block_threshold > 0
+
+        remove_shards(destination)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        db_conn = sqlite3.connect(destination)
+        try:
+            create_schema(db_conn, hash_algorithm, num_shards, block_filter)
+            for pragma in BULK_LOAD_PRAGMAS:
+                db_conn.execute(pragma)
+            if num_shards > 1:
+                with ShardWriters(destination, num_shards, hash_algorithm, count_common) as shard_writers:
+                    for source, source_conn in zip(sources, source_conns):
+                        _merge_source(
+                            source, source_conn, db_conn, shard_writers.insert, shard_writers.add_duplicates
+                        )
+                        if count_common:
+                            _merge_common_hashes(source_conn, shard_writers.add_common)
+            else:
+                for source, source_conn in zip(sources, source_conns):
+                    _merge_source(
+                        source,
+                        source_conn,
+                        db_conn,
+                        lambda rows: insert_hash_rows(db_conn, rows, count_common),
+                        lambda rows: add_duplicate_hash_rows(db_conn, rows),
+                    )
+                    if count_common:
+                        _merge_common_hashes(source_conn, lambda rows: add_common_hash_rows(db_conn, rows))
+            db_conn.commit()
+            for pragma in END_BULK_LOAD_PRAGMAS:
+                db_conn.execute(pragma)
+        except BaseException:
+            db_conn.close()
+            destination.unlink()
+            remove_shards(destination)
+            raise
+        db_conn.close()
+    finally:
+        for source_conn in source_conns:
+            source_conn.close()
+    print(f"INFO: Merged {len(sources)} DBs into {destination} with {num_shards} shards")
+
+
+def _merge_source(
+    source: Path,
+    source_conn: sqlite3.Connection,
+    db_conn: sqlite3.Connection,
+    insert: Callable[[List[HashRow]], object],
+    add_duplicates: Callable[[List[HashRow]], object],
+) -> None:
+    print(f"INFO: Merging {source}")
+    # Files are matched by path across sources, and renumbered in the destination
+    source_files = source_conn.execute("SELECT id, path FROM files").fetchall()
+    db_conn.executemany(
+        "INSERT OR IGNORE INTO files (path) VALUES (?)", ((path,) for _, path in source_files)
+    )
+    file_ids = dict(db_conn.execute("SELECT path, id FROM files"))
+    new_file_ids = {file_id: file_ids[path] for file_id, path in source_files}
+
+    db_conn.executemany(
+        """INSERT OR IGNORE INTO manifest (file_id, size, mtime_ns, inode, block_size)
+        VALUES (?, ?, ?, ?, ?)""",
+        (
+            (new_file_ids[file_id], *signature)
+            for file_id, *signature in source_conn.execute(
+                "SELECT file_id, size, mtime_ns, inode, block_size FROM manifest"
+            )
+        ),
+    )
+
+    rows: List[HashRow] = []
+    for hash_value, file_id, block_num in _iter_hash_rows(source_conn):
+        rows.append((hash_value, new_file_ids[file_id], block_num))
+        if len(rows) >= MERGE_CHUNK_SIZE:
+            insert(rows)
+            rows = []
+    if rows:
+        insert(rows)
+
+    # The other files holding a hash of the source, after its owners so that they stay the owners
+    rows = []
+    for hash_value, file_id, block_num in _iter_duplicate_hash_rows(source_conn):
+        rows.append((hash_value, new_file_ids[file_id], block_num))
+        if len(rows) >= MERGE_CHUNK_SIZE:
+            add_duplicates(rows)
+            rows = []
+    if rows:
+        add_duplicates(rows)
+
+
+def _merge_common_hashes(
+    source_conn: sqlite3.Connection, add_common: Callable[[List[CommonHashRow]], object]
+) -> None:
+    rows: List[CommonHashRow] = []
+    for row in _iter_common_hash_rows(source_conn):
+        rows.append(row)
+        if len(rows) >= MERGE_CHUNK_SIZE:
+            add_common(rows)
+            rows = []
+    if rows:
+        add_common(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge known content DBs into a new DB, optionally split into shards"
+    )
+    parser.add_argument("destination", type=Path, help="Path of the merged DB, which must not exist yet")
+    parser.add_argument("sources", type=Path, nargs="+", help="DBs to merge, earlier ones take precedence")
+    parser.add_argument(
+        "--num_shards", type=int, default=1, help="Number of shards of the merged DB. Defaults to 1."
+    )
+    args = parser.parse_args()
+    merge_known_content(args.sources, args.destination, args.num_shards)
+
+
+if __name__ == "__main__":
+    main()
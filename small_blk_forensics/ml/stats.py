@@ -0,0 +1,91 @@
+import cProfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+
+class ScanStats:
+    """
+    Counters and timers of model runs, to tell whether walking the target, reading blocks, hashing them or
+    querying the DB is where the time goes. Hashing and querying time are summed over the threads and
+    processes doing them, so they can add up to more than the wall time of a stage.
+    Hot loops accumulate their counts locally and add them once, since the target scan updates these from
+    several threads under a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.files_visited = 0
+        self.blocks_read = 0
+        self.bytes_read = 0
+        self.hash_seconds = 0.0
+        self.db_queries = 0
+        self.db_query_seconds = 0.0
+        self.blocks_filtered = 0  # low-information blocks skipped before hashing or lookup
+        self.stage_seconds: Dict[str, float] = {}
+
+    def add(
+        self,
+        files_visited: int = 0,
+        blocks_read: int = 0,
+        bytes_read: int = 0,
+        hash_seconds: float = 0.0,
+        db_queries: int = 0,
+        db_query_seconds: float = 0.0,
+        blocks_filtered: int = 0,
+    ) -> None:
+        with self._lock:
+            self.files_visited += files_visited
+            self.blocks_read += blocks_read
+            self.bytes_read += bytes_read
+            self.hash_seconds += hash_seconds
+            self.db_queries += db_queries
+            self.db_query_seconds += db_query_seconds
+            self.blocks_filtered += blocks_filtered
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """
+        Add the wall time of the block to the given stage, including when it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + elapsed
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "files_visited": self.files_visited,
+                "blocks_read": self.blocks_read,
+                "bytes_read": self.bytes_read,
+                "hash_seconds": round(self.hash_seconds, 6),
+                "db_queries": self.db_queries,
+                "db_query_seconds": round(self.db_query_seconds, 6),
+                "blocks_filtered": self.blocks_filtered,
+                "stage_seconds": {stage: round(seconds, 6) for stage, seconds in self.stage_seconds.items()},
+            }
+
+
+@contextmanager
+def profiled(output_path: Optional[Path]) -> Iterator[None]:
+    """
+    Profile the block with cProfile and save the stats to output_path, to be read with `python -m pstats`.
+    Only the calling thread is profiled, not the threads and processes it starts. Does nothing without a path.
+    """
+    if output_path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output_path)
+        print(f"INFO: Saved the profile to {output_path}")
@@ -0,0 +1,200 @@
+import hashlib
+import os
+import sqlite3
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Union
+
+# Version of the layout of block map cache files, a cache file with another version is ignored
+LISTING_CACHE_VERSION = 1
+
+
+class DirectoryListing:
+    """
+    The non-empty files under a directory in the order they are walked, and the mtimes of the directories
+    walked. Paths and sizes are kept in flat containers rather than one object per file, since targets can
+    hold millions of files.
+    """
+
+    def __init__(self):
+        self.file_paths: List[str] = []
+        self.file_sizes = array("Q")
+        self.dir_paths: List[str] = []
+        self.dir_mtimes = array("q")
+
+    def extend(self, other: "DirectoryListing") -> None:
+        self.file_paths.extend(other.file_paths)
+        self.file_sizes.extend(other.file_sizes)
+        self.dir_paths.extend(other.dir_paths)
+        self.dir_mtimes.extend(other.dir_mtimes)
+
+
+def _scan_directory(path: str, listing: DirectoryListing, subdirs: List[str]) -> None:
+    """
+    Add the files of a single directory to the listing, and its subdirectories to subdirs.
+    The file size comes from the stat result cached by the DirEntry, so each file costs a single stat.
+    Symlinks to files are followed, symlinks to directories are not, and unreadable directories are skipped.
+    """
+    try:
+        # Taken before listing the directory, so that a change made during the walk invalidates the cache
+        mtime_ns = os.stat(path).st_mtime_ns
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    file_size = entry.stat().st_size
+                    if file_size:
+                        listing.file_paths.append(entry.path)
+                        listing.file_sizes.append(file_size)
+    except PermissionError:
+        return
+    listing.dir_paths.append(path)
+    listing.dir_mtimes.append(mtime_ns)
+
+
+def _walk_subtree(path: str) -> DirectoryListing:
+    """
+    Walk a directory tree depth first, listing the files of a directory before those of its subdirectories.
+    This is the same order as Path.rglob.
+    """
+    listing = DirectoryListing()
+    stack = [path]
+    while stack:
+        subdirs: List[str] = []
+        _scan_directory(stack.pop(), listing, subdirs)
+        stack.extend(reversed(subdirs))
+    return listing
+
+
+def walk_directory(directory: Path, num_threads: int = 1) -> DirectoryListing:
+    """
+    List the non-empty files under a directory.
+    With several threads, the top of the tree is expanded breadth first until there are enough subtrees to
+    keep the threads busy, and the subtrees are then walked in parallel. scandir and stat release the GIL, so
+    the walks overlap on slow storage. The listing is in the same order as with a single thread.
+    """
+    if num_threads <= 1:
+        return _walk_subtree(str(directory))
+
+    # Each segment of the walk is either a listing of the files of a directory, or a subtree still to walk
+    segments: List[Union[DirectoryListing, str]] = [str(directory)]
+    while 0 < sum(isinstance(segment, str) for segment in segments) < 4 * num_threads:
+        expanded: List[Union[DirectoryListing, str]] = []
+        for segment in segments:
+            if isinstance(segment, str):
+                listing = DirectoryListing()
+                subdirs: List[str] = []
+                _scan_directory(segment, listing, subdirs)
+                expanded.append(listing)
+                expanded.extend(subdirs)
+            else:
+                expanded.append(segment)
+        segments = expanded
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        walks: List[Union[DirectoryListing, Future]] = [
+            executor.submit(_walk_subtree, segment) if isinstance(segment, str) else segment
+            for segment in segments
+        ]
+        listing = DirectoryListing()
+        for walk in walks:
+            listing.extend(walk.result() if isinstance(walk, Future) else walk)
+    return listing
+
+
+def _listing_cache_path(cache_dir: Path, directory: Path) -> Path:
+    return cache_dir / f"{hashlib.sha1(str(directory.resolve()).encode()).hexdigest()}.sqlite"
+
+
+def load_cached_listing(cache_dir: Path, directory: Path) -> Optional[DirectoryListing]:
+    """
+    The listing of a directory saved by a previous walk, or None if there is none or if any directory of the
+    tree was modified since. A directory's mtime changes when entries are added to, removed from or renamed in
+    it, but not when an existing file is rewritten in place, so that is not detected.
+    """
+    cache_path = _listing_cache_path(cache_dir, directory)
+    if not cache_path.is_file():
+        return None
+
+    db_conn = sqlite3.connect(cache_path)
+    try:
+        c = db_conn.cursor()
+        c.execute("SELECT key, value FROM meta")
+        meta = dict(c.fetchall())
+        if meta.get("version") != str(LISTING_CACHE_VERSION) or meta.get("directory") != str(directory):
+            return None
+
+        listing = DirectoryListing()
+        c.execute("SELECT path, mtime_ns FROM directories ORDER BY rowid")
+        for dir_path, mtime_ns in c:
+            try:
+                if os.stat(dir_path).st_mtime_ns != mtime_ns:
+                    return None
+            except OSError:
+                return None
+            listing.dir_paths.append(dir_path)
+            listing.dir_mtimes.append(mtime_ns)
+
+        c.execute("SELECT path, size FROM files ORDER BY rowid")
+        for file_path, file_size in c:
+            listing.file_paths.append(file_path)
+            listing.file_sizes.append(file_size)
+        return listing
+    except sqlite3.DatabaseError:
+        return None  # Not a cache file written by this version
+    finally:
+        db_conn.close()
+
+
+def save_cached_listing(cache_dir: Path, directory: Path, listing: DirectoryListing) -> None:
+    """
+    Save the listing of a directory. The cache file is written next to its final path and then renamed over
+    it, so concurrent scans never read a partial file.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_path = _listing_cache_path(cache_dir, directory)
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+
+    db_conn = sqlite3.connect(tmp_path)
+    try:
+        c = db_conn.cursor()
+        c.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        c.execute("CREATE TABLE directories (path TEXT NOT NULL, mtime_ns INTEGER NOT NULL)")
+        c.execute("CREATE TABLE files (path TEXT NOT NULL, size INTEGER NOT NULL)")
+        c.executemany(
+            "INSERT INTO meta (key, value) VALUES (?, ?)",
+            [("version", str(LISTING_CACHE_VERSION)), ("directory", str(directory))],
+        )
+        c.executemany(
+            "INSERT INTO directories (path, mtime_ns) VALUES (?, ?)",
+            zip(listing.dir_paths, listing.dir_mtimes),
+        )
+        c.executemany(
+            "INSERT INTO files (path, size) VALUES (?, ?)", zip(listing.file_paths, listing.file_sizes)
+        )
+        db_conn.commit()
+    finally:
+        db_conn.close()
+    os.replace(tmp_path, cache_path)
+
+
+def list_directory(
+    directory: Path, num_threads: int = 1, cache_dir: Optional[Path] = None
+) -> DirectoryListing:
+    """
+    List the non-empty files under a directory, reusing the listing saved in cache_dir by a previous walk of
+    the same unmodified tree if there is one.
+    """
+    if cache_dir is None:
+        return walk_directory(directory, num_threads)
+
+    listing = load_cached_listing(cache_dir, directory)
+    if listing is not None:
+        print(f"INFO: Using the cached listing of {str(directory)}")
+        return listing
+
+    listing = walk_directory(directory, num_threads)
+    save_cached_listing(cache_dir, directory, listing)
+    return listing
@@ -1,10 +1,18 @@
 import os
+import stat
 
 
 def is_dir_path(path: str) -> bool:
     return os.path.isdir(path)  # type: ignore
 
 
+def is_image_path(path: str) -> bool:
+    """
+    A raw disk image is a regular file, a drive is a block device.
+    """
+    return os.path.isfile(path) or (os.path.exists(path) and stat.S_ISBLK(os.stat(path).st_mode))
+
+
 def dir_path_arg_parser(path: str) -> str:
     if is_dir_path(path):
         return path
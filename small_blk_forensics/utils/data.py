@@ -6,6 +6,23 @@ from pydantic import BaseModel
 class Parameters(TypedDict):
     block_size: int
     target_probability: float
+    num_io_threads: int
+
+
+class ParametersKnownContentDirectory(Parameters):
+    num_workers: int
+    hash_algorithm: str
+
+
+class ParametersKnownContentSql(Parameters):
+    index_memory_limit_mb: int
+    adaptive_sampling: str
+
+
+class ParametersExhaustive(TypedDict):
+    block_size: int
+    num_io_threads: int
+    index_memory_limit_mb: int
 
 
 # Model for result
@@ -15,6 +32,8 @@ class MyModelResponse(BaseModel):
     known_dataset_file: Optional[str] = None
     block_num_in_known_dataset_file: Optional[int] = None
     block_num_in_target_file: Optional[int] = None
+    # Counters and timers of the run, see small_blk_forensics.ml.stats.ScanStats
+    stats: Optional[dict] = None
 
     # Additional validation to ensure files are provided if found is True
     @classmethod
@@ -22,3 +41,13 @@ class MyModelResponse(BaseModel):
         if result.found and (not result.target_file or not result.known_dataset_file):
             raise ValueError("Both target_file and known_dataset_file must be provided if found is True.")
         return result
+
+
+# Model for the result of an exhaustive scan, the matches themselves are written to results_path
+class ExhaustiveScanResponse(BaseModel):
+    results_path: str
+    files_scanned: int = 0
+    files_matched: int = 0
+    blocks_scanned: int = 0
+    blocks_matched: int = 0
+    stats: Optional[dict] = None